@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Benchmark of the PIL <-> Cairo conversions (image2surface() and
+surface2image()) on A4 scans at 300 and 600 dpi, compared with the previous
+implementations. image2surface() is measured with both its direct encoding
+and its public tobytes() fallback.
+
+Usage: bench-imgconv.py [number of runs]
+"""
+
+import array
+import sys
+import time
+
+import cairo
+import PIL.Image
+import PIL.ImageDraw
+
+import paperwork.backend.util as util
+
+
+# A4 = 210mm x 297mm
+A4_SIZES = [
+    ("A4 300dpi", (2480, 3508)),
+    ("A4 600dpi", (4960, 7016)),
+]
+
+
+def old_image2surface(img):
+    img.putalpha(256)
+    (width, height) = img.size
+    imgd = img.tobytes('raw', 'BGRA')
+    imga = array.array('B', imgd)
+    stride = width * 4
+    return cairo.ImageSurface.create_for_data(
+        imga, cairo.FORMAT_ARGB32, width, height, stride)
+
+
+def old_surface2image(surface):
+    dimension = (surface.get_width(), surface.get_height())
+    img = PIL.Image.frombuffer("RGBA", dimension,
+                               surface.get_data(), "raw", "BGRA", 0, 1)
+    background = PIL.Image.new("RGB", img.size, (255, 255, 255))
+    background.paste(img, mask=img.split()[3])
+    return background
+
+
+def public_image2surface(img):
+    """
+    image2surface() restricted to the public img.tobytes() path (used with
+    the versions of Pillow not in DIRECT_IMG_CONV_PILLOW_VERSIONS)
+    """
+    versions = util.DIRECT_IMG_CONV_PILLOW_VERSIONS
+    util.DIRECT_IMG_CONV_PILLOW_VERSIONS = []
+    try:
+        return util.image2surface(img)
+    finally:
+        util.DIRECT_IMG_CONV_PILLOW_VERSIONS = versions
+
+
+def make_scan(size):
+    """
+    Something that looks vaguely like a scanned page of text
+    """
+    img = PIL.Image.new("RGB", size, (250, 248, 240))
+    draw = PIL.ImageDraw.Draw(img)
+    line_height = size[1] / 80
+    for line in xrange(5, 75):
+        y = line * line_height
+        draw.rectangle((size[0] / 10, y, size[0] * 9 / 10,
+                        y + line_height / 2), fill=(20, 20, 30))
+    return img
+
+
+def bench(name, func, make_arg, nb_runs):
+    best = None
+    for _ in xrange(0, nb_runs):
+        arg = make_arg()
+        start = time.time()
+        func(arg)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    print("    %-24s %8.1f ms" % (name, best * 1000))
+
+
+def main():
+    nb_runs = 5
+    if len(sys.argv) > 1:
+        nb_runs = int(sys.argv[1])
+
+    for (name, size) in A4_SIZES:
+        print("%s (%dx%d), best of %d runs:" % (name, size[0], size[1],
+                                                nb_runs))
+        scan = make_scan(size)
+        # the old image2surface() modifies its input
+        bench("old image2surface()", old_image2surface, scan.copy, nb_runs)
+        bench("image2surface()", util.image2surface, lambda: scan, nb_runs)
+        bench("image2surface() (tobytes)", public_image2surface,
+              lambda: scan, nb_runs)
+        bench("image2surface() (RGBA)", util.image2surface,
+              lambda: scan.convert("RGBA"), nb_runs)
+
+        argb_surface = old_image2surface(scan.copy())
+        rgb_surface = util.image2surface(scan)
+        bench("old surface2image()", old_surface2image,
+              lambda: argb_surface, nb_runs)
+        bench("surface2image() (ARGB32)", util.surface2image,
+              lambda: argb_surface, nb_runs)
+        bench("surface2image() (RGB24)", util.surface2image,
+              lambda: rgb_surface, nb_runs)
+
+        assert(util.surface2image(rgb_surface).tobytes() == scan.tobytes())
+        assert(util.surface2image(public_image2surface(scan)).tobytes() ==
+               scan.tobytes())
+        print("")
+
+
+if __name__ == "__main__":
+    main()
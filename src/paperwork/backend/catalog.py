@@ -0,0 +1,257 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Document catalog: a compact on-disk summary of all the indexed documents.
+
+It is stored next to the Whoosh index and rewritten each time the index is
+committed. It allows DocSearch to instantiate the whole document list at
+startup without touching any of the document directories.
+"""
+
+import logging
+import mmap
+import os
+import struct
+
+from paperwork.backend.util import write_file_atomically
+
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogEntry(object):
+    """
+    What the catalog knows about a document.
+
+    nb_pages is -1 and page_sizes is empty when unknown.
+    """
+
+    def __init__(self, docid, doctype, nb_pages=-1, last_mod=0.0,
+                 labels=None, page_sizes=None, content_mtime=0.0):
+        if labels is None:
+            labels = []
+        if page_sizes is None:
+            page_sizes = []
+        self.docid = docid
+        self.doctype = doctype
+        self.nb_pages = nb_pages
+        self.last_mod = last_mod
+        self.labels = labels  # [(label name, color string), ...]
+        self.page_sizes = page_sizes  # [(width, height), ...]
+        # most recent mtime of the page images / PDF file when page_sizes
+        # was computed (see DocDirSnapshot.get_content_last_mod())
+        self.content_mtime = content_mtime
+
+    @staticmethod
+    def from_doc(doc, last_mod, with_geometry=True, previous=None):
+        """
+        Arguments:
+            previous --- previous catalog entry of the document, if any. Its
+                page sizes are reused if the page files haven't changed.
+        """
+        labels = [(label.name, label.get_color_str()) for label in doc.labels]
+        nb_pages = doc.nb_pages
+        content_mtime = doc.get_snapshot().get_content_last_mod()
+        page_sizes = []
+        if with_geometry:
+            if (previous is not None and
+                    previous.nb_pages == nb_pages and
+                    len(previous.page_sizes) == nb_pages and
+                    previous.content_mtime == content_mtime):
+                page_sizes = previous.page_sizes
+            else:
+                page_sizes = [page.size for page in doc.pages]
+        return CatalogEntry(unicode(doc.docid), doc.doctype, nb_pages,
+                            last_mod, labels, page_sizes, content_mtime)
+
+    def get_doc_cache(self):
+        """
+        Returns the values that can be used to pre-fill the cache of a
+        document (see BasicDoc.__init__())
+        """
+        from paperwork.backend.labels import Label
+
+        cache = {
+            'new': False,
+            'labels': [Label.intern(name, color)
+                       for (name, color) in self.labels],
+            'last_mod': self.last_mod,
+        }
+        if self.nb_pages >= 0:
+            cache['nb_pages'] = self.nb_pages
+        return cache
+
+    def __str__(self):
+        return ("%s (%s, %d pages)"
+                % (self.docid, self.doctype, self.nb_pages))
+
+
+class DocCatalog(object):
+    """
+    Reads and writes the catalog file.
+
+    The file is only considered valid if it has been written for the current
+    generation of the Whoosh index. Otherwise, the caller must fall back on
+    examining the documents themselves.
+
+    File format (little endian):
+        header: magic, version, index generation, number of entries
+        offset table: one uint32 per entry
+        entries:
+            docid, doctype (length-prefixed UTF-8 strings)
+            nb_pages (int32), last_mod (double), content_mtime (double)
+            labels: count (uint16), then name and color (strings)
+            page sizes: count (uint32), then (width, height) (uint32 each)
+    """
+    MAGIC = "PWCT"
+    VERSION = 2
+
+    _HEADER = struct.Struct("<4sIiI")
+    _OFFSET = struct.Struct("<I")
+    _STR_LEN = struct.Struct("<H")
+    _DOC_INFOS = struct.Struct("<idd")
+    _NB_LABELS = struct.Struct("<H")
+    _NB_SIZES = struct.Struct("<I")
+    _SIZE = struct.Struct("<II")
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # docid --> CatalogEntry
+
+    def __read_str(self, buf, offset):
+        (length, ) = self._STR_LEN.unpack_from(buf, offset)
+        offset += self._STR_LEN.size
+        string = buf[offset:offset + length].decode("utf-8")
+        return (string, offset + length)
+
+    def __read_entry(self, buf, offset):
+        (docid, offset) = self.__read_str(buf, offset)
+        (doctype, offset) = self.__read_str(buf, offset)
+        (nb_pages, last_mod, content_mtime) = \
+            self._DOC_INFOS.unpack_from(buf, offset)
+        offset += self._DOC_INFOS.size
+
+        (nb_labels, ) = self._NB_LABELS.unpack_from(buf, offset)
+        offset += self._NB_LABELS.size
+        labels = []
+        for _ in xrange(0, nb_labels):
+            (name, offset) = self.__read_str(buf, offset)
+            (color, offset) = self.__read_str(buf, offset)
+            labels.append((name, color))
+
+        (nb_sizes, ) = self._NB_SIZES.unpack_from(buf, offset)
+        offset += self._NB_SIZES.size
+        page_sizes = []
+        for _ in xrange(0, nb_sizes):
+            page_sizes.append(self._SIZE.unpack_from(buf, offset))
+            offset += self._SIZE.size
+
+        return CatalogEntry(docid, doctype, nb_pages, last_mod, labels,
+                            page_sizes, content_mtime)
+
+    def load(self, generation):
+        """
+        Load the catalog from the disk.
+
+        Returns:
+            True if the catalog is usable. False if it is missing, corrupted,
+            or out of sync with the index.
+        """
+        self.entries = {}
+        try:
+            with open(self.path, 'rb') as file_desc:
+                if os.fstat(file_desc.fileno()).st_size <= 0:
+                    return False
+                buf = mmap.mmap(file_desc.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        except (IOError, OSError, mmap.error), exc:
+            logger.info("No usable document catalog (%s): %s"
+                        % (self.path, exc))
+            return False
+
+        try:
+            (magic, version, file_generation, nb_entries) = \
+                self._HEADER.unpack_from(buf, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                logger.warning("Document catalog %s: unknown format"
+                               % self.path)
+                return False
+            if file_generation != generation:
+                logger.warning("Document catalog %s is out of date"
+                               " (generation %d != %d)"
+                               % (self.path, file_generation, generation))
+                return False
+            entries = {}
+            for idx in xrange(0, nb_entries):
+                (offset, ) = self._OFFSET.unpack_from(
+                    buf, self._HEADER.size + (idx * self._OFFSET.size))
+                entry = self.__read_entry(buf, offset)
+                entries[entry.docid] = entry
+            self.entries = entries
+            logger.info("Document catalog loaded: %d documents"
+                        % len(entries))
+            return True
+        except (struct.error, UnicodeDecodeError), exc:
+            logger.warning("Document catalog %s is corrupted: %s"
+                           % (self.path, exc))
+            return False
+        finally:
+            buf.close()
+
+    def __pack_str(self, string):
+        string = string.encode("utf-8")
+        return self._STR_LEN.pack(len(string)) + string
+
+    def __pack_entry(self, entry):
+        out = [
+            self.__pack_str(entry.docid),
+            self.__pack_str(entry.doctype),
+            self._DOC_INFOS.pack(entry.nb_pages, entry.last_mod,
+                                 entry.content_mtime),
+            self._NB_LABELS.pack(len(entry.labels)),
+        ]
+        for (name, color) in entry.labels:
+            out.append(self.__pack_str(name))
+            out.append(self.__pack_str(color))
+        out.append(self._NB_SIZES.pack(len(entry.page_sizes)))
+        for (width, height) in entry.page_sizes:
+            out.append(self._SIZE.pack(int(width), int(height)))
+        return "".join(out)
+
+    def write(self, generation):
+        """
+        Rewrite the whole catalog file (see util.write_file_atomically())
+        """
+        entries = [self.__pack_entry(entry)
+                   for entry in self.entries.itervalues()]
+
+        offsets = []
+        offset = self._HEADER.size + (len(entries) * self._OFFSET.size)
+        for entry in entries:
+            offsets.append(self._OFFSET.pack(offset))
+            offset += len(entry)
+
+        header = self._HEADER.pack(self.MAGIC, self.VERSION, generation,
+                                   len(entries))
+        write_file_atomically(self.path,
+                              "".join([header] + offsets + entries))
+        logger.info("Document catalog written: %d documents (generation %d)"
+                    % (len(entries), generation))
+
+    def destroy(self):
+        self.entries = {}
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,228 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compact binary copy of the box files.
+
+Box files (hOCR) are the reference: they are what OCR tools and previous
+versions of Paperwork read and write. Parsing them is slow however, so
+each one gets a binary copy next to it the first time it is read. The
+copy is only used as long as the size and mtime of the box file it comes
+from don't change.
+
+File format (little endian):
+    header: magic, version, box file size, box file mtime,
+            number of lines, number of words, size of the string table
+    lines: (x1, y1, x2, y2, first word, number of words) (int32 each)
+    words: (x1, y1, x2, y2, offset, length) (int32 each), offset and length
+           locating the content of the word in the string table
+    string table: UTF-8
+"""
+
+import codecs
+import logging
+import mmap
+import os
+import struct
+
+import pyocr.builders
+
+from paperwork.backend.util import write_sidecar_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class BoxStore(object):
+    MAGIC = "PWBX"
+    VERSION = 1
+
+    _HEADER = struct.Struct("<4sIQdIII")
+    _LINE = struct.Struct("<iiiiii")
+    _WORD = struct.Struct("<iiiiii")
+
+    def __init__(self, buf):
+        """
+        Use BoxStore.load() instead
+        """
+        self.__buf = buf
+        (_, _, _, _, self.nb_lines, self.nb_words, _) = \
+            self._HEADER.unpack_from(buf, 0)
+        self.__lines_offset = self._HEADER.size
+        self.__words_offset = (self.__lines_offset +
+                               (self.nb_lines * self._LINE.size))
+        self.__strings_offset = (self.__words_offset +
+                                 (self.nb_words * self._WORD.size))
+
+    def __get_line(self, line_idx):
+        return self._LINE.unpack_from(
+            self.__buf, self.__lines_offset + (line_idx * self._LINE.size))
+
+    def __get_word(self, word_idx):
+        return self._WORD.unpack_from(
+            self.__buf, self.__words_offset + (word_idx * self._WORD.size))
+
+    def __get_str(self, offset, length):
+        start = self.__strings_offset + offset
+        return self.__buf[start:start + length].decode("utf-8")
+
+    def get_word_content(self, word_idx):
+        (_, _, _, _, offset, length) = self.__get_word(word_idx)
+        return self.__get_str(offset, length)
+
+    def get_line_texts(self):
+        """
+        Returns:
+            The text of each line (words separated by spaces). No box object
+            is instantiated.
+        """
+        lines = []
+        for line_idx in xrange(0, self.nb_lines):
+            (_, _, _, _, first_word, nb_words) = self.__get_line(line_idx)
+            lines.append(u" ".join([
+                self.get_word_content(word_idx)
+                for word_idx in xrange(first_word, first_word + nb_words)
+            ]))
+        return lines
+
+    def get_boxes(self):
+        """
+        Returns:
+            The line boxes, as pyocr would have returned them
+        """
+        boxes = []
+        for line_idx in xrange(0, self.nb_lines):
+            (x1, y1, x2, y2, first_word, nb_words) = self.__get_line(line_idx)
+            words = []
+            for word_idx in xrange(first_word, first_word + nb_words):
+                (wx1, wy1, wx2, wy2, offset, length) = \
+                    self.__get_word(word_idx)
+                words.append(pyocr.builders.Box(
+                    self.__get_str(offset, length), ((wx1, wy1), (wx2, wy2))
+                ))
+            boxes.append(pyocr.builders.LineBox(words, ((x1, y1), (x2, y2))))
+        return boxes
+
+    def close(self):
+        self.__buf.close()
+
+    @staticmethod
+    def load(path, src_stat):
+        """
+        Arguments:
+            src_stat --- os.stat() of the box file the store must match
+
+        Returns:
+            A BoxStore, or None if the file is missing or out of date
+        """
+        try:
+            with open(path, 'rb') as file_desc:
+                if os.fstat(file_desc.fileno()).st_size < \
+                        BoxStore._HEADER.size:
+                    return None
+                buf = mmap.mmap(file_desc.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        except (IOError, OSError, mmap.error):
+            return None
+        try:
+            (magic, version, src_size, src_mtime, _, _, _) = \
+                BoxStore._HEADER.unpack_from(buf, 0)
+        except struct.error:
+            buf.close()
+            return None
+        if (magic != BoxStore.MAGIC or version != BoxStore.VERSION or
+                src_size != src_stat.st_size or
+                src_mtime != src_stat.st_mtime):
+            buf.close()
+            return None
+        return BoxStore(buf)
+
+    @staticmethod
+    def write(path, boxes, src_stat):
+        """
+        Write a binary copy of the given line boxes (as returned by pyocr).
+        Old-style box files (word boxes only) are stored as one line per
+        word.
+        """
+        lines = []
+        words = []
+        strings = []
+        strings_len = 0
+        for line in boxes:
+            line_words = getattr(line, 'word_boxes', None)
+            if line_words is None:
+                line_words = [line]
+            first_word = len(words)
+            for word in line_words:
+                content = word.content.encode("utf-8")
+                ((wx1, wy1), (wx2, wy2)) = word.position
+                words.append(BoxStore._WORD.pack(
+                    int(wx1), int(wy1), int(wx2), int(wy2),
+                    strings_len, len(content)))
+                strings.append(content)
+                strings_len += len(content)
+            ((x1, y1), (x2, y2)) = line.position
+            lines.append(BoxStore._LINE.pack(int(x1), int(y1), int(x2),
+                                             int(y2), first_word,
+                                             len(line_words)))
+
+        header = BoxStore._HEADER.pack(
+            BoxStore.MAGIC, BoxStore.VERSION, src_stat.st_size,
+            src_stat.st_mtime, len(lines), len(words), strings_len)
+        write_sidecar_file(path, "".join([header] + lines + words + strings),
+                           "box store")
+
+
+def load_boxes(boxfile, storefile, with_objects=True):
+    """
+    Read the boxes of a page from the box store if it is up to date, or from
+    the box file otherwise (the box store is then updated).
+
+    Arguments:
+        with_objects --- if False, only the text lines are returned
+
+    Returns:
+        Line boxes (see pyocr), or text lines if with_objects is False.
+
+    Raises:
+        IOError/OSError if the box file can't be read
+    """
+    src_stat = os.stat(boxfile)
+    store = BoxStore.load(storefile, src_stat)
+    if store is not None:
+        try:
+            if with_objects:
+                return store.get_boxes()
+            return store.get_line_texts()
+        finally:
+            store.close()
+
+    logger.info("Converting box file %s" % boxfile)
+    box_builder = pyocr.builders.LineBoxBuilder()
+    with codecs.open(boxfile, 'r', encoding='utf-8') as file_desc:
+        boxes = box_builder.read_file(file_desc)
+    if boxes == []:
+        # fallback: old format: word boxes
+        # shouldn't be used anymore ...
+        logger.warning("WARNING: %s uses old box format" % boxfile)
+        box_builder = pyocr.builders.WordBoxBuilder()
+        with codecs.open(boxfile, 'r', encoding='utf-8') as file_desc:
+            boxes = box_builder.read_file(file_desc)
+    BoxStore.write(storefile, boxes, src_stat)
+    if with_objects:
+        return boxes
+    return [u" ".join([word.content
+                       for word in getattr(line, 'word_boxes', [line])])
+            for line in boxes]
@@ -0,0 +1,174 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Snapshot of the content of a document directory.
+
+Knowing the number of pages, the type, the last modification time or the
+fingerprint of a document all require looking at its directory. A snapshot
+lists it once, and stat()s each file at most once, only when its size or
+mtime is actually needed. It is shared by all of them until the cache of the
+document is dropped.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+# Page images and PDF files (see get_content_last_mod())
+_FINGERPRINT_NAME_ONLY_EXTS = [
+    ".jpg",
+    ".pdf",
+]
+# Files that may be modified in place by something else than Paperwork (the
+# user editing them, a synchronization tool, ...): their size and mtime are
+# part of the fingerprint. The other files (box files, extracted text, ...)
+# are only rewritten by Paperwork, which reindexes the document itself
+_FINGERPRINT_STAT_FILES = [
+    "labels",
+    "extra.txt",
+]
+# Files that have no impact on the index content
+_FINGERPRINT_IGNORED_EXTS = [
+    ".thumb.jpg",
+    ".boxes",
+    ".cache",
+    ".tmp",
+]
+
+
+def is_ignored_file(filename):
+    """
+    Returns:
+        True if the file has no impact on the index content (thumbnails,
+        caches, temporary files, etc)
+    """
+    lower = filename.lower()
+    return any(lower.endswith(ext) for ext in _FINGERPRINT_IGNORED_EXTS)
+
+
+class DocDirSnapshot(object):
+    """
+    A directory that can't be listed is considered as not existing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__stats = {}  # filename --> os.stat() result (None if gone)
+        try:
+            self.filenames = os.listdir(path)
+            self.exists = True
+        except OSError, exc:
+            if exc.errno not in (errno.ENOENT, errno.ENOTDIR):
+                logger.warning("Warning: Failed to list files in %s: %s"
+                               % (path, exc))
+            self.filenames = []
+            self.exists = False
+        self.filenames.sort()
+        self.__filename_set = set(self.filenames)
+
+    def __contains__(self, filename):
+        return filename in self.__filename_set
+
+    def stat(self, filename):
+        """
+        Returns:
+            os.stat() of the file, or None if it doesn't exist
+        """
+        with self.__lock:
+            if filename in self.__stats:
+                return self.__stats[filename]
+            stat = None
+            if filename in self.__filename_set:
+                try:
+                    stat = os.stat(os.path.join(self.path, filename))
+                except OSError:
+                    # file removed since the directory has been listed
+                    pass
+            self.__stats[filename] = stat
+            return stat
+
+    def get_mtime(self, filename, default=None):
+        stat = self.stat(filename)
+        if stat is None:
+            return default
+        return stat.st_mtime
+
+    def get_last_mod(self, filenames, default=0.0):
+        """
+        Returns:
+            The most recent mtime of the given files (files that don't exist
+            are ignored)
+        """
+        last_mod = default
+        for filename in filenames:
+            mtime = self.get_mtime(filename)
+            if mtime is not None and mtime > last_mod:
+                last_mod = mtime
+        return last_mod
+
+    def get_content_last_mod(self):
+        """
+        Returns:
+            The most recent mtime of the page images and PDF files (0.0 if
+            there is none)
+        """
+        filenames = []
+        for filename in self.filenames:
+            if is_ignored_file(filename):
+                continue
+            lower = filename.lower()
+            if any(lower.endswith(ext) for ext in _FINGERPRINT_NAME_ONLY_EXTS):
+                filenames.append(filename)
+        return self.get_last_mod(filenames)
+
+    def get_fingerprint(self):
+        """
+        Compute a cheap fingerprint of the document directory: the listing of
+        the directory, plus the size and mtime of the label file and the
+        extra text file. Whatever the number of pages, it costs at most 2
+        stat() calls.
+
+        Doesn't use the directory mtime itself: it changes each time a
+        thumbnail or a cache file is written.
+
+        Returns:
+            An unicode string, or None if the directory doesn't exist.
+        """
+        if not self.exists:
+            return None
+        fingerprint = hashlib.sha1()
+        for filename in self.filenames:
+            if is_ignored_file(filename):
+                continue
+            if isinstance(filename, unicode):
+                fingerprint.update(filename.encode("utf-8"))
+            else:
+                fingerprint.update(filename)
+            stat = None
+            if filename in _FINGERPRINT_STAT_FILES:
+                stat = self.stat(filename)
+            if stat is None:
+                fingerprint.update("\n")
+                continue
+            fingerprint.update(":%d:%f\n" % (stat.st_size, stat.st_mtime))
+        return unicode(fingerprint.hexdigest())
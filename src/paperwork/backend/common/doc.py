@@ -20,8 +20,11 @@ import gettext
 import logging
 import os.path
 import time
-import hashlib
 
+from paperwork.backend.common.dirsnapshot import DocDirSnapshot
+from paperwork.backend.common.hashcache import get_file_hash
+from paperwork.backend.common.textcache import DocTextCache
+from paperwork.backend.common.thumbnails import make_thumbnails_from_files
 from paperwork.backend.labels import Label
 from paperwork.backend.util import rm_rf
 
@@ -30,6 +33,13 @@ _ = gettext.gettext
 logger = logging.getLogger(__name__)
 
 
+def get_doc_fingerprint(docpath):
+    """
+    See DocDirSnapshot.get_fingerprint()
+    """
+    return DocDirSnapshot(docpath).get_fingerprint()
+
+
 class BasicDoc(object):
     LABEL_FILE = "labels"
     DOCNAME_FORMAT = "%Y%m%d_%H%M_%S"
@@ -38,10 +48,16 @@ class BasicDoc(object):
     pages = []
     can_edit = False
 
-    def __init__(self, docpath, docid=None):
+    def __init__(self, docpath, docid=None, cache=None):
         """
         Basic init of common parts of doc.
 
+        Arguments:
+            cache --- values already known about this document (see
+                catalog.CatalogEntry.get_doc_cache()). They are used instead
+                of reading the document directory, until drop_cache() is
+                called.
+
         Note regarding subclassing: *do not* load the document
         content in __init__(). It would reduce in a huge performance loose
         and thread-safety issues. Load the content on-the-fly when requested.
@@ -64,6 +80,8 @@ class BasicDoc(object):
             self.__docid = docid
             self.path = docpath
         self.__cache = {}
+        if cache is not None:
+            self.__cache.update(cache)
 
         # We need to keep track of the labels:
         # When updating bayesian filters for label guessing,
@@ -74,6 +92,17 @@ class BasicDoc(object):
     def drop_cache(self):
         self.__cache = {}
 
+    def get_snapshot(self):
+        """
+        Returns:
+            A snapshot of the document directory (see
+            dirsnapshot.DocDirSnapshot), taken the first time it is
+            requested after the last drop_cache()
+        """
+        if 'snapshot' not in self.__cache:
+            self.__cache['snapshot'] = DocDirSnapshot(self.path)
+        return self.__cache['snapshot']
+
     def __str__(self):
         return self.__docid
 
@@ -82,11 +111,28 @@ class BasicDoc(object):
 
     id = property(__get_id)
 
-    def __get_last_mod(self):
+    def _get_last_mod(self):
         raise NotImplementedError()
 
+    def __get_last_mod(self):
+        if 'last_mod' not in self.__cache:
+            self.__cache['last_mod'] = self._get_last_mod()
+        return self.__cache['last_mod']
+
     last_mod = property(__get_last_mod)
 
+    def _get_thumbnail_source_filename(self):
+        raise NotImplementedError()
+
+    def get_thumbnail_source_mtime(self):
+        """
+        Returns:
+            The mtime of the file the thumbnail of the document (the one of
+            its first page) is made from, or None if there is no such file
+        """
+        return self.get_snapshot().get_mtime(
+            self._get_thumbnail_source_filename())
+
     def __get_nb_pages(self):
         if 'nb_pages' not in self.__cache:
             self.__cache['nb_pages'] = self._get_nb_pages()
@@ -94,6 +140,28 @@ class BasicDoc(object):
 
     nb_pages = property(__get_nb_pages)
 
+    def make_thumbnails(self, name="grid"):
+        """
+        Make the missing or outdated thumbnails of the pages that have an
+        image file, all at once, so they are made in parallel (see
+        thumbnails.make_thumbnails_from_files()). The thumbnails of the other
+        pages are made when they are requested.
+
+        Arguments:
+            name --- thumbnail size used to check if the thumbnails of a
+                page are up-to-date (all the sizes are made at once anyway)
+        """
+        jobs = []
+        for page in self.pages:
+            src_path = page._get_thumbnail_source()
+            if src_path is None or page._has_thumbnail(name):
+                continue
+            jobs.append((src_path, page._get_thumb_targets()))
+        if len(jobs) > 0:
+            logger.info("%s: making the thumbnails of %d pages"
+                        % (self.docid, len(jobs)))
+            make_thumbnails_from_files(jobs)
+
     def print_page_cb(self, print_op, print_context, page_nb, keep_refs={}):
         """
         Arguments:
@@ -109,6 +177,12 @@ class BasicDoc(object):
     def get_docfilehash(self):
         raise NotImplementedError()
 
+    def get_fingerprint(self):
+        """
+        See DocDirSnapshot.get_fingerprint()
+        """
+        return self.get_snapshot().get_fingerprint()
+
     doctype = property(__get_doctype)
 
     def __get_keywords(self):
@@ -171,8 +245,8 @@ class BasicDoc(object):
                     for line in file_desc.readlines():
                         line = line.strip()
                         (label_name, label_color) = line.split(",", 1)
-                        labels.append(Label(name=label_name,
-                                            color=label_color))
+                        labels.append(Label.intern(label_name,
+                                                   label_color))
             except IOError:
                 pass
             self.__cache['labels'] = labels
@@ -188,31 +262,35 @@ class BasicDoc(object):
                 file_desc.write("%s,%s\n" % (label.name,
                                              label.get_color_str()))
         self.__cache['labels'] = labels
+        self.__cache.pop('snapshot', None)
+        self.__cache.pop('last_mod', None)
 
     labels = property(__get_labels, __set_labels)
 
+    def get_text_cache(self, build=True):
+        """
+        Arguments:
+            build --- if False and the text cache hasn't been loaded yet,
+                returns None instead of loading or rebuilding it
+
+        Returns:
+            The text of the document (see textcache.DocTextCache)
+        """
+        if 'text' not in self.__cache:
+            if not build:
+                return None
+            self.__cache['text'] = DocTextCache.get(self)
+        return self.__cache['text']
+
     def get_index_text(self):
-        txt = u""
-        for page in self.pages:
-            txt += u"\n".join([unicode(line) for line in page.text])
-        extra_txt = self.extra_text
-        if extra_txt != u"":
-            txt += u"\n" + extra_txt + u"\n"
-        txt = txt.strip()
+        txt = self.get_text_cache().get_text()
         if txt == u"":
             # make sure the text field is not empty. Whoosh doesn't like that
             txt = u"empty"
         return txt
 
     def _get_text(self):
-        txt = u""
-        for page in self.pages:
-            txt += u"\n".join([unicode(line) for line in page.text])
-        extra_txt = self.extra_text
-        if extra_txt != u"":
-            txt += u"\n" + extra_txt + u"\n"
-        txt = txt.strip()
-        return txt
+        return self.get_text_cache().get_text()
 
     text = property(_get_text)
 
@@ -297,7 +375,7 @@ class BasicDoc(object):
     def __is_new(self):
         if 'new' in self.__cache:
             return self.__cache['new']
-        self.__cache['new'] = not os.access(self.path, os.F_OK)
+        self.__cache['new'] = not self.get_snapshot().exists
         return self.__cache['new']
 
     is_new = property(__is_new)
@@ -369,11 +447,12 @@ class BasicDoc(object):
 
     def __get_extra_text(self):
         extra_txt_file = os.path.join(self.path, self.EXTRA_TEXT_FILE)
-        if not os.access(extra_txt_file, os.R_OK):
+        try:
+            with codecs.open(extra_txt_file, 'r',
+                             encoding='utf-8') as file_desc:
+                return file_desc.read()
+        except IOError:
             return u""
-        with codecs.open(extra_txt_file, 'r', encoding='utf-8') as file_desc:
-            text = file_desc.read()
-            return text
 
     def __set_extra_text(self, txt):
         extra_txt_file = os.path.join(self.path, self.EXTRA_TEXT_FILE)
@@ -385,13 +464,15 @@ class BasicDoc(object):
             with codecs.open(extra_txt_file, 'w',
                              encoding='utf-8') as file_desc:
                 file_desc.write(txt)
+        self.__cache.pop('text', None)
+        self.__cache.pop('snapshot', None)
+        self.__cache.pop('last_mod', None)
 
     extra_text = property(__get_extra_text, __set_extra_text)
 
     @staticmethod
     def hash_file(path):
-        dochash = hashlib.sha256(open(path, 'rb').read()).hexdigest()
-        return int(dochash, 16)
+        return get_file_hash(path)
 
     def clone(self):
         raise NotImplementedError()
@@ -0,0 +1,194 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Cache of the content hashes of the document files.
+
+The hash of a document is computed from the content of its files (PDF file,
+page images). Reading them all each time a document is reindexed is slow,
+so the hashes are kept in a file in the index directory, each one along
+with the inode, size and mtime of the file it comes from.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from paperwork.backend.util import write_sidecar_file
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024  # bytes
+
+
+def hash_file(path):
+    """
+    Hash the content of a file, without loading it entirely in memory.
+
+    Returns:
+        The SHA256 of the file content, as an integer
+    """
+    dochash = hashlib.sha256()
+    with open(path, 'rb') as file_desc:
+        while True:
+            chunk = file_desc.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            dochash.update(chunk)
+    return int(dochash.hexdigest(), 16)
+
+
+class FileHashCache(object):
+    """
+    Thread-safe. Changes are only written when write() is called.
+    """
+    VERSION = 1
+
+    def __init__(self, path, record_updates=False):
+        """
+        Arguments:
+            record_updates --- True in the worker processes: the hashes they
+                compute are kept until take_updates() sends them back to the
+                main process
+        """
+        self.path = path
+        self.record_updates = record_updates
+        self.__lock = threading.Lock()
+        self.__entries = {}  # file path --> [inode, size, mtime, hex hash]
+        self.__updates = {}  # entries computed since take_updates()
+        self.__dirty = False
+
+    def load(self):
+        """
+        Load the cache from the disk. A missing or corrupted file just
+        results in an empty cache.
+        """
+        entries = {}
+        try:
+            with open(self.path, 'rb') as file_desc:
+                content = json.load(file_desc)
+            if content['version'] == self.VERSION:
+                entries = content['files']
+        except (IOError, OSError, ValueError, KeyError, TypeError), exc:
+            logger.info("No usable file hash cache (%s): %s"
+                        % (self.path, exc))
+        with self.__lock:
+            self.__entries = entries
+            self.__updates = {}
+            self.__dirty = False
+
+    def get_hash(self, path):
+        """
+        Returns:
+            The content hash of the file (see hash_file()). The file is only
+            read if it has changed since its hash was computed.
+
+        Raises:
+            IOError/OSError if the file can't be read
+        """
+        if isinstance(path, str):
+            path = path.decode("utf-8", "replace")
+        stat = os.stat(path)
+        key = [stat.st_ino, stat.st_size, stat.st_mtime]
+        with self.__lock:
+            entry = self.__entries.get(path)
+        if entry is not None and entry[:3] == key:
+            return int(entry[3], 16)
+        filehash = hash_file(path)
+        entry = key + ["%X" % filehash]
+        with self.__lock:
+            self.__entries[path] = entry
+            if self.record_updates:
+                self.__updates[path] = entry
+            self.__dirty = True
+        return filehash
+
+    def take_updates(self):
+        """
+        Used by the indexing processes to send back to the main process the
+        hashes they had to compute (see merge()).
+
+        Returns:
+            The entries computed since the last call
+        """
+        with self.__lock:
+            updates = self.__updates
+            self.__updates = {}
+        return updates
+
+    def merge(self, updates):
+        if not updates:
+            return
+        with self.__lock:
+            self.__entries.update(updates)
+            self.__dirty = True
+
+    def write(self, is_wanted=None):
+        """
+        Write the cache if it has been modified (see
+        util.write_sidecar_file()).
+
+        Arguments:
+            is_wanted --- if set, is_wanted(path) is called for each file:
+                entries for which it returns False are dropped (files
+                removed, documents deleted, etc)
+        """
+        with self.__lock:
+            if is_wanted is not None:
+                unwanted = [path for path in self.__entries.iterkeys()
+                            if not is_wanted(path)]
+                for path in unwanted:
+                    self.__entries.pop(path)
+                if len(unwanted) > 0:
+                    logger.info("File hash cache: %d obsolete entries dropped"
+                                % len(unwanted))
+                    self.__dirty = True
+            if not self.__dirty:
+                return
+            content = {
+                'version': self.VERSION,
+                'files': self.__entries,
+            }
+            if write_sidecar_file(self.path, json.dumps(content),
+                                  "file hash cache"):
+                self.__dirty = False
+
+
+# cache used by get_file_hash(). Set by DocSearch.
+_file_hash_cache = None
+
+
+def set_file_hash_cache(cache):
+    global _file_hash_cache
+    _file_hash_cache = cache
+
+
+def get_file_hash_cache():
+    return _file_hash_cache
+
+
+def get_file_hash(path):
+    """
+    Returns:
+        The content hash of the file, from the file hash cache if one has
+        been set (see set_file_hash_cache())
+    """
+    cache = _file_hash_cache
+    if cache is None:
+        return hash_file(path)
+    return cache.get_hash(path)
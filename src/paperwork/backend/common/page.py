@@ -15,12 +15,23 @@
 #    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
 
 from copy import copy
+import logging
+import math
 import PIL.Image
 import os.path
 
+from paperwork.backend.common.thumbnails import THUMB_SIZES
+from paperwork.backend.common.thumbnails import fit_img
+from paperwork.backend.common.thumbnails import get_thumb_level
+from paperwork.backend.common.thumbnails import make_thumbnails
+from paperwork.backend.common.thumbnails import make_thumbnails_from_files
+from paperwork.backend.util import image2surface
 from paperwork.backend.util import split_words
 
 
+logger = logging.getLogger(__name__)
+
+
 class PageExporter(object):
     can_select_format = False
     can_change_quality = True
@@ -113,7 +124,7 @@ class BasicPage(object):
         self.doc = doc
         self.page_nb = page_nb
 
-        self.__thumbnail_cache = (None, 0)
+        self.__thumbnail_cache = {}  # thumbnail size name --> PIL image
         self.__text_cache = None
 
         assert(self.page_nb >= 0)
@@ -135,54 +146,146 @@ class BasicPage(object):
         filename = ("%s%d.%s" % (self.FILE_PREFIX, self.page_nb + 1, ext))
         return os.path.join(self.doc.path, filename)
 
-    def __make_thumbnail(self, width, height):
+    def _get_thumbnail_source(self):
         """
-        Create the page's thumbnail
+        Returns:
+            The path of an image file from which the thumbnails can be made,
+            or None if they must be made from self.img
         """
-        img = self.img
-        (w, h) = img.size
-        factor = max(
-            (float(w) / width),
-            (float(h) / height)
-        )
-        w /= factor
-        h /= factor
-        img = img.resize((int(w), int(h)), PIL.Image.ANTIALIAS)
-        return img
-
-    def _get_thumb_path(self):
-        return self._get_filepath(self.EXT_THUMB)
-
-    def get_thumbnail(self, width, height):
+        return None
+
+    def _get_thumb_path(self, name="grid"):
+        for (thumb_name, _, ext) in THUMB_SIZES:
+            if thumb_name == name:
+                return self._get_filepath(ext)
+        raise KeyError(name)
+
+    def _get_thumb_paths(self):
+        """
+        Returns:
+            The paths of all the thumbnails of the page
+        """
+        return [self._get_filepath(ext) for (_, _, ext) in THUMB_SIZES]
+
+    def _get_thumb_targets(self):
         """
-        thumbnail with a memory cache
+        Returns:
+            The thumbnails to make (see thumbnails.make_thumbnails())
         """
-        if ((width, height) == self.__thumbnail_cache[1]):
-            return self.__thumbnail_cache[0]
+        return [(self._get_filepath(ext), size)
+                for (_, size, ext) in THUMB_SIZES]
 
-        # get from the file
+    def _has_thumbnail(self, name="grid"):
+        """
+        Returns:
+            True if the thumbnail exists and is more recent than the page
+        """
         try:
-            if (os.path.getmtime(self.get_doc_file_path()) <
-                    os.path.getmtime(self._get_thumb_path())):
-                thumbnail = PIL.Image.open(self._get_thumb_path())
-            else:
-                thumbnail = self.__make_thumbnail(width, height)
-                thumbnail.save(self._get_thumb_path())
-        except:
-            thumbnail = self.__make_thumbnail(width, height)
-            thumbnail.save(self._get_thumb_path())
-
-        self.__thumbnail_cache = (thumbnail, (width, height))
+            return (os.path.getmtime(self.get_doc_file_path()) <
+                    os.path.getmtime(self._get_thumb_path(name)))
+        except OSError:
+            # no thumbnail yet
+            return False
+
+    def __make_thumbnails(self):
+        """
+        Create all the thumbnails of the page
+        """
+        src_path = self._get_thumbnail_source()
+        if src_path is not None:
+            make_thumbnails_from_files([(src_path, self._get_thumb_targets())])
+        else:
+            make_thumbnails(self.img, self._get_thumb_targets())
+
+    def get_thumbnail(self, width, height, whole_doc=True):
+        """
+        Arguments:
+            whole_doc --- if the thumbnails of the page must be made, make
+                the missing ones of the other pages of the document at the
+                same time (see BasicDoc.make_thumbnails())
+
+        Returns:
+            The smallest thumbnail of the page at least as big as the given
+            size (see thumbnails.THUMB_SIZES), or the biggest one. Callers
+            must resize it if they need an exact size.
+        """
+        name = get_thumb_level(width, height)
+        if name in self.__thumbnail_cache:
+            return self.__thumbnail_cache[name]
+
+        thumb_path = self._get_thumb_path(name)
+        try:
+            if not self._has_thumbnail(name):
+                if whole_doc and self._get_thumbnail_source() is not None:
+                    self.doc.make_thumbnails(name)
+                else:
+                    self.__make_thumbnails()
+            thumbnail = PIL.Image.open(thumb_path)
+            thumbnail.load()
+        except (IOError, OSError), exc:
+            logger.warning("Unable to get the thumbnails of %s: %s"
+                           % (str(self), exc))
+            size = dict([(thumb_name, thumb_size)
+                         for (thumb_name, thumb_size, _) in THUMB_SIZES])
+            thumbnail = fit_img(self.img, size[name])
+
+        self.__thumbnail_cache[name] = thumbnail
         return thumbnail
 
+    def get_image(self, width, height):
+        """
+        Returns:
+            A PIL image of the page, at least as big as the given size when
+            possible, but loaded as cheaply as possible. Callers must resize
+            it if they need an exact size.
+        """
+        return self.img
+
+    def get_tiles(self, size, rects):
+        """
+        Render areas of the page, as displayed at the given size.
+
+        The image is decoded only once for all the areas (see get_image()),
+        and then dropped. Subclasses may render each area directly.
+
+        Arguments:
+            size --- (width, height) of the whole page
+            rects --- list of areas: (x, y, width, height)
+
+        Returns:
+            One cairo image surface for each area
+        """
+        img = self.get_image(size[0], size[1])
+        ratio = (float(img.size[0]) / size[0], float(img.size[1]) / size[1])
+        tiles = []
+        for (x, y, width, height) in rects:
+            box = (
+                int(x * ratio[0]),
+                int(y * ratio[1]),
+                min(img.size[0], int(math.ceil((x + width) * ratio[0]))),
+                min(img.size[1], int(math.ceil((y + height) * ratio[1]))),
+            )
+            tile = img.crop(box)
+            if tile.size != (width, height):
+                tile = tile.resize((width, height), PIL.Image.ANTIALIAS)
+            tiles.append(image2surface(tile))
+        return tiles
+
     def drop_cache(self):
-        self.__thumbnail_cache = (None, 0)
+        self.__thumbnail_cache = {}
         self.__text_cache = None
 
     def __get_text(self):
         if self.__text_cache is not None:
             return self.__text_cache
-        self.__text_cache = self._get_text()
+        text_cache = self.doc.get_text_cache()
+        if self.page_nb < text_cache.nb_pages:
+            txt = text_cache.get_page_text(self.page_nb)
+            txt = txt.split(u"\n") if txt != u"" else []
+        else:
+            # page being added to the document
+            txt = self._get_text()
+        self.__text_cache = txt
         return self.__text_cache
 
     text = property(__get_text)
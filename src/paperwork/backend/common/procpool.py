@@ -0,0 +1,97 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Pool of worker processes shared by the backend (index rebuilding,
+thumbnails).
+
+multiprocessing forks its worker processes. Forking a process that already
+runs threads (Gtk, job schedulers, work directory watcher, timers, ...) is not
+safe: the child only gets a copy of the thread that forked it, and any lock
+held by another thread at that time (logging, GLib, Poppler, ...) remains
+locked forever in the child. So the pool must be started with start_pool()
+before the program starts any thread. If it hasn't been started, get_pool()
+returns None and the work is done in the calling process.
+"""
+
+import logging
+import multiprocessing
+import signal
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_size = 1
+_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    # Ctrl-C is handled by the main process: it stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def start_pool(processes=None):
+    """
+    Start the worker processes. Must be called before any other thread is
+    started.
+
+    Arguments:
+        processes --- number of worker processes (default: number of CPUs)
+    """
+    global _pool
+    global _pool_size
+    with _pool_lock:
+        if _pool is not None:
+            return
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        logger.info("Starting %d worker processes" % processes)
+        _pool = multiprocessing.Pool(processes, _init_worker)
+        _pool_size = processes
+
+
+def get_pool():
+    """
+    Returns:
+        The shared multiprocessing.Pool, or None if start_pool() hasn't been
+        called
+    """
+    return _pool
+
+
+def get_pool_size():
+    """
+    Returns:
+        The number of worker processes (1 if the pool hasn't been started)
+    """
+    return _pool_size
+
+
+def stop_pool():
+    """
+    Kill the worker processes. The tasks still queued are dropped.
+    """
+    global _pool
+    global _pool_size
+    with _pool_lock:
+        if _pool is None:
+            return
+        logger.info("Stopping the worker processes")
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+        _pool_size = 1
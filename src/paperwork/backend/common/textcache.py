@@ -0,0 +1,198 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per-document text cache.
+
+Getting the text of a document means parsing the box file of each of its
+pages (or asking Poppler), and reading its extra text. The result is stored
+in a sidecar file in the document directory, along with the size and mtime
+of the files it comes from. It is only rebuilt when one of them changes.
+"""
+
+import errno
+import json
+import logging
+import os
+
+from paperwork.backend.common.dirsnapshot import DocDirSnapshot
+from paperwork.backend.util import write_sidecar_file
+
+
+logger = logging.getLogger(__name__)
+
+# Files from which the text of a document is made: images (number of pages),
+# box files, text files (extracted text, extra text) and PDF files
+_TEXT_SOURCE_EXTS = [
+    ".jpg",
+    ".words",
+    ".txt",
+    ".pdf",
+]
+_TEXT_IGNORED_EXTS = [
+    ".thumb.jpg",
+]
+
+
+def get_text_sources(docpath, snapshot=None):
+    """
+    Arguments:
+        snapshot --- DocDirSnapshot of docpath, if already available: the
+            directory is not listed again, and the files already stat()ed
+            are not stat()ed again
+
+    Returns:
+        A sorted list of (filename, size, mtime) of the files the text of the
+        document depends on
+
+    Raises:
+        OSError if the directory doesn't exist
+    """
+    if snapshot is None:
+        snapshot = DocDirSnapshot(docpath)
+    if not snapshot.exists:
+        raise OSError(errno.ENOENT, "%s not found" % docpath)
+    sources = []
+    for filename in snapshot.filenames:
+        lower = filename.lower()
+        if not any(lower.endswith(ext) for ext in _TEXT_SOURCE_EXTS):
+            continue
+        if any(lower.endswith(ext) for ext in _TEXT_IGNORED_EXTS):
+            continue
+        stat = snapshot.stat(filename)
+        if stat is None:
+            # file removed while we are looking at the directory
+            continue
+        if isinstance(filename, str):
+            filename = filename.decode("utf-8", "replace")
+        sources.append([filename, stat.st_size, stat.st_mtime])
+    sources.sort()
+    return sources
+
+
+class DocTextCache(object):
+    """
+    Text of a document: the text of all its pages, one after the other,
+    followed by its extra text. Lines are stripped.
+    """
+    FILENAME = "text.cache"
+    VERSION = 1
+
+    def __init__(self, text, offsets):
+        """
+        Arguments:
+            text --- text of all the pages and the extra text, separated by
+                line returns
+            offsets --- offset of the start of each page in the text, plus
+                the offset of the start of the extra text
+        """
+        self.text = text
+        self.offsets = offsets
+
+    def __get_nb_pages(self):
+        return len(self.offsets) - 1
+
+    nb_pages = property(__get_nb_pages)
+
+    def get_page_text(self, page_nb):
+        """
+        Returns:
+            The text of the page (lines separated by line returns)
+        """
+        start = self.offsets[page_nb]
+        end = self.offsets[page_nb + 1]
+        return self.text[start:end].rstrip(u"\n")
+
+    def get_extra_text(self):
+        return self.text[self.offsets[-1]:]
+
+    def get_text(self):
+        """
+        Returns:
+            The whole text of the document, stripped
+        """
+        return self.text.strip()
+
+    @staticmethod
+    def from_doc(doc):
+        """
+        Extract the text of a document from its pages
+        """
+        chunks = []
+        offsets = []
+        offset = 0
+        for page in doc.pages:
+            offsets.append(offset)
+            lines = [unicode(line).strip() for line in page._get_text()]
+            chunk = u"\n".join(lines) + u"\n"
+            chunks.append(chunk)
+            offset += len(chunk)
+        offsets.append(offset)
+        chunks.append(doc.extra_text.strip())
+        return DocTextCache(u"".join(chunks), offsets)
+
+    @staticmethod
+    def load(docpath, sources):
+        """
+        Returns:
+            The text cache of the document, or None if it is missing or out
+            of date
+        """
+        path = os.path.join(docpath, DocTextCache.FILENAME)
+        try:
+            with open(path, 'rb') as file_desc:
+                content = json.load(file_desc)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            if (content['version'] != DocTextCache.VERSION or
+                    content['sources'] != sources):
+                return None
+            return DocTextCache(content['text'], content['offsets'])
+        except (KeyError, TypeError):
+            return None
+
+    def write(self, docpath, sources):
+        """
+        Store the text cache in the document directory
+        """
+        content = {
+            'version': self.VERSION,
+            'sources': sources,
+            'offsets': self.offsets,
+            'text': self.text,
+        }
+        write_sidecar_file(os.path.join(docpath, self.FILENAME),
+                           json.dumps(content), "text cache")
+
+    @staticmethod
+    def get(doc):
+        """
+        Load the text cache of the document. Rebuild it if it is out of date.
+        The document directory is looked at through the snapshot of the
+        document (see BasicDoc.get_snapshot()).
+        """
+        try:
+            sources = get_text_sources(doc.path, doc.get_snapshot())
+        except OSError:
+            # new document: nothing to cache yet
+            return DocTextCache.from_doc(doc)
+        text_cache = DocTextCache.load(doc.path, sources)
+        if text_cache is not None:
+            return text_cache
+        logger.info("Extracting the text of %s" % doc.docid)
+        text_cache = DocTextCache.from_doc(doc)
+        text_cache.write(doc.path, sources)
+        return text_cache
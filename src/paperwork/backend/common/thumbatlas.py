@@ -0,0 +1,154 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Thumbnail atlas: the thumbnails of all the documents, as displayed in the
+document list, in a single file.
+
+File format (little endian):
+    header: magic, version, number of entries
+    entries:
+        docid (length-prefixed UTF-8 string)
+        mtime of the file the thumbnail was made from (double, see
+            BasicDoc.get_thumbnail_source_mtime())
+        thumbnail (length-prefixed PNG image)
+"""
+
+import logging
+import StringIO
+import struct
+import threading
+
+import PIL.Image
+
+from paperwork.backend.util import write_sidecar_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailAtlas(object):
+    """
+    Thread-safe. The file is read entirely the first time a thumbnail is
+    requested, but each thumbnail is only decoded when requested. Changes
+    are only written when write() is called.
+    """
+    MAGIC = "PWTA"
+    VERSION = 2
+
+    _HEADER = struct.Struct("<4sII")
+    _STR_LEN = struct.Struct("<H")
+    _MTIME = struct.Struct("<d")
+    _DATA_LEN = struct.Struct("<I")
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__entries = None  # docid --> (source mtime, PNG data)
+        self.__dirty = False
+
+    def __load(self):
+        self.__entries = {}
+        try:
+            with open(self.path, 'rb') as file_desc:
+                buf = file_desc.read()
+        except IOError, exc:
+            logger.info("No thumbnail atlas (%s): %s" % (self.path, exc))
+            return
+        try:
+            (magic, version, nb_entries) = self._HEADER.unpack_from(buf, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                logger.warning("Thumbnail atlas %s: unknown format"
+                               % self.path)
+                return
+            offset = self._HEADER.size
+            entries = {}
+            for _ in xrange(0, nb_entries):
+                (length, ) = self._STR_LEN.unpack_from(buf, offset)
+                offset += self._STR_LEN.size
+                docid = buf[offset:offset + length].decode("utf-8")
+                offset += length
+                (mtime, ) = self._MTIME.unpack_from(buf, offset)
+                offset += self._MTIME.size
+                (length, ) = self._DATA_LEN.unpack_from(buf, offset)
+                offset += self._DATA_LEN.size
+                entries[docid] = (mtime, buf[offset:offset + length])
+                offset += length
+            self.__entries = entries
+            logger.info("Thumbnail atlas loaded: %d thumbnails"
+                        % len(entries))
+        except (struct.error, UnicodeDecodeError), exc:
+            logger.warning("Thumbnail atlas %s is corrupted: %s"
+                           % (self.path, exc))
+
+    def get(self, docid, mtime):
+        """
+        Arguments:
+            mtime --- current mtime of the file the thumbnail is made from
+
+        Returns:
+            The thumbnail of the document (PIL image), or None if the atlas
+            has no thumbnail for this version of the file
+        """
+        with self.__lock:
+            if self.__entries is None:
+                self.__load()
+            entry = self.__entries.get(unicode(docid))
+        if entry is None or entry[0] != mtime:
+            return None
+        try:
+            img = PIL.Image.open(StringIO.StringIO(entry[1]))
+            img.load()
+            return img
+        except IOError, exc:
+            logger.warning("Invalid thumbnail for %s in the atlas: %s"
+                           % (docid, exc))
+            return None
+
+    def put(self, docid, mtime, img):
+        output = StringIO.StringIO()
+        img.save(output, "PNG")
+        with self.__lock:
+            if self.__entries is None:
+                self.__load()
+            self.__entries[unicode(docid)] = (mtime, output.getvalue())
+            self.__dirty = True
+
+    def remove(self, docid):
+        with self.__lock:
+            if self.__entries is None:
+                self.__load()
+            if self.__entries.pop(unicode(docid), None) is not None:
+                self.__dirty = True
+
+    def write(self):
+        """
+        Write the atlas if it has been modified
+        """
+        with self.__lock:
+            if not self.__dirty:
+                return
+            out = [self._HEADER.pack(self.MAGIC, self.VERSION,
+                                     len(self.__entries))]
+            for (docid, (mtime, data)) in self.__entries.iteritems():
+                docid = docid.encode("utf-8")
+                out.append(self._STR_LEN.pack(len(docid)))
+                out.append(docid)
+                out.append(self._MTIME.pack(mtime))
+                out.append(self._DATA_LEN.pack(len(data)))
+                out.append(data)
+            if write_sidecar_file(self.path, "".join(out),
+                                  "thumbnail atlas"):
+                self.__dirty = False
@@ -0,0 +1,141 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Page thumbnails.
+
+Each page gets a small pyramid of thumbnails (one per size the GUI
+displays), all generated at once. The thumbnails of the page images of a
+document are generated in parallel by the worker processes (see procpool),
+and the JPEG files are decoded directly at a reduced scale (draft mode): the
+full-size scans are never fully decoded.
+"""
+
+import logging
+import os
+
+import PIL.Image
+
+from paperwork.backend.common import procpool
+
+
+logger = logging.getLogger(__name__)
+
+
+# (name, (maximum width, maximum height), file extension), from the smallest
+# to the biggest
+THUMB_SIZES = [
+    ("doclist", (64, 80), "doclist.thumb.jpg"),
+    ("grid", (150, 212), "thumb.jpg"),
+    ("preview", (300, 424), "preview.thumb.jpg"),
+]
+THUMB_QUALITY = 85
+
+
+def get_thumb_level(width, height):
+    """
+    Returns:
+        The name of the smallest thumbnail at least as big as the given size
+        (or the biggest one)
+    """
+    for (name, (max_width, max_height), _) in THUMB_SIZES:
+        if width <= max_width and height <= max_height:
+            return name
+    return THUMB_SIZES[-1][0]
+
+
+def fit_img(img, size):
+    """
+    Resize the image so it fits in 'size', keeping its proportions
+    """
+    (width, height) = img.size
+    factor = max(
+        (float(width) / size[0]),
+        (float(height) / size[1])
+    )
+    width /= factor
+    height /= factor
+    return img.resize((int(width), int(height)), PIL.Image.ANTIALIAS)
+
+
+def make_thumbnails(img, targets):
+    """
+    Arguments:
+        img --- PIL image
+        targets --- list of (thumbnail path, (max width, max height))
+
+    Returns:
+        The thumbnails (path --> PIL image)
+    """
+    thumbnails = {}
+    # each thumbnail is made from the previous (bigger) one
+    for (path, size) in sorted(targets, key=lambda target: target[1],
+                               reverse=True):
+        img = fit_img(img, size)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        tmp_path = path + ".tmp"
+        img.save(tmp_path, "JPEG", quality=THUMB_QUALITY)
+        os.rename(tmp_path, path)
+        thumbnails[path] = img
+    return thumbnails
+
+
+def _make_thumbnails_from_file(args):
+    """
+    Run by the worker processes (see make_thumbnails_from_files())
+    """
+    (src_path, targets) = args
+    img = PIL.Image.open(src_path)
+    if img.format == "JPEG":
+        # let the JPEG decoder do most of the downscaling: it only decodes
+        # what is required to get an image at least as big as the biggest
+        # thumbnail
+        biggest = max([size for (_, size) in targets])
+        img.draft("RGB", biggest)
+    make_thumbnails(img, targets)
+
+
+def make_thumbnails_from_files(jobs):
+    """
+    Make the thumbnails of image files. They are made in parallel by the
+    worker processes if they have been started (see procpool), in the
+    calling process otherwise. Blocks until they are all written.
+
+    Failures are logged: callers must check that the thumbnails they need
+    are there.
+
+    Arguments:
+        jobs --- list of (image path, targets) (see make_thumbnails())
+    """
+    pool = procpool.get_pool()
+    if pool is None or len(jobs) <= 1:
+        for job in jobs:
+            try:
+                _make_thumbnails_from_file(job)
+            except (IOError, OSError), exc:
+                logger.warning("Unable to make the thumbnails of %s: %s"
+                               % (job[0], exc))
+        return
+    results = [
+        (job[0], pool.apply_async(_make_thumbnails_from_file, (job, )))
+        for job in jobs
+    ]
+    for (src_path, result) in results:
+        try:
+            result.get()
+        except (IOError, OSError), exc:
+            logger.warning("Unable to make the thumbnails of %s: %s"
+                           % (src_path, exc))
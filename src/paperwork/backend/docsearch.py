@@ -22,27 +22,45 @@ suggestions)
 import logging
 import copy
 import datetime
+import itertools
+import multiprocessing.pool
 import os.path
+import threading
+import time
 
 from gi.repository import GObject
 
+import Levenshtein
 import whoosh.fields
 import whoosh.index
 import whoosh.qparser
 import whoosh.query
 import whoosh.sorting
-
+import whoosh.util.times
+
+from paperwork.backend.catalog import CatalogEntry
+from paperwork.backend.catalog import DocCatalog
+from paperwork.backend.common.dirsnapshot import DocDirSnapshot
+from paperwork.backend.common.doc import get_doc_fingerprint
+from paperwork.backend.common.hashcache import FileHashCache
+from paperwork.backend.common.hashcache import get_file_hash_cache
+from paperwork.backend.common.hashcache import set_file_hash_cache
+from paperwork.backend.common import procpool
+from paperwork.backend.common.thumbatlas import ThumbnailAtlas
 from paperwork.backend.common.page import BasicPage
 from paperwork.backend.img.doc import ImgDoc
 from paperwork.backend.img.doc import is_img_doc
 from paperwork.backend.labels import LabelGuesser
+from paperwork.backend.labels import LabelGuessUpdater
 from paperwork.backend.pdf.doc import PdfDoc
 from paperwork.backend.pdf.doc import is_pdf_doc
 from paperwork.backend.util import dummy_progress_cb
+from paperwork.backend.util import LRUCache
 from paperwork.backend.util import MIN_KEYWORD_LEN
 from paperwork.backend.util import mkdir_p
 from paperwork.backend.util import rm_rf
 from paperwork.backend.util import strip_accents
+from paperwork.backend.watcher import WorkdirWatcher
 
 
 logger = logging.getLogger(__name__)
@@ -63,6 +81,7 @@ class DummyDocSearch(object):
     """
     docs = []
     label_list = []
+    thumbnail_atlas = None
 
     def __init__(self):
         pass
@@ -77,6 +96,16 @@ class DummyDocSearch(object):
         """ Do nothing """
         assert()
 
+    @staticmethod
+    def get_index_rebuilder(*args, **kwargs):
+        """ Do nothing """
+        assert()
+
+    @staticmethod
+    def get_watcher(*args, **kwargs):
+        """ Do nothing """
+        assert()
+
     @staticmethod
     def find_suggestions(*args, **kwargs):
         """ Do nothing """
@@ -87,6 +116,21 @@ class DummyDocSearch(object):
         """ Do nothing """
         return []
 
+    @staticmethod
+    def find_docids(*args, **kwargs):
+        """ Do nothing """
+        return DocSearchResults(None, [])
+
+    @staticmethod
+    def get_docs_from_docids(*args, **kwargs):
+        """ Do nothing """
+        return []
+
+    @staticmethod
+    def get_facets(*args, **kwargs):
+        """ Do nothing """
+        return {'labels': {}, 'dates': {}}
+
     @staticmethod
     def create_label(*args, **kwargs):
         """ Do nothing """
@@ -117,6 +161,11 @@ class DummyDocSearch(object):
         """ Do nothing """
         assert()
 
+    @staticmethod
+    def flush_index_updates():
+        """ Do nothing """
+        pass
+
     @staticmethod
     def is_hash_in_index(*args, **kwargs):
         """ Do nothing """
@@ -143,6 +192,8 @@ class DocDirExaminer(GObject.GObject):
     Examine a directory containing documents. It looks for new documents,
     modified documents, or deleted documents.
     """
+    FINGERPRINT_THREADS = 8
+
     def __init__(self, docsearch):
         GObject.GObject.__init__(self)
         self.docsearch = docsearch
@@ -150,38 +201,105 @@ class DocDirExaminer(GObject.GObject):
         # searcher
         self.__searcher = docsearch.index.searcher()
 
+    def __get_fingerprints(self, docdirs, progress_cb):
+        """
+        Compute the fingerprints of all the given document directories, using
+        a pool of threads (this is mostly waiting on the filesystem)
+
+        Returns:
+            docdir --> fingerprint
+        """
+        rootdir = self.docsearch.rootdir
+        fingerprints = {}
+        pool = multiprocessing.pool.ThreadPool(self.FINGERPRINT_THREADS)
+        try:
+            results = pool.imap_unordered(
+                lambda docdir: (
+                    docdir, get_doc_fingerprint(os.path.join(rootdir, docdir))
+                ),
+                docdirs
+            )
+            for (progress, (docdir, fingerprint)) in enumerate(results):
+                fingerprints[docdir] = fingerprint
+                progress_cb(progress, 2 * len(docdirs),
+                            DocSearch.INDEX_STEP_CHECKING)
+        finally:
+            pool.terminate()
+        return fingerprints
+
     def examine_rootdir(self,
                         on_new_doc,
                         on_doc_modified,
                         on_doc_deleted,
                         on_doc_unchanged,
-                        progress_cb=dummy_progress_cb):
+                        progress_cb=dummy_progress_cb,
+                        full_scan=False):
         """
         Examine the rootdir.
         Calls on_new_doc(doc), on_doc_modified(doc), on_doc_deleted(docid)
         every time a new, modified, or deleted document is found
+
+        Arguments:
+            full_scan --- if False, documents are only instantiated and
+                examined if their fingerprint (see get_doc_fingerprint())
+                doesn't match the one stored in the index. If True, the last
+                modification time of all the documents is checked.
         """
         # getting the doc list from the index
-        query = whoosh.query.Every()
-        results = self.__searcher.search(query, limit=None)
-        old_doc_list = [result['docid'] for result in results]
         old_doc_infos = {}
-        for result in results:
-            old_doc_infos[result['docid']] = (result['doctype'],
-                                              result['last_read'])
-        old_doc_list = set(old_doc_list)
+        for (_, fields) in self.__searcher.reader().iter_docs():
+            old_doc_infos[fields['docid']] = (fields['doctype'],
+                                              fields['last_read'],
+                                              fields.get('fingerprint'))
+        old_doc_list = set(old_doc_infos.keys())
 
         # and compare it to the current directory content
         docdirs = os.listdir(self.docsearch.rootdir)
-        progress = 0
+        if full_scan:
+            fingerprints = {}
+            progress = 0
+            total = len(docdirs)
+        else:
+            fingerprints = self.__get_fingerprints(docdirs, progress_cb)
+            progress = len(docdirs)
+            total = 2 * len(docdirs)
+
         for docdir in docdirs:
             old_infos = old_doc_infos.get(docdir)
             doctype = None
             if old_infos is not None:
                 doctype = old_infos[0]
+
+            if (old_infos is not None and old_infos[2] is not None
+                    and not full_scan):
+                unchanged = (fingerprints.get(docdir) == old_infos[2])
+                doc = None
+                if unchanged:
+                    # the document loaded with the index or the catalog is
+                    # still up-to-date: no need to look at its directory
+                    doc = self.docsearch.get_doc_from_docid(docdir)
+                if doc is None:
+                    doc = self.docsearch.get_doc_from_docid(docdir, doctype,
+                                                            inst=True)
+                if doc is None:
+                    continue
+                old_doc_list.remove(docdir)
+                if unchanged:
+                    on_doc_unchanged(doc)
+                else:
+                    doc.drop_cache()
+                    on_doc_modified(doc)
+                progress_cb(progress, total,
+                            DocSearch.INDEX_STEP_CHECKING, doc)
+                progress += 1
+                continue
+
             doc = self.docsearch.get_doc_from_docid(docdir, doctype, inst=True)
             if doc is None:
                 continue
+            # the document may have been instantiated from the catalog:
+            # make sure we look at its current content
+            doc.drop_cache()
             if docdir in old_doc_list:
                 old_doc_list.remove(docdir)
                 assert(old_infos is not None)
@@ -192,7 +310,7 @@ class DocDirExaminer(GObject.GObject):
                     on_doc_unchanged(doc)
             else:
                 on_new_doc(doc)
-            progress_cb(progress, len(docdirs),
+            progress_cb(progress, total,
                         DocSearch.INDEX_STEP_CHECKING, doc)
             progress += 1
 
@@ -204,22 +322,118 @@ class DocDirExaminer(GObject.GObject):
 
         progress_cb(1, 1, DocSearch.INDEX_STEP_CHECKING)
 
+    def examine_docids(self,
+                       docids,
+                       on_new_doc,
+                       on_doc_modified,
+                       on_doc_deleted,
+                       on_doc_unchanged):
+        """
+        Examine only some document directories (see WorkdirWatcher). Same
+        callbacks as examine_rootdir().
+        """
+        for docid in docids:
+            docid = unicode(docid)
+            docpath = os.path.join(self.docsearch.rootdir, docid)
+            fields = self.__searcher.document(docid=docid)
+
+            if not os.path.isdir(docpath):
+                if fields is not None:
+                    # Will be a document with 0 pages
+                    on_doc_deleted(ImgDoc(docpath, docid))
+                continue
+
+            doctype = fields['doctype'] if fields is not None else None
+            doc = self.docsearch.get_doc_from_docid(docid, doctype, inst=True)
+            if doc is None:
+                continue
+            if fields is None:
+                on_new_doc(doc)
+            elif (fields.get('fingerprint') is not None and
+                    fields['fingerprint'] == get_doc_fingerprint(docpath)):
+                on_doc_unchanged(doc)
+            else:
+                doc.drop_cache()
+                on_doc_modified(doc)
+
+
+def get_doc_index_infos(doc, catalog_entry=None):
+    """
+    Extract from a document everything the index needs to know about it.
+    Doesn't touch the index, so it can be run in another process (see
+    DocIndexRebuilder).
+
+    Arguments:
+        catalog_entry --- current catalog entry of the document, if any (see
+            CatalogEntry.from_doc())
+
+    Returns:
+        A dict:
+            'fields': Whoosh fields of the document
+            'catalog': catalog entry of the document
+            'label_guessing_txt': text used to train the label guesser
+    """
+    # computed first: if the document is modified while we are indexing
+    # it, it will be seen as modified on the next examination
+    fingerprint = doc.get_fingerprint()
+    doc_last_mod = doc.last_mod
+    last_mod = datetime.datetime.fromtimestamp(doc_last_mod)
+
+    dochash = doc.get_docfilehash()
+    dochash = (u"%X" % dochash)
+
+    doc_txt = doc.get_index_text()
+    assert(isinstance(doc_txt, unicode))
+    labels_txt = doc.get_index_labels()
+    assert(isinstance(labels_txt, unicode))
+
+    return {
+        'fields': {
+            'docid': unicode(doc.docid),
+            'doctype': doc.doctype,
+            'docfilehash': dochash,
+            'content': strip_accents(doc_txt),
+            'label': strip_accents(labels_txt),
+            'date': doc.date,
+            'last_read': last_mod,
+            'fingerprint': fingerprint,
+        },
+        'catalog': CatalogEntry.from_doc(doc, doc_last_mod,
+                                         previous=catalog_entry),
+        'label_guessing_txt': LabelGuessUpdater.get_doc_txt(doc),
+    }
+
 
 class DocIndexUpdater(GObject.GObject):
     """
     Update the index content.
     Don't forget to call commit() to apply the changes
     """
+    # how long we wait for another writer to release the index lock
+    WRITER_LOCK_TIMEOUT = 30.0  # seconds
+
     def __init__(self, docsearch, optimize, progress_cb=dummy_progress_cb):
         self.docsearch = docsearch
         self.optimize = optimize
-        self.index_writer = docsearch.index.writer()
+        self.index_writer = self._make_index_writer()
         self.label_guesser_updater = docsearch.label_guesser.get_updater()
         self.progress_cb = progress_cb
+        # docid --> catalog entry (None if the document has been deleted)
+        self.catalog_updates = {}
 
-    def _update_doc_in_index(self, index_writer, doc):
+    def _make_index_writer(self):
+        return self.docsearch.index.writer(timeout=self.WRITER_LOCK_TIMEOUT)
+
+    def _update_doc_in_index(self, index_writer, doc, infos=None):
         """
         Add/Update a document in the index
+
+        Arguments:
+            infos --- result of get_doc_index_infos() for this document, if
+                already computed
+
+        Returns:
+            The text to use to train the label guesser
         """
         all_labels = set(self.docsearch.label_list)
         doc_labels = set(doc.labels)
@@ -229,46 +443,34 @@ class DocIndexUpdater(GObject.GObject):
         for label in new_labels:
             self.docsearch.create_label(label)
 
-        last_mod = datetime.datetime.fromtimestamp(doc.last_mod)
-        docid = unicode(doc.docid)
-
-        dochash = doc.get_docfilehash()
-        dochash = (u"%X" % dochash)
-
-        doc_txt = doc.get_index_text()
-        assert(isinstance(doc_txt, unicode))
-        labels_txt = doc.get_index_labels()
-        assert(isinstance(labels_txt, unicode))
-
-        query = whoosh.query.Term("docid", docid)
-        index_writer.delete_by_query(query)
+        if infos is None:
+            infos = get_doc_index_infos(
+                doc, self.docsearch.catalog.entries.get(unicode(doc.docid)))
 
-        index_writer.update_document(
-            docid=docid,
-            doctype=doc.doctype,
-            docfilehash=dochash,
-            content=strip_accents(doc.get_index_text()),
-            label=strip_accents(doc.get_index_labels()),
-            date=doc.date,
-            last_read=last_mod
-        )
-        return True
+        # docid is a unique field: update_document() takes care of removing
+        # the previous version of the document
+        index_writer.update_document(**infos['fields'])
+        self.catalog_updates[infos['fields']['docid']] = infos['catalog']
+        return infos['label_guessing_txt']
 
-    @staticmethod
-    def _delete_doc_from_index(index_writer, docid):
+    def _delete_doc_from_index(self, index_writer, docid):
         """
         Remove a document from the index
         """
         query = whoosh.query.Term("docid", docid)
         index_writer.delete_by_query(query)
+        self.catalog_updates[unicode(docid)] = None
 
-    def add_doc(self, doc):
+    def add_doc(self, doc, infos=None):
         """
         Add a document to the index
+
+        Arguments:
+            infos --- see _update_doc_in_index()
         """
         logger.info("Indexing new doc: %s" % doc)
-        self._update_doc_in_index(self.index_writer, doc)
-        self.label_guesser_updater.add_doc(doc)
+        doc_txt = self._update_doc_in_index(self.index_writer, doc, infos)
+        self.label_guesser_updater.add_doc(doc, doc_txt)
         if doc.docid not in self.docsearch._docs_by_id:
             self.docsearch._docs_by_id[doc.docid] = doc
 
@@ -277,8 +479,8 @@ class DocIndexUpdater(GObject.GObject):
         Update a document in the index
         """
         logger.info("Updating modified doc: %s" % doc)
-        self._update_doc_in_index(self.index_writer, doc)
-        self.label_guesser_updater.upd_doc(doc)
+        doc_txt = self._update_doc_in_index(self.index_writer, doc)
+        self.label_guesser_updater.upd_doc(doc, doc_txt)
 
     def del_doc(self, doc):
         """
@@ -303,6 +505,8 @@ class DocIndexUpdater(GObject.GObject):
         self.index_writer.commit()
         del self.index_writer
         self.label_guesser_updater.commit()
+        self.docsearch.update_catalog(self.catalog_updates)
+        self.catalog_updates = {}
 
         self.docsearch.reload_searcher()
 
@@ -314,6 +518,433 @@ class DocIndexUpdater(GObject.GObject):
         self.index_writer.cancel()
         del self.index_writer
         self.label_guesser_updater.cancel()
+        self.catalog_updates = {}
+
+
+def _get_worker_file_hash_cache(path):
+    """
+    Returns:
+        The file hash cache of the current process. Worker processes are
+        started before DocSearch: they load their own copy.
+    """
+    cache = get_file_hash_cache()
+    if cache is None or cache.path != path:
+        cache = FileHashCache(path, record_updates=True)
+        cache.load()
+        set_file_hash_cache(cache)
+    return cache
+
+
+def _get_doc_index_infos_from_path(args):
+    """
+    Run by the worker processes for DocIndexRebuilder
+
+    Returns:
+        (docid, get_doc_index_infos(doc)), or (docid, None) if it failed
+    """
+    (docpath, docid, doctype, file_hash_cache_path) = args
+    try:
+        file_hash_cache = _get_worker_file_hash_cache(file_hash_cache_path)
+        for (is_doc_type, doc_type_name, doc_type) in DOC_TYPE_LIST:
+            if doc_type_name == doctype:
+                infos = get_doc_index_infos(doc_type(docpath, docid))
+                # the file hash cache of this process is a copy: the main
+                # process must learn about the hashes computed here
+                infos['file_hashes'] = file_hash_cache.take_updates()
+                return (docid, infos)
+        logger.warning("Unknown doc type for doc '%s': %s" % (docid, doctype))
+    except Exception, exc:
+        logger.exception("Failed to read doc '%s': %s" % (docid, exc))
+    return (docid, None)
+
+
+class DocIndexRebuilder(DocIndexUpdater):
+    """
+    Index updater made to index a lot of new documents at once (when
+    rebuilding the index from scratch).
+
+    The text of the documents is extracted and normalized by the worker
+    processes (see backend.common.procpool), and the label guesser is trained
+    once with all the documents.
+    """
+
+    def add_docs(self, docs):
+        """
+        Add many new documents to the index. progress_cb(progression,
+        total, step, doc) is called each time a document has been added.
+        If it raises StopIteration, the documents already added remain in the
+        index writer, and the others are ignored.
+        """
+        docs = {doc.docid: doc for doc in docs}
+        total = len(docs)
+        logger.info("Indexing %d new documents with %d processes"
+                    % (total, procpool.get_pool_size()))
+        args = [
+            (doc.path, doc.docid, doc.doctype,
+             self.docsearch.file_hash_cache.path)
+            for doc in docs.values()
+        ]
+        pool = procpool.get_pool()
+        if pool is None:
+            results = itertools.imap(_get_doc_index_infos_from_path, args)
+        else:
+            results = pool.imap_unordered(_get_doc_index_infos_from_path,
+                                          args, chunksize=4)
+
+        label_guessing_docs = []
+        try:
+            for (progress, (docid, infos)) in enumerate(results):
+                doc = docs[docid]
+                if infos is not None:
+                    self.docsearch.file_hash_cache.merge(
+                        infos['file_hashes'])
+                # if infos is None, _update_doc_in_index() will try again in
+                # this process and report the error
+                logger.info("Indexing new doc: %s" % doc)
+                doc_txt = self._update_doc_in_index(self.index_writer, doc,
+                                                    infos)
+                label_guessing_docs.append((doc, doc_txt))
+                if doc.docid not in self.docsearch._docs_by_id:
+                    self.docsearch._docs_by_id[doc.docid] = doc
+                self.progress_cb(progress, total,
+                                 DocSearch.INDEX_STEP_READING, doc)
+        finally:
+            # also when interrupted: the documents already added remain in
+            # the index writer
+            self.label_guesser_updater.add_docs(label_guessing_docs)
+
+
+class BatchIndexUpdater(object):
+    """
+    Write-behind index updater.
+
+    Updates are buffered and coalesced per document: updating 200 times the
+    same document, or 200 documents in a row, results in a single index
+    commit. The buffer is flushed when it reaches 'max_docs' documents, when
+    flush() is called, or 'max_delay' seconds after the first buffered
+    update.
+
+    When the delay expires or the buffer is full, flush_cb(batch) is called
+    if it is set (from a timer thread, or from the thread that queued the
+    last update). Otherwise, the batch is flushed from this thread. The
+    frontend uses flush_cb to run the update in its own index thread (see
+    take()).
+
+    Until the buffer is flushed, the index doesn't reflect the buffered
+    changes.
+    """
+    DEFAULT_MAX_DOCS = 100
+    DEFAULT_MAX_DELAY = 2.0  # seconds
+
+    def __init__(self, docsearch, max_docs=DEFAULT_MAX_DOCS,
+                 max_delay=DEFAULT_MAX_DELAY, flush_cb=None):
+        self.docsearch = docsearch
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self.flush_cb = flush_cb
+
+        self.__lock = threading.RLock()
+        # serializes the flushes, so the batches are committed in order.
+        # Not held while queuing updates
+        self.__flush_lock = threading.Lock()
+        self.__new_docs = {}  # docid --> doc
+        self.__upd_docs = {}  # docid --> doc
+        self.__del_docs = {}  # docid --> doc
+        self.__timer = None
+
+    def __len__(self):
+        with self.__lock:
+            return (len(self.__new_docs) + len(self.__upd_docs) +
+                    len(self.__del_docs))
+
+    def __queued(self):
+        """
+        Must be called with the lock held
+
+        Returns:
+            True if the buffer is full and must be flushed now (see
+            __flush_now()). Must be done once the lock is released.
+        """
+        if len(self) >= self.max_docs:
+            return True
+        if self.__timer is None:
+            self.__timer = threading.Timer(self.max_delay, self.__on_timeout)
+            self.__timer.daemon = True
+            self.__timer.start()
+        return False
+
+    def __flush_now(self):
+        if self.flush_cb is not None:
+            self.flush_cb(self)
+        else:
+            self.flush()
+
+    def __on_timeout(self):
+        with self.__lock:
+            self.__timer = None
+        try:
+            self.__flush_now()
+        except Exception, exc:
+            # nobody to report it to in the timer thread. The changes have
+            # been put back in the buffer (see flush())
+            logger.exception("Index: failed to flush the buffered changes:"
+                             " %s" % exc)
+
+    def add_doc(self, doc):
+        with self.__lock:
+            self.__del_docs.pop(doc.docid, None)
+            self.__new_docs[doc.docid] = doc
+            full = self.__queued()
+        if full:
+            self.__flush_now()
+
+    def upd_doc(self, doc):
+        with self.__lock:
+            if doc.docid in self.__new_docs:
+                self.__new_docs[doc.docid] = doc
+            else:
+                self.__upd_docs[doc.docid] = doc
+            full = self.__queued()
+        if full:
+            self.__flush_now()
+
+    def del_doc(self, doc):
+        with self.__lock:
+            self.__upd_docs.pop(doc.docid, None)
+            if self.__new_docs.pop(doc.docid, None) is None:
+                self.__del_docs[doc.docid] = doc
+            full = self.__queued()
+        if full:
+            self.__flush_now()
+
+    def take(self):
+        """
+        Empty the buffer without applying it.
+
+        Returns:
+            A tuple of sets: (new docs, updated docs, deleted docs). To give
+            to a DocIndexUpdater.
+        """
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+            changes = (set(self.__new_docs.values()),
+                       set(self.__upd_docs.values()),
+                       set(self.__del_docs.values()))
+            self.__new_docs = {}
+            self.__upd_docs = {}
+            self.__del_docs = {}
+            return changes
+
+    def put_back(self, changes):
+        """
+        Put back in the buffer changes returned by take() that couldn't be
+        applied. Changes queued since then take precedence.
+        """
+        (new_docs, upd_docs, del_docs) = changes
+        with self.__lock:
+            for doc in new_docs:
+                if doc.docid in self.__upd_docs:
+                    # still not in the index
+                    doc = self.__upd_docs.pop(doc.docid)
+                if (doc.docid not in self.__new_docs and
+                        doc.docid not in self.__del_docs):
+                    self.__new_docs[doc.docid] = doc
+            for doc in upd_docs:
+                if (doc.docid not in self.__new_docs and
+                        doc.docid not in self.__upd_docs and
+                        doc.docid not in self.__del_docs):
+                    self.__upd_docs[doc.docid] = doc
+            for doc in del_docs:
+                if (doc.docid not in self.__new_docs and
+                        doc.docid not in self.__upd_docs and
+                        doc.docid not in self.__del_docs):
+                    self.__del_docs[doc.docid] = doc
+            if len(self) > 0:
+                # retried later, even if the buffer is full
+                self.__queued()
+
+    def flush(self):
+        """
+        Apply all the buffered changes, with a single index writer and
+        commit. The buffer is only locked while it is emptied: updates can
+        be queued while the index is written. If the changes can't be
+        applied, they are put back in the buffer (see put_back()) and the
+        exception is raised again.
+        """
+        with self.__flush_lock:
+            changes = self.take()
+            (new_docs, upd_docs, del_docs) = changes
+            if len(new_docs) + len(upd_docs) + len(del_docs) <= 0:
+                return
+            logger.info("Index: flushing %d new, %d updated, %d deleted docs"
+                        % (len(new_docs), len(upd_docs), len(del_docs)))
+            try:
+                updater = self.docsearch.get_index_updater(optimize=False)
+                try:
+                    for doc in new_docs:
+                        updater.add_doc(doc)
+                    for doc in upd_docs:
+                        updater.upd_doc(doc)
+                    for doc in del_docs:
+                        updater.del_doc(doc)
+                except:
+                    updater.cancel()
+                    raise
+                updater.commit()
+            except:
+                self.put_back(changes)
+                raise
+
+
+class DocSearchResults(object):
+    """
+    Lazy, deduplicated cursor on the ids of the documents matching a search.
+
+    A search may be made of many queries (for instance fuzzy terms, then
+    prefixes). Their results are returned one after the other, each
+    document only once. Queries are only run when their results are
+    required. Each query is first run with a top-k collector only as large
+    as the number of results requested so far: fetching the first page
+    doesn't score or sort more than needed. If more of its results are
+    required later, it is run a second and last time without limit, and its
+    results are then consumed as required.
+
+    Thread-safe: cursors are shared between the searches made with the same
+    keywords (see DocSearch.find_docids()).
+    """
+    FIRST_FETCH = 32
+
+    def __init__(self, searcher, queries, done_cb=None):
+        """
+        Arguments:
+            searcher --- Whoosh searcher
+            queries --- list of (query, sortedby, docnums), sortedby being
+                None if no sorting is required, and docnums a set of document
+                numbers to which the query must be restricted (or None)
+            done_cb --- called with the result of get_query_docnums() once
+                all the results have been fetched
+        """
+        self.__searcher = searcher
+        self.__queries = queries
+        self.__done_cb = done_cb
+        # documents matched by each query (even those already returned by a
+        # previous query). Only complete once the query is exhausted
+        self.__query_docnums = [set() for _ in queries]
+        self.__query_idx = 0
+        self.__results = None  # Whoosh results of the current query
+        self.__complete = False  # True if __results has all the hits
+        self.__fetched = 0  # number of hits of the current query looked at
+
+        self.__seen = set()  # docnums
+        self.__docids = []
+        self.__lock = threading.Lock()
+
+    def __search(self, limit):
+        (query, sortedby, docnums) = self.__queries[self.__query_idx]
+        kwargs = {}
+        if sortedby is not None:
+            kwargs['sortedby'] = sortedby
+        if docnums is not None:
+            kwargs['filter'] = docnums
+        self.__results = self.__searcher.search(query, limit=limit, **kwargs)
+        self.__complete = (limit is None or
+                           self.__results.scored_length() < limit)
+
+    def __fetch(self, nb_docids):
+        """
+        Append the docids of the next hits of the current query, until we
+        have nb_docids of them (None = all of them) or the query is
+        exhausted.
+
+        Returns:
+            False if there is nothing left to fetch
+        """
+        if self.__query_idx >= len(self.__queries):
+            return False
+        if self.__results is None:
+            if nb_docids is None:
+                self.__search(None)
+            else:
+                self.__search(max(self.FIRST_FETCH,
+                                  nb_docids - len(self.__docids)))
+        elif (not self.__complete and
+                self.__fetched >= self.__results.scored_length()):
+            # The top-k collector can't be resumed: run the query once
+            # again, this time with all its results. Hits are in the same
+            # order, so the ones already looked at are skipped
+            self.__search(None)
+
+        results = self.__results
+        nb_hits = results.scored_length()
+        query_docnums = self.__query_docnums[self.__query_idx]
+        while (self.__fetched < nb_hits and
+               (nb_docids is None or len(self.__docids) < nb_docids)):
+            docnum = results.docnum(self.__fetched)
+            self.__fetched += 1
+            query_docnums.add(docnum)
+            if docnum in self.__seen:
+                continue
+            self.__seen.add(docnum)
+            self.__docids.append(
+                self.__searcher.stored_fields(docnum)['docid'])
+
+        if self.__complete and self.__fetched >= nb_hits:
+            # this query is exhausted
+            self.__query_idx += 1
+            self.__results = None
+            self.__complete = False
+            self.__fetched = 0
+            if (self.__query_idx >= len(self.__queries) and
+                    self.__done_cb is not None):
+                self.__done_cb(self.__query_docnums)
+        return True
+
+    def __fill(self, nb_docids):
+        """
+        Make sure we have at least nb_docids results (if possible). None =
+        all of them.
+        """
+        while nb_docids is None or len(self.__docids) < nb_docids:
+            if not self.__fetch(nb_docids):
+                return
+
+    def get_page(self, offset, limit):
+        """
+        Returns up to 'limit' docids, starting at 'offset'
+        """
+        with self.__lock:
+            self.__fill(offset + limit)
+            return self.__docids[offset:offset + limit]
+
+    def get_all(self):
+        with self.__lock:
+            self.__fill(None)
+            return self.__docids[:]
+
+    def get_query_docnums(self):
+        """
+        Returns:
+            For each query, the set of the documents it matched. None if
+            the results haven't been entirely fetched yet.
+        """
+        with self.__lock:
+            if self.__query_idx < len(self.__queries):
+                return None
+            return self.__query_docnums
+
+    def __iter__(self):
+        idx = 0
+        while True:
+            with self.__lock:
+                if idx >= len(self.__docids):
+                    self.__fill(idx + 1)
+                    if idx >= len(self.__docids):
+                        return
+                docid = self.__docids[idx]
+            yield docid
+            idx += 1
 
 
 class DocSearch(object):
@@ -330,6 +961,20 @@ class DocSearch(object):
     INDEX_STEP_COMMIT = "commit"
     LABEL_STEP_UPDATING = "label updating"
     LABEL_STEP_DESTROYING = "label deletion"
+    SEARCH_CACHE_SIZE = 64  # number of result lists
+    CURSOR_CACHE_SIZE = 32  # number of search cursors
+    SUGGESTION_CACHE_SIZE = 64  # number of suggestion lists
+    SUGGESTION_MAX_DISTANCE = 2
+    SUGGESTION_MAX_PER_KEYWORD = 5
+    FACET_CACHE_SIZE = 16  # number of facet counts
+    DATE_BUCKETS = {
+        'year': lambda date: (date.year, ),
+        'month': lambda date: (date.year, date.month),
+        'day': lambda date: (date.year, date.month, date.day),
+    }
+    # queries using them are not simple lists of keywords
+    QUERY_OPERATORS = [u"AND", u"OR", u"NOT", u"ANDNOT", u"ANDMAYBE"]
+    QUERY_SPECIAL_CHARS = u"\"'()[]{}:*?~^+-"
     WHOOSH_SCHEMA = whoosh.fields.Schema(
         # static up to date schema
         docid=whoosh.fields.ID(stored=True, unique=True),
@@ -340,6 +985,7 @@ class DocSearch(object):
                                     scorable=True),
         date=whoosh.fields.DATETIME(stored=True),
         last_read=whoosh.fields.DATETIME(stored=True),
+        fingerprint=whoosh.fields.ID(stored=True),
     )
 
     def __init__(self, rootdir, indexdir=None,
@@ -367,9 +1013,19 @@ class DocSearch(object):
         mkdir_p(self.indexdir)
         self.label_guesser_dir = os.path.join(indexdir, "label_guessing")
         mkdir_p(self.label_guesser_dir)
+        self.catalog = DocCatalog(os.path.join(indexdir, "catalog"))
+        self.file_hash_cache = FileHashCache(os.path.join(indexdir,
+                                                          "file_hashes"))
+        self.file_hash_cache.load()
+        set_file_hash_cache(self.file_hash_cache)
+        # thumbnails of the document list (see the frontend)
+        self.thumbnail_atlas = ThumbnailAtlas(os.path.join(indexdir,
+                                                           "thumbnails"))
 
         self._docs_by_id = {}  # docid --> doc
         self.labels = {}  # label name --> label
+        self.__label_list = None  # sorted labels (see label_list)
+        self.index_batch = BatchIndexUpdater(self)
 
         need_index_rewrite = True
         try:
@@ -386,11 +1042,30 @@ class DocSearch(object):
 
         if need_index_rewrite:
             logger.info("Creating a new index")
+            self.catalog.destroy()
             self.index = whoosh.index.create_in(self.indexdir,
                                                 self.WHOOSH_SCHEMA)
             logger.info("Index '%s' created" % self.indexdir)
 
         self.__searcher = self.index.searcher()
+        # bumped each time the searcher is reloaded. Part of the keys of
+        # search_cache
+        self.__generation = 0
+        # (sentence, search type, limit, must_sort, generation) --> docs
+        # see search_cache.get_stats() for tuning
+        self.search_cache = LRUCache(self.SEARCH_CACHE_SIZE)
+        # (sentence, search type, must_sort, generation) --> (cursor,
+        #  on_search_done) (see find_docids())
+        self.cursor_cache = LRUCache(self.CURSOR_CACHE_SIZE)
+        # (sentence, generation) --> suggestions
+        self.suggestion_cache = LRUCache(self.SUGGESTION_CACHE_SIZE)
+        # (sentence, search type, date bucket, generation) --> facets
+        self.facet_cache = LRUCache(self.FACET_CACHE_SIZE)
+        # last complete search, used to narrow down the next one when the
+        # user is still typing (see __get_narrowing_docnums())
+        # (search type, generation, [keywords per query],
+        #  [docnums per query])
+        self.__last_search = None
 
         class CustomFuzzy(whoosh.qparser.query.FuzzyTerm):
             def __init__(self, fieldname, text, boost=1.0, maxdist=1,
@@ -417,7 +1092,9 @@ class DocSearch(object):
                     "query_parser": whoosh.qparser.MultifieldParser(
                         ["label", "content"], schema=self.index.schema,
                         termclass=whoosh.qparser.query.Prefix),
-                    "sortedby": facets
+                    "sortedby": facets,
+                    # "invoice" matches a subset of what "invoi" matches
+                    "prefix": True,
                 },
             ],
             'strict': [
@@ -448,6 +1125,14 @@ class DocSearch(object):
         """
         return DocDirExaminer(self)
 
+    def get_watcher(self, callback, rescan_cb=None):
+        """
+        Return an object watching the work directory for changes made by
+        other programs (see watcher.WorkdirWatcher). It must be started
+        explicitly.
+        """
+        return WorkdirWatcher(self.rootdir, callback, rescan_cb)
+
     def get_index_updater(self, optimize=True):
         """
         Return an object useful to update the content of the index
@@ -459,6 +1144,14 @@ class DocSearch(object):
         """
         return DocIndexUpdater(self, optimize)
 
+    def get_index_rebuilder(self, optimize=True,
+                            progress_cb=dummy_progress_cb):
+        """
+        Return an index updater able to index a lot of new documents using
+        all the CPUs (see DocIndexRebuilder)
+        """
+        return DocIndexRebuilder(self, optimize, progress_cb)
+
     def guess_labels(self, doc):
         """
         return a prediction of label names
@@ -472,6 +1165,20 @@ class DocSearch(object):
             labels.add(label)
         return labels
 
+    def __inst_doc_from_catalog(self, entry):
+        """
+        Instantiate a document based on its catalog entry. Doesn't touch the
+        document directory at all.
+        """
+        for (is_doc_type, doc_type_name, doc_type) in DOC_TYPE_LIST:
+            if doc_type_name == entry.doctype:
+                docpath = os.path.join(self.rootdir, entry.docid)
+                return doc_type(docpath, entry.docid,
+                                cache=entry.get_doc_cache())
+        logger.warning("Warning: unknown doc type found in the catalog: %s"
+                       % entry.doctype)
+        return None
+
     def __inst_doc(self, docid, doc_type_name=None):
         """
         Instantiate a document based on its document id.
@@ -479,13 +1186,16 @@ class DocSearch(object):
         """
         doc = None
         docpath = os.path.join(self.rootdir, docid)
-        if not os.path.exists(docpath):
+        # listed once, and shared with the document instance
+        snapshot = DocDirSnapshot(docpath)
+        if not snapshot.exists:
             return None
+        cache = {'snapshot': snapshot}
         if doc_type_name is not None:
             # if we already know the doc type name
             for (is_doc_type, doc_type_name_b, doc_type) in DOC_TYPE_LIST:
                 if doc_type_name_b == doc_type_name:
-                    doc = doc_type(docpath, docid)
+                    doc = doc_type(docpath, docid, cache=cache)
             if not doc:
                 logger.warning(
                     ("Warning: unknown doc type found in the index: %s") %
@@ -494,8 +1204,8 @@ class DocSearch(object):
         # otherwise we guess the doc type
         if not doc:
             for (is_doc_type, doc_type_name, doc_type) in DOC_TYPE_LIST:
-                if is_doc_type(docpath):
-                    doc = doc_type(docpath, docid)
+                if is_doc_type(docpath, snapshot):
+                    doc = doc_type(docpath, docid, cache=cache)
                     break
         if not doc:
             logger.warning("Warning: unknown doc type for doc '%s'" % docid)
@@ -527,13 +1237,58 @@ class DocSearch(object):
         for doc in docs_by_id.values():
             doc.drop_cache()
         del docs_by_id
+        # cached search results refer to the previous document instances
+        self.__generation += 1
+
+        if self.catalog.load(self.index.latest_generation()):
+            labels = self.__load_docs_from_catalog(progress_cb)
+        else:
+            labels = self.__load_docs_from_index(progress_cb)
+        progress_cb(1, 1, self.INDEX_STEP_LOADING)
+
+        self.label_guesser = LabelGuesser(self.label_guesser_dir)
+        for label in labels:
+            self.label_guesser.load(label.name)
+
+        self.labels = {label.name: label for label in labels}
+        self.__label_list = None
+
+    def __load_docs_from_catalog(self, progress_cb):
+        """
+        Instantiate all the documents listed in the catalog.
+
+        Returns:
+            The set of labels found on the documents
+        """
+        entries = self.catalog.entries.values()
+        nb_entries = len(entries)
+        labels = set()
+
+        for (progress, entry) in enumerate(entries):
+            doc = self.__inst_doc_from_catalog(entry)
+            if doc is None:
+                continue
+            progress_cb(progress, nb_entries, self.INDEX_STEP_LOADING, doc)
+            self._docs_by_id[entry.docid] = doc
+            labels.update(doc.labels)
+        return labels
+
+    def __load_docs_from_index(self, progress_cb):
+        """
+        Instantiate all the documents listed in the index, and look at their
+        directories. Used when the catalog is not available. Rewrites the
+        catalog so the next loading is fast.
 
+        Returns:
+            The set of labels found on the documents
+        """
         query = whoosh.query.Every()
         results = self.__searcher.search(query, limit=None)
 
         nb_results = len(results)
         progress = 0
         labels = set()
+        self.catalog.entries = {}
 
         for result in results:
             docid = result['docid']
@@ -545,15 +1300,55 @@ class DocSearch(object):
             self._docs_by_id[docid] = doc
             for label in doc.labels:
                 labels.add(label)
+            # we don't know the page count or the geometry without opening
+            # the files: they will be filled in on the next update of the doc
+            # last_read is datetime.fromtimestamp(doc.last_mod): local time,
+            # down to the microsecond
+            last_read = result['last_read']
+            last_mod = (time.mktime(last_read.timetuple()) +
+                        last_read.microsecond / 1e6)
+            self.catalog.entries[docid] = CatalogEntry(
+                docid, doctype, last_mod=last_mod,
+                labels=[(label.name, label.get_color_str())
+                        for label in doc.labels]
+            )
 
             progress += 1
-        progress_cb(1, 1, self.INDEX_STEP_LOADING)
 
-        self.label_guesser = LabelGuesser(self.label_guesser_dir)
-        for label in labels:
-            self.label_guesser.load(label.name)
+        try:
+            self.catalog.write(self.index.latest_generation())
+        except (IOError, OSError), exc:
+            logger.warning("Failed to write the document catalog: %s" % exc)
+        return labels
 
-        self.labels = {label.name: label for label in labels}
+    def update_catalog(self, entries):
+        """
+        Apply the changes made to the catalog by a DocIndexUpdater, and
+        write it. Must be called right after the index commit.
+
+        Arguments:
+            entries --- docid --> CatalogEntry (or None if the doc has been
+                removed)
+        """
+        for (docid, entry) in entries.iteritems():
+            if entry is None:
+                self.catalog.entries.pop(docid, None)
+            else:
+                self.catalog.entries[docid] = entry
+        try:
+            self.catalog.write(self.index.latest_generation())
+        except (IOError, OSError), exc:
+            logger.warning("Failed to write the document catalog: %s" % exc)
+            self.catalog.destroy()
+        self.file_hash_cache.write(is_wanted=self.__is_file_hash_wanted)
+
+    def __is_file_hash_wanted(self, path):
+        """
+        Only keep in the file hash cache the hashes of the files of the
+        documents still in the catalog
+        """
+        docid = os.path.relpath(path, self.rootdir).split(os.sep)[0]
+        return docid in self.catalog.entries
 
     def index_page(self, page):
         """
@@ -564,9 +1359,7 @@ class DocSearch(object):
 
         Obsolete. To remove. Use get_index_updater() instead
         """
-        updater = self.get_index_updater(optimize=False)
-        updater.upd_doc(page.doc)
-        updater.commit()
+        self.index_batch.upd_doc(page.doc)
         if page.doc.docid not in self._docs_by_id:
             logger.info("Adding document '%s' to the index" % page.doc.docid)
             assert(page.doc is not None)
@@ -601,53 +1394,291 @@ class DocSearch(object):
         Returns:
             An array of document (doc objects)
         """
-        sentence = sentence.strip()
-        sentence = strip_accents(sentence)
+        sentence = self.__normalize_sentence(sentence)
 
         if sentence == u"":
             return self.docs
 
-        result_list_list = []
-        total_results = 0
+        key = (sentence, search_type, limit, must_sort, self.__generation)
+        docs = self.search_cache.get(key)
+        if docs is None:
+            docs = self.__find_documents(sentence, limit, must_sort,
+                                         search_type)
+            self.search_cache.put(key, docs)
+        # the caller may sort the list in place
+        return docs[:]
+
+    def __normalize_sentence(self, sentence):
+        sentence = strip_accents(sentence)
+        # whoosh doesn't care about the amount of spaces between keywords
+        return u" ".join(sentence.split())
+
+    def __has_query_syntax(self, keywords):
+        return any(keyword in self.QUERY_OPERATORS or
+                   any(char in self.QUERY_SPECIAL_CHARS for char in keyword)
+                   for keyword in keywords)
+
+    @staticmethod
+    def __get_query_keywords(query):
+        """
+        Returns the keywords actually looked for by a parsed query (after
+        analysis: lower case, stop words removed, etc). None if the query
+        contains something else than terms.
+        """
+        keywords = set()
+        for leaf in query.leaves():
+            if not hasattr(leaf, 'text'):
+                return None
+            keywords.add(leaf.text)
+        return keywords
+
+    def __get_narrowing_docnums(self, search_type, query_idx, keywords):
+        """
+        If the new query can only match a subset of what the same query
+        matched during the last search, returns the documents it matched
+        then. Otherwise returns None.
+
+        Keywords are ANDed, so the new query narrows the old one if each old
+        keyword is still there, or, for prefix queries, has been made
+        longer.
+        """
+        last_search = self.__last_search
+        if last_search is None or keywords is None:
+            return None
+        (last_type, last_generation, last_keywords, last_docnums) = \
+            last_search
+        if last_type != search_type or last_generation != self.__generation:
+            return None
+        old_keywords = last_keywords[query_idx]
+        if old_keywords is None or len(old_keywords) <= 0:
+            return None
+        prefix = self.search_param_list[search_type][query_idx].get(
+            "prefix", False)
+        for old_keyword in old_keywords:
+            if old_keyword in keywords:
+                continue
+            if not prefix or not any(keyword.startswith(old_keyword)
+                                     for keyword in keywords):
+                return None
+        return last_docnums[query_idx]
+
+    def find_docids(self, sentence, must_sort=True, search_type='fuzzy'):
+        """
+        Returns a lazy cursor on the ids of the documents matching the
+        given keywords (see DocSearchResults). Use it instead of
+        find_documents() when only the first results are required.
 
-        for query_parser in self.search_param_list[search_type]:
+        Cursors are cached and shared: the same search made again (the
+        user retyping a query, for instance) continues from what has
+        already been fetched.
+        """
+        sentence = self.__normalize_sentence(sentence)
+        return self.__find_docids(sentence, must_sort, search_type)
+
+    def __find_docids(self, sentence, must_sort, search_type):
+        generation = self.__generation
+        key = (sentence, search_type, must_sort, generation)
+        cached = self.cursor_cache.get(key)
+        if cached is not None:
+            (results, on_search_done) = cached
+            docnums = results.get_query_docnums()
+            if docnums is not None:
+                # the next search may narrow down this one
+                on_search_done(docnums)
+            return results
+
+        plain = not self.__has_query_syntax(sentence.split(" "))
+        queries = []
+        queries_keywords = []
+        for (idx, query_parser) in enumerate(
+                self.search_param_list[search_type]):
             query = query_parser["query_parser"].parse(sentence)
+            sortedby = None
             if must_sort and "sortedby" in query_parser:
-                result_list = self.__searcher.search(
-                    query, limit=limit, sortedby=query_parser["sortedby"])
-            else:
-                result_list = self.__searcher.search(
-                    query, limit=limit)
+                sortedby = query_parser["sortedby"]
+            keywords = None
+            if plain:
+                keywords = self.__get_query_keywords(query)
+            docnums = self.__get_narrowing_docnums(search_type, idx,
+                                                   keywords)
+            if docnums is not None:
+                logger.info("Search [%s]: narrowing down the last search"
+                            " (%d documents)" % (sentence, len(docnums)))
+            queries.append((query, sortedby, docnums))
+            queries_keywords.append(keywords)
+
+        def on_search_done(docnums):
+            self.__last_search = (search_type, generation, queries_keywords,
+                                  docnums)
+
+        results = DocSearchResults(self.__searcher, queries, on_search_done)
+        self.cursor_cache.put(key, (results, on_search_done))
+        return results
 
-            result_list_list.append(result_list)
-            total_results += len(result_list)
+    def get_docs_from_docids(self, docids, limit=None):
+        """
+        Arguments:
+            docids --- iterable of document ids (for instance a cursor
+                returned by find_docids()). Documents unknown to this
+                DocSearch are skipped.
+            limit --- maximum number of documents to return (None = no
+                limit). The docids are only consumed until it is reached.
 
-            if not must_sort and total_results >= limit:
+        Returns:
+            An array of documents (doc objects)
+        """
+        docs = []
+        if limit is not None and limit <= 0:
+            return docs
+        for docid in docids:
+            doc = self._docs_by_id.get(docid)
+            if doc is None:
+                continue
+            docs.append(doc)
+            if limit is not None and len(docs) >= limit:
                 break
+        return docs
 
-        # merging results
-        results = result_list_list[0]
-        for result_intermediate in result_list_list[1:]:
-            results.extend(result_intermediate)
+    def __find_documents(self, sentence, limit, must_sort, search_type):
+        results = self.__find_docids(sentence, must_sort, search_type)
+        if limit is None:
+            return self.get_docs_from_docids(results.get_all())
+        return self.get_docs_from_docids(results, limit)
 
-        docs = [self._docs_by_id.get(result['docid']) for result in results]
-        try:
-            while True:
-                docs.remove(None)
-        except ValueError:
-            pass
-        assert (None not in docs)
+    def get_facets(self, sentence=u"", search_type='fuzzy',
+                   date_bucket=None):
+        """
+        Count the documents matching a search, for each label and, if
+        requested, each period of time. Counts come from the index only: no
+        document is read.
 
-        if limit is not None:
-            docs = docs[:limit]
+        Arguments:
+            sentence --- a sentenced query, as for find_documents(). An
+                empty sentence matches all the documents
+            date_bucket --- 'year', 'month', 'day', or None if the dates
+                don't have to be counted
+        Returns:
+            {
+                'labels': {label name: number of documents},
+                'dates': {date bucket: number of documents},
+            }
+            Date buckets are tuples: (year, ), (year, month) or
+            (year, month, day). 'dates' is empty if date_bucket is None.
+        """
+        sentence = self.__normalize_sentence(sentence)
+        key = (sentence, search_type, date_bucket, self.__generation)
+        facets = self.facet_cache.get(key)
+        if facets is None:
+            facets = self.__get_facets(sentence, search_type, date_bucket)
+            self.facet_cache.put(key, facets)
+        # the caller may modify them
+        return {name: dict(counts) for (name, counts) in facets.iteritems()}
+
+    def __get_facets(self, sentence, search_type, date_bucket):
+        if sentence == u"":
+            query = whoosh.query.Every()
+        else:
+            query = whoosh.query.Or([
+                query_parser["query_parser"].parse(sentence)
+                for query_parser in self.search_param_list[search_type]
+            ])
+
+        groupedby = {
+            # a document may have many labels
+            'labels': whoosh.sorting.FieldFacet("label", allow_overlap=True),
+        }
+        if date_bucket is not None:
+            groupedby['dates'] = whoosh.sorting.FieldFacet("date")
+        results = self.__searcher.search(query, limit=None, scored=False,
+                                         groupedby=groupedby,
+                                         maptype=whoosh.sorting.Count)
+
+        # labels are indexed without their accents
+        label_names = {strip_accents(label.name): label.name
+                       for label in self.label_list}
+        labels = {}
+        for (term, count) in results.groups('labels').iteritems():
+            if isinstance(term, str):
+                term = term.decode("utf-8")
+            name = label_names.get(term, term)
+            labels[name] = labels.get(name, 0) + count
+
+        dates = {}
+        if date_bucket is None:
+            return {'labels': labels, 'dates': dates}
+
+        get_bucket = self.DATE_BUCKETS[date_bucket]
+        for (date, count) in results.groups('dates').iteritems():
+            if date is None:
+                continue
+            if not isinstance(date, datetime.datetime):
+                date = whoosh.util.times.long_to_datetime(date)
+            bucket = get_bucket(date)
+            dates[bucket] = dates.get(bucket, 0) + count
 
-        return docs
+        return {'labels': labels, 'dates': dates}
+
+    def __get_keyword_docnums(self, reader, keyword):
+        """
+        Find the documents matching a keyword of a strict search, directly
+        from the posting lists of the index.
+
+        Returns:
+            A set of document numbers, or None if the keyword is dropped
+            by the query parser (and so matches all the documents)
+        """
+        docnums = None
+        for fieldname in ("label", "content"):
+            field = self.index.schema[fieldname]
+            tokens = [token for token in field.process_text(keyword,
+                                                            mode="query")]
+            if len(tokens) <= 0:
+                continue
+            field_docnums = None
+            for token in tokens:
+                if (fieldname, token) in reader:
+                    ids = set(reader.postings(fieldname, token).all_ids())
+                else:
+                    ids = set()
+                if field_docnums is None:
+                    field_docnums = ids
+                else:
+                    field_docnums.intersection_update(ids)
+            if docnums is None:
+                docnums = field_docnums
+            else:
+                docnums.update(field_docnums)
+        return docnums
+
+    def __get_label_candidates(self, keyword, limit):
+        """
+        Label names looking like the keyword. There are only a few labels,
+        so we can simply compare them all.
+        """
+        keyword = strip_accents(keyword).lower()
+        candidates = []
+        for label_name in self.labels.keys():
+            label_name = strip_accents(label_name)
+            distance = Levenshtein.distance(keyword, label_name.lower())
+            if distance <= 0 or distance > self.SUGGESTION_MAX_DISTANCE:
+                continue
+            candidates.append((distance, label_name))
+        candidates.sort()
+        return [label_name for (distance, label_name) in candidates[:limit]]
 
     def find_suggestions(self, sentence):
         """
         Search all possible suggestions. Suggestions returned always have at
         least one document matching.
 
+        Candidates for each keyword come from the spelling dictionary that
+        Whoosh maintains for the content (updated on each commit), and from
+        the label names. They are ranked and filtered with the document
+        frequencies of their terms. Only the best ones are checked against
+        the posting lists of the index, and only when these frequencies are
+        not enough (many keywords, deleted documents). No search is run.
+        Results are cached until the index changes.
+
         Arguments:
             sentence --- keywords (single strings) for which we want
                 suggestions
@@ -658,16 +1689,136 @@ class DocSearch(object):
         if not isinstance(sentence, unicode):
             sentence = unicode(sentence, encoding="UTF-8")
 
-        keywords = sentence.split(" ")
+        key = (sentence, self.__generation)
+        suggestions = self.suggestion_cache.get(key)
+        if suggestions is None:
+            keywords = sentence.split(" ")
+            if self.__has_query_syntax(keywords):
+                suggestions = self.__find_suggestions_by_searching(keywords)
+            else:
+                suggestions = self.__find_suggestions(keywords)
+            suggestions.sort()
+            self.suggestion_cache.put(key, suggestions)
+        return suggestions[:]
+
+    def __get_keyword_doc_frequency(self, reader, keyword):
+        """
+        Estimate how many documents a keyword of a strict search matches,
+        from the term infos of the index only (no posting list is read).
+
+        Returns:
+            (number of documents, exact). 'exact' is False when the keyword
+            is made of many tokens: the number is then only an upper bound.
+            (None, True) if the keyword is dropped by the query parser
+        """
+        frequency = None
+        exact = True
+        for fieldname in ("label", "content"):
+            field = self.index.schema[fieldname]
+            tokens = [token for token in field.process_text(keyword,
+                                                            mode="query")]
+            if len(tokens) <= 0:
+                continue
+            if len(tokens) > 1:
+                exact = False
+            field_frequency = min([reader.doc_frequency(fieldname, token)
+                                   for token in tokens])
+            if frequency is None:
+                frequency = field_frequency
+            else:
+                frequency += field_frequency
+        return (frequency, exact)
+
+    def __find_suggestions(self, keywords):
+        searcher = self.__searcher
+        reader = searcher.reader()
+        corrector = searcher.corrector("content")
+        # document frequencies include the deleted documents until their
+        # segment is merged
+        has_deletions = reader.has_deletions()
+
+        # documents matching each of the keywords as they are. Only read
+        # if a candidate has to be checked against the other keywords
+        keywords_docnums = []
+
+        def get_others_docnums(keyword_idx):
+            """
+            Documents matching all the other keywords
+            """
+            if len(keywords_docnums) <= 0:
+                keywords_docnums.extend([
+                    self.__get_keyword_docnums(reader, strip_accents(keyword))
+                    for keyword in keywords
+                ])
+            others_docnums = None
+            for (other_idx, docnums) in enumerate(keywords_docnums):
+                if other_idx == keyword_idx or docnums is None:
+                    continue
+                if others_docnums is None:
+                    others_docnums = set(docnums)
+                else:
+                    others_docnums.intersection_update(docnums)
+            return others_docnums
+
+        final_suggestions = []
+        for keyword_idx in range(0, len(keywords)):
+            keyword = keywords[keyword_idx]
+            if (len(keyword) <= MIN_KEYWORD_LEN):
+                continue
+
+            keyword_suggestions = self.__get_label_candidates(keyword, 2)
+            keyword_suggestions += corrector.suggest(keyword, limit=5)[:]
+
+            # rank the candidates (closest first, then most frequent) and
+            # drop those that match no document, without reading any
+            # posting list
+            candidates = []
+            for keyword_suggestion in set(keyword_suggestions):
+                (frequency, exact) = self.__get_keyword_doc_frequency(
+                    reader, strip_accents(keyword_suggestion))
+                if frequency is not None and frequency <= 0:
+                    continue
+                distance = Levenshtein.distance(keyword, keyword_suggestion)
+                candidates.append((distance, -(frequency or 0),
+                                   keyword_suggestion, exact))
+            candidates.sort()
+
+            # only the finalists are checked against the posting lists, and
+            # only when the document frequencies are not enough
+            for (_, _, keyword_suggestion, exact) in \
+                    candidates[:self.SUGGESTION_MAX_PER_KEYWORD]:
+                if len(keywords) > 1 or not exact or has_deletions:
+                    docnums = self.__get_keyword_docnums(
+                        reader, strip_accents(keyword_suggestion))
+                    others_docnums = None
+                    if len(keywords) > 1:
+                        others_docnums = get_others_docnums(keyword_idx)
+                    if docnums is None:
+                        docnums = others_docnums
+                    elif others_docnums is not None:
+                        docnums = docnums.intersection(others_docnums)
+                    if docnums is not None and not any(
+                            not reader.is_deleted(docnum)
+                            for docnum in docnums):
+                        continue
+                new_suggestion = keywords[:]
+                new_suggestion[keyword_idx] = keyword_suggestion
+                final_suggestions.append(u" ".join(new_suggestion))
+        return final_suggestions
+
+    def __find_suggestions_by_searching(self, keywords):
+        """
+        Slow path, for queries using the Whoosh query syntax: each candidate
+        is checked by actually running the corresponding search.
+        """
         final_suggestions = []
 
         corrector = self.__searcher.corrector("content")
-        label_corrector = self.__searcher.corrector("label")
         for keyword_idx in range(0, len(keywords)):
             keyword = keywords[keyword_idx]
             if (len(keyword) <= MIN_KEYWORD_LEN):
                 continue
-            keyword_suggestions = label_corrector.suggest(keyword, limit=2)[:]
+            keyword_suggestions = self.__get_label_candidates(keyword, 2)
             keyword_suggestions += corrector.suggest(keyword, limit=5)[:]
             for keyword_suggestion in keyword_suggestions:
                 new_suggestion = keywords[:]
@@ -681,7 +1832,6 @@ class DocSearch(object):
                 if len(docs) <= 0:
                     continue
                 final_suggestions.append(new_suggestion)
-        final_suggestions.sort()
         return final_suggestions
 
     def create_label(self, label, doc=None, callback=dummy_progress_cb):
@@ -695,12 +1845,11 @@ class DocSearch(object):
         label = copy.copy(label)
         assert(label not in self.labels.values())
         self.labels[label.name] = label
+        self.__label_list = None
         self.label_guesser.load(label.name)
         if doc:
             doc.add_label(label)
-            updater = self.get_index_updater(optimize=False)
-            updater.upd_doc(doc)
-            updater.commit()
+            self.index_batch.upd_doc(doc)
 
     def add_label(self, doc, label, update_index=True):
         """
@@ -709,24 +1858,29 @@ class DocSearch(object):
         Arguments:
             label --- The new label (see labels.Label)
             doc --- The first document on which this label has been added
+            update_index --- if True, the document update is queued in
+                index_batch (see BatchIndexUpdater)
         """
         label = copy.copy(label)
         assert(label in self.labels.values())
         doc.add_label(label)
         if update_index:
-            updater = self.get_index_updater(optimize=False)
-            updater.upd_doc(doc)
-            updater.commit()
+            self.index_batch.upd_doc(doc)
 
     def remove_label(self, doc, label, update_index=True):
         """
-        Remove a label from a doc. Takes care of updating the index
+        Remove a label from a doc. Takes care of updating the index (see
+        add_label())
         """
         doc.remove_label(label)
         if update_index:
-            updater = self.get_index_updater(optimize=False)
-            updater.upd_doc(doc)
-            updater.commit()
+            self.index_batch.upd_doc(doc)
+
+    def flush_index_updates(self):
+        """
+        Make sure all the pending index updates are written
+        """
+        self.index_batch.flush()
 
     def update_label(self, old_label, new_label, callback=dummy_progress_cb):
         """
@@ -738,6 +1892,7 @@ class DocSearch(object):
         self.labels.pop(old_label.name)
         if new_label not in self.labels.values():
             self.labels[new_label.name] = new_label
+        self.__label_list = None
         current = 0
         total = len(self.docs)
         updater = self.get_index_updater(optimize=False)
@@ -758,6 +1913,7 @@ class DocSearch(object):
         """
         assert(label)
         self.labels.pop(label.name)
+        self.__label_list = None
         current = 0
         docs = self.docs
         total = len(docs)
@@ -781,6 +1937,8 @@ class DocSearch(object):
         """
         searcher = self.__searcher
         self.__searcher = self.index.searcher()
+        # results cached for the previous generation will never be used again
+        self.__generation += 1
         del(searcher)
 
     def destroy_index(self):
@@ -791,6 +1949,7 @@ class DocSearch(object):
         logger.info("Destroying the index ...")
         rm_rf(self.indexdir)
         rm_rf(self.label_guesser_dir)
+        self.catalog.destroy()
         logger.info("Done")
 
     def is_hash_in_index(self, filehash):
@@ -803,14 +1962,17 @@ class DocSearch(object):
         return results
 
     def __get_label_list(self):
-        labels = [label for label in self.labels.values()]
-        labels.sort()
-        return labels
+        if self.__label_list is None:
+            self.__label_list = sorted(self.labels.values(),
+                                       key=lambda label: label.sort_key)
+        # callers may modify the list they get
+        return self.__label_list[:]
 
     def __set_label_list(self, label_list):
         for label in label_list:
             self.label_guesser.load(label.name)
         labels = {label.name: label for label in label_list}
         self.labels = labels
+        self.__label_list = None
 
     label_list = property(__get_label_list, __set_label_list)
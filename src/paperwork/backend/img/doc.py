@@ -18,7 +18,6 @@
 Code for managing documents (not page individually ! see page.py for that)
 """
 
-import errno
 import os
 import os.path
 import logging
@@ -28,7 +27,9 @@ import cairo
 import PIL.Image
 from gi.repository import Poppler
 
+from paperwork.backend.common.dirsnapshot import DocDirSnapshot
 from paperwork.backend.common.doc import BasicDoc
+from paperwork.backend.img.geometry import DocGeometry
 from paperwork.backend.img.page import ImgPage
 from paperwork.backend.util import image2surface
 from paperwork.backend.util import surface2image
@@ -209,41 +210,45 @@ class ImgDoc(BasicDoc):
     can_edit = True
     doctype = u"Img"
 
-    def __init__(self, docpath, docid=None):
+    def __init__(self, docpath, docid=None, cache=None):
         """
         Arguments:
             docpath --- For an existing document, the path to its folder. For
                 a new one, the rootdir of all documents
             docid --- Document Id (ie folder name). Use None for a new document
+            cache --- see BasicDoc.__init__()
         """
-        BasicDoc.__init__(self, docpath, docid)
+        BasicDoc.__init__(self, docpath, docid, cache)
         self.__pages = None
+        self.__geometry = None
 
     def clone(self):
         return ImgDoc(self.path, self.docid)
 
-    def __get_last_mod(self):
-        last_mod = 0.0
-        for page in self.pages:
-            if last_mod < page.last_mod:
-                last_mod = page.last_mod
-        labels_path = os.path.join(self.path, BasicDoc.LABEL_FILE)
-        try:
-            file_last_mod = os.stat(labels_path).st_mtime
-            if file_last_mod > last_mod:
-                last_mod = file_last_mod
-        except OSError:
-            pass
-        extra_txt_path = os.path.join(self.path, BasicDoc.EXTRA_TEXT_FILE)
-        try:
-            file_last_mod = os.stat(extra_txt_path).st_mtime
-            if file_last_mod > last_mod:
-                last_mod = file_last_mod
-        except OSError:
-            pass
-        return last_mod
-
-    last_mod = property(__get_last_mod)
+    def __get_page_filenames(self):
+        return set([ImgPage.get_img_filename(page_nb)
+                    for page_nb in xrange(0, self.nb_pages)])
+
+    def get_geometry(self):
+        """
+        Returns:
+            The geometry table of the pages (see geometry.DocGeometry)
+        """
+        if self.__geometry is None:
+            self.__geometry = DocGeometry(self.path,
+                                          self.__get_page_filenames)
+        return self.__geometry
+
+    def _get_last_mod(self):
+        filenames = [
+            "%s%d.%s" % (ImgPage.FILE_PREFIX, page_nb + 1, ImgPage.EXT_BOX)
+            for page_nb in xrange(0, self.nb_pages)
+        ]
+        filenames += [BasicDoc.LABEL_FILE, BasicDoc.EXTRA_TEXT_FILE]
+        return self.get_snapshot().get_last_mod(filenames)
+
+    def _get_thumbnail_source_filename(self):
+        return ImgPage.get_img_filename(0)
 
     def __get_pages(self):
         if self.__pages is None:
@@ -257,23 +262,15 @@ class ImgDoc(BasicDoc):
         Compute the number of pages in the document. It basically counts
         how many JPG files there are in the document.
         """
-        try:
-            filelist = os.listdir(self.path)
-            count = 0
-            for filename in filelist:
-                if (filename[-4:].lower() != "." + ImgPage.EXT_IMG
-                    or (filename[-10:].lower() == "." + ImgPage.EXT_THUMB)
-                    or (filename[:len(ImgPage.FILE_PREFIX)].lower() !=
-                        ImgPage.FILE_PREFIX)):
-                    continue
-                count += 1
-            return count
-        except OSError, exc:
-            if exc.errno != errno.ENOENT:
-                logger.error("Exception while trying to get the number of"
-                             " pages of '%s': %s" % (self.docid, exc))
-                raise
-            return 0
+        count = 0
+        for filename in self.get_snapshot().filenames:
+            if (filename[-4:].lower() != "." + ImgPage.EXT_IMG
+                or (filename[-10:].lower() == "." + ImgPage.EXT_THUMB)
+                or (filename[:len(ImgPage.FILE_PREFIX)].lower() !=
+                    ImgPage.FILE_PREFIX)):
+                continue
+            count += 1
+        return count
 
     def print_page_cb(self, print_op, print_context, page_nb, keep_refs={}):
         """
@@ -307,9 +304,10 @@ class ImgDoc(BasicDoc):
         BasicDoc.drop_cache(self)
         del(self.__pages)
         self.__pages = None
+        self.__geometry = None
 
     def get_docfilehash(self):
-        if self._get_nb_pages() == 0:
+        if self.nb_pages == 0:
             logger.warn("WARNING: Document %s is empty" % self.docid)
             dochash = 0
         else:
@@ -349,16 +347,14 @@ class ImgDoc(BasicDoc):
         return self.pages[page_nb]
 
 
-def is_img_doc(docpath):
-    if not os.path.isdir(docpath):
-        return False
-    try:
-        filelist = os.listdir(docpath)
-    except OSError, exc:
-        logger.warn("Warning: Failed to list files in %s: %s"
-                    % (docpath, str(exc)))
-        return False
-    for filename in filelist:
+def is_img_doc(docpath, snapshot=None):
+    """
+    Arguments:
+        snapshot --- DocDirSnapshot of docpath, if already available
+    """
+    if snapshot is None:
+        snapshot = DocDirSnapshot(docpath)
+    for filename in snapshot.filenames:
         if (filename.lower().endswith(ImgPage.EXT_IMG)
                 and not filename.lower().endswith(ImgPage.EXT_THUMB)):
             return True
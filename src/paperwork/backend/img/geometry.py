@@ -0,0 +1,193 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Page geometry table of image documents.
+
+Knowing the size of a page means opening its image. The geometry of all the
+pages of a document is stored in a sidecar file in the document directory,
+each entry along with the size and mtime of the image it comes from.
+"""
+
+import json
+import logging
+import os
+import threading
+
+import PIL.Image
+
+from paperwork.backend.util import write_sidecar_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class PageGeometry(object):
+    EXIF_ORIENTATION = 0x0112
+
+    def __init__(self, size, dpi=None, orientation=1):
+        """
+        Arguments:
+            size --- (width, height), in pixels
+            dpi --- (horizontal, vertical), or None if unknown
+            orientation --- EXIF orientation (1 = normal)
+        """
+        self.size = size
+        self.dpi = dpi
+        self.orientation = orientation
+
+    @staticmethod
+    def from_img(img):
+        dpi = img.info.get('dpi', None)
+        if dpi is not None:
+            dpi = (int(dpi[0]), int(dpi[1]))
+        orientation = 1
+        try:
+            exif = img._getexif()
+            if exif is not None:
+                orientation = exif.get(PageGeometry.EXIF_ORIENTATION, 1)
+        except Exception:
+            # no EXIF support for this format, or broken EXIF data
+            pass
+        return PageGeometry(img.size, dpi, orientation)
+
+    @staticmethod
+    def from_file(path):
+        """
+        Only the image header is read: PIL doesn't decode the image until
+        its pixels are required.
+        """
+        img = PIL.Image.open(path)
+        return PageGeometry.from_img(img)
+
+
+class DocGeometry(object):
+    """
+    Geometry of all the pages of a document, loaded from the sidecar file
+    on first use and then served from memory. Entries are checked against
+    their image (size and mtime) only the first time one of them is
+    requested.
+    """
+    FILENAME = "geometry.cache"
+    VERSION = 1
+
+    def __init__(self, docpath, get_filenames):
+        """
+        Arguments:
+            get_filenames --- callback returning the file names of all the
+                page images of the document
+        """
+        self.docpath = docpath
+        self.get_filenames = get_filenames
+        self.__lock = threading.Lock()
+        self.__entries = None  # filename --> [file size, mtime, geometry]
+        self.__checked = set()
+
+    def __load(self):
+        self.__entries = {}
+        path = os.path.join(self.docpath, self.FILENAME)
+        try:
+            with open(path, 'rb') as file_desc:
+                content = json.load(file_desc)
+            if content['version'] != self.VERSION:
+                return
+            for (filename, (file_size, mtime, size, dpi, orientation)) \
+                    in content['pages'].iteritems():
+                geometry = PageGeometry(
+                    tuple(size), tuple(dpi) if dpi is not None else None,
+                    orientation
+                )
+                self.__entries[filename] = [file_size, mtime, geometry]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return
+
+    def __write(self):
+        content = {
+            'version': self.VERSION,
+            'pages': {
+                filename: [file_size, mtime, geometry.size, geometry.dpi,
+                           geometry.orientation]
+                for (filename, (file_size, mtime, geometry))
+                in self.__entries.iteritems()
+            },
+        }
+        write_sidecar_file(os.path.join(self.docpath, self.FILENAME),
+                           json.dumps(content), "page geometry cache")
+
+    def __refresh(self):
+        """
+        Check all the entries at once, so the sidecar file is rewritten only
+        once even if many images have changed
+        """
+        changed = False
+        filenames = self.get_filenames()
+        for filename in self.__entries.keys():
+            if filename not in filenames:
+                # page removed
+                self.__entries.pop(filename)
+                self.__checked.discard(filename)
+                changed = True
+        for filename in filenames:
+            path = os.path.join(self.docpath, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = self.__entries.get(filename)
+            if (entry is None or entry[0] != stat.st_size or
+                    entry[1] != stat.st_mtime):
+                try:
+                    geometry = PageGeometry.from_file(path)
+                except IOError, exc:
+                    logger.warning("Unable to read %s: %s" % (path, exc))
+                    continue
+                self.__entries[filename] = [stat.st_size, stat.st_mtime,
+                                            geometry]
+                changed = True
+            self.__checked.add(filename)
+        if changed:
+            self.__write()
+
+    def get(self, filename):
+        """
+        Returns:
+            The PageGeometry of the given image of the document
+
+        Raises:
+            IOError/OSError if the image can't be read
+        """
+        with self.__lock:
+            if self.__entries is None:
+                self.__load()
+            if filename not in self.__checked:
+                self.__refresh()
+            if filename not in self.__checked:
+                # not a known page image
+                return PageGeometry.from_file(
+                    os.path.join(self.docpath, filename))
+            return self.__entries[filename][2]
+
+    def set(self, filename, img):
+        """
+        Record the geometry of an image that has just been written
+        """
+        with self.__lock:
+            if self.__entries is None:
+                self.__load()
+            stat = os.stat(os.path.join(self.docpath, filename))
+            self.__entries[filename] = [stat.st_size, stat.st_mtime,
+                                        PageGeometry.from_img(img)]
+            self.__checked.add(filename)
+            self.__write()
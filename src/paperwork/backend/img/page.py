@@ -28,6 +28,8 @@ import logging
 import pyocr
 import pyocr.builders
 
+from paperwork.backend.common.boxstore import BoxStore
+from paperwork.backend.common.boxstore import load_boxes
 from paperwork.backend.common.page import BasicPage
 from paperwork.backend.util import image2surface
 
@@ -43,6 +45,7 @@ class ImgPage(BasicPage):
 
     FILE_PREFIX = "paper."
     EXT_BOX = "words"
+    EXT_BOX_STORE = "boxes"
     EXT_IMG = "jpg"
 
     KEYWORD_HIGHLIGHT = 3
@@ -63,6 +66,17 @@ class ImgPage(BasicPage):
 
     __box_path = property(__get_box_path)
 
+    def __get_box_store_path(self):
+        """
+        Returns the file path of the binary copy of the box list (see
+        boxstore.BoxStore)
+        """
+        return self._get_filepath(self.EXT_BOX_STORE)
+
+    @staticmethod
+    def get_img_filename(page_nb):
+        return "%s%d.%s" % (ImgPage.FILE_PREFIX, page_nb + 1, ImgPage.EXT_IMG)
+
     def __get_img_path(self):
         """
         Returns the file path of the image corresponding to this page
@@ -75,6 +89,9 @@ class ImgPage(BasicPage):
         """
         return self.__get_img_path()
 
+    def _get_thumbnail_source(self):
+        return self.__get_img_path()
+
     __img_path = property(__get_img_path)
 
     def __get_last_mod(self):
@@ -89,36 +106,21 @@ class ImgPage(BasicPage):
         """
         Get the text corresponding to this page
         """
-        boxes = self.boxes
-        txt = []
-        for line in boxes:
-            txt_line = u""
-            for box in line.word_boxes:
-                txt_line += u" " + box.content
-            txt.append(txt_line)
-        return txt
+        try:
+            return load_boxes(self.__box_path, self.__get_box_store_path(),
+                              with_objects=False)
+        except (IOError, OSError), exc:
+            logger.error("Unable to get boxes for '%s': %s"
+                         % (self.doc.docid, exc))
+            return []
 
     def __get_boxes(self):
         """
         Get all the word boxes of this page.
         """
-        boxfile = self.__box_path
-
         try:
-            box_builder = pyocr.builders.LineBoxBuilder()
-            with codecs.open(boxfile, 'r', encoding='utf-8') as file_desc:
-                boxes = box_builder.read_file(file_desc)
-            if boxes != []:
-                return boxes
-            # fallback: old format: word boxes
-            # shouldn't be used anymore ...
-            logger.warning("WARNING: Doc %s uses old box format" %
-                           (str(self.doc)))
-            box_builder = pyocr.builders.WordBoxBuilder()
-            with codecs.open(boxfile, 'r', encoding='utf-8') as file_desc:
-                boxes = box_builder.read_file(file_desc)
-            return boxes
-        except IOError, exc:
+            return load_boxes(self.__box_path, self.__get_box_store_path())
+        except (IOError, OSError), exc:
             logger.error("Unable to get boxes for '%s': %s"
                          % (self.doc.docid, exc))
             return []
@@ -127,6 +129,7 @@ class ImgPage(BasicPage):
         boxfile = self.__box_path
         with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
             pyocr.builders.LineBoxBuilder().write_file(file_desc, boxes)
+        BoxStore.write(self.__get_box_store_path(), boxes, os.stat(boxfile))
         self.drop_cache()
         self.doc.drop_cache()
 
@@ -140,12 +143,34 @@ class ImgPage(BasicPage):
 
     def __set_img(self, img):
         img.save(self.__img_path)
+        self.doc.get_geometry().set(self.get_img_filename(self.page_nb), img)
         self.drop_cache()
 
     img = property(__get_img, __set_img)
 
+    def get_image(self, width, height):
+        img = PIL.Image.open(self.__img_path)
+        if img.format == "JPEG":
+            # DCT scaling: the JPEG decoder can decode the image directly at
+            # 1/2, 1/4 or 1/8 of its size. draft() picks the smallest scale
+            # that still gives an image at least as big as requested.
+            img.draft("RGB", (width, height))
+        return img
+
+    def __get_geometry(self):
+        """
+        Returns:
+            The size, DPI and orientation of the page (see
+            geometry.PageGeometry). Doesn't open the image if it is already
+            known.
+        """
+        return self.doc.get_geometry().get(
+            self.get_img_filename(self.page_nb))
+
+    geometry = property(__get_geometry)
+
     def __get_size(self):
-        return self.img.size
+        return self.geometry.size
 
     size = property(__get_size)
 
@@ -201,8 +226,10 @@ class ImgPage(BasicPage):
         """
         src = {}
         src["box"] = self.__get_box_path()
+        src["box_store"] = self.__get_box_store_path()
         src["img"] = self.__get_img_path()
-        src["thumb"] = self._get_thumb_path()
+        for (idx, path) in enumerate(self._get_thumb_paths()):
+            src["thumb%d" % idx] = path
 
         page_nb = self.page_nb
 
@@ -215,8 +242,10 @@ class ImgPage(BasicPage):
 
         dst = {}
         dst["box"] = self.__get_box_path()
+        dst["box_store"] = self.__get_box_store_path()
         dst["img"] = self.__get_img_path()
-        dst["thumb"] = self._get_thumb_path()
+        for (idx, path) in enumerate(self._get_thumb_paths()):
+            dst["thumb%d" % idx] = path
 
         for key in src.keys():
             if os.access(src[key], os.F_OK):
@@ -238,9 +267,9 @@ class ImgPage(BasicPage):
         current_doc_nb_pages = self.doc.nb_pages
         paths = [
             self.__get_box_path(),
+            self.__get_box_store_path(),
             self.__get_img_path(),
-            self._get_thumb_path(),
-        ]
+        ] + self._get_thumb_paths()
         for path in paths:
             if os.access(path, os.F_OK):
                 os.unlink(path)
@@ -262,8 +291,14 @@ class ImgPage(BasicPage):
         to_move = [
             (other_page.__get_box_path(), self.__get_box_path()),
             (other_page.__get_img_path(), self.__get_img_path()),
-            (other_page._get_thumb_path(), self._get_thumb_path())
         ]
+        for (src, dst) in zip(other_page._get_thumb_paths(),
+                              self._get_thumb_paths()):
+            if os.access(src, os.F_OK):
+                to_move.append((src, dst))
+        if os.access(other_page.__get_box_store_path(), os.F_OK):
+            to_move.append((other_page.__get_box_store_path(),
+                            self.__get_box_store_path()))
         for (src, dst) in to_move:
             # sanity check
             if os.access(dst, os.F_OK):
@@ -17,33 +17,175 @@
 """
 Code to manage document labels
 """
+import logging
 import os
+import threading
+import weakref
 
-from gi.repository import Gdk
 import simplebayes
 
 from paperwork.backend.util import mkdir_p
 from paperwork.backend.util import strip_accents
 
 
+logger = logging.getLogger(__name__)
+
+
+def _parse_hex_channel(value):
+    """
+    Expand a channel of an hexadecimal color (1 to 4 digits) to 16 bits,
+    the same way Pango does.
+    """
+    bits = len(value) * 4
+    channel = int(value, 16) << (16 - bits)
+    while bits < 16:
+        channel |= (channel >> bits)
+        bits *= 2
+    return channel / 65535.0
+
+
+def _parse_rgb_channel(value):
+    value = value.strip()
+    if value.endswith("%"):
+        channel = float(value[:-1]) / 100.0
+    else:
+        channel = float(value) / 255.0
+    return min(max(channel, 0.0), 1.0)
+
+
+def parse_color(color):
+    """
+    Parse a color string, as written in the label files. Understands the
+    same notations than Gdk.RGBA.parse(): '#rgb', '#rrggbb', '#rrrgggbbb',
+    '#rrrrggggbbbb', 'rgb(r,g,b)' and 'rgba(r,g,b,a)'.
+
+    Returns:
+        (red, green, blue, alpha), each between 0.0 and 1.0
+
+    Raises:
+        ValueError if the string can't be parsed
+    """
+    color = color.strip()
+    if color.startswith("#"):
+        digits = color[1:]
+        if len(digits) not in (3, 6, 9, 12):
+            raise ValueError("Invalid color: %s" % color)
+        step = len(digits) / 3
+        return (_parse_hex_channel(digits[0:step]),
+                _parse_hex_channel(digits[step:2 * step]),
+                _parse_hex_channel(digits[2 * step:]),
+                1.0)
+    lower = color.lower()
+    for (prefix, nb_values) in (("rgba(", 4), ("rgb(", 3)):
+        if not lower.startswith(prefix) or not lower.endswith(")"):
+            continue
+        values = color[len(prefix):-1].split(",")
+        if len(values) != nb_values:
+            raise ValueError("Invalid color: %s" % color)
+        alpha = 1.0
+        if nb_values == 4:
+            alpha = min(max(float(values.pop()), 0.0), 1.0)
+        return tuple([_parse_rgb_channel(value) for value in values] +
+                     [alpha])
+    raise ValueError("Invalid color: %s" % color)
+
+
+def format_color(rgba):
+    """
+    Returns:
+        The string representation of the color, as Gdk.RGBA.to_string()
+        would have returned it.
+    """
+    (red, green, blue) = [int(0.5 + (channel * 255))
+                          for channel in rgba[:3]]
+    if rgba[3] > 0.999:
+        return "rgb(%d,%d,%d)" % (red, green, blue)
+    return "rgba(%d,%d,%d,%g)" % (red, green, blue, rgba[3])
+
+
 class Label(object):
 
     """
     Represents a Label (color + string).
+
+    Labels are plain data: the color is kept as a (red, green, blue, alpha)
+    tuple and the key used to sort them is computed once, when the name or
+    the color is set.
     """
 
+    # (name, color string) --> Label. See Label.intern().
+    __registry = weakref.WeakValueDictionary()
+    __registry_lock = threading.Lock()
+
     def __init__(self, name=u"", color="#000000000000"):
         """
         Arguments:
             name --- label name
             color --- label color (string representation, see get_color_str())
         """
+        self.__name = u""
+        self.__rgba = (0.0, 0.0, 0.0, 1.0)
+        self.__color_str = format_color(self.__rgba)
+        self.name = name
+        self.color = color
+
+    @staticmethod
+    def intern(name, color):
+        """
+        Returns:
+            A label instance shared with all the other documents having the
+            same label. Shared instances must not be modified (use copy.copy()
+            first).
+        """
+        if type(name) != unicode:
+            name = unicode(name, encoding='utf-8')
+        key = (name, color)
+        with Label.__registry_lock:
+            label = Label.__registry.get(key)
+            if label is not None:
+                return label
+            label = Label(name, color)
+            # the same color may be written differently
+            label = Label.__registry.setdefault(
+                (name, label.get_color_str()), label)
+            Label.__registry[key] = label
+            return label
+
+    def __get_name(self):
+        return self.__name
+
+    def __set_name(self, name):
         if type(name) == unicode:
-            self.name = name
+            self.__name = name
         else:
-            self.name = unicode(name, encoding='utf-8')
-        self.color = Gdk.RGBA()
-        self.color.parse(color)
+            self.__name = unicode(name, encoding='utf-8')
+        self.__update_sort_key()
+
+    name = property(__get_name, __set_name)
+
+    def __get_color(self):
+        return self.__color_str
+
+    def __set_color(self, color):
+        try:
+            self.__rgba = parse_color(color)
+        except ValueError, exc:
+            logger.warning("Label '%s': %s. Using black instead"
+                           % (self.__name, exc))
+            self.__rgba = (0.0, 0.0, 0.0, 1.0)
+        self.__color_str = format_color(self.__rgba)
+        self.__update_sort_key()
+
+    color = property(__get_color, __set_color)
+
+    def __get_rgba(self):
+        return self.__rgba
+
+    rgba = property(__get_rgba)
+
+    def __update_sort_key(self):
+        self.sort_key = (strip_accents(self.__name).lower(),
+                         self.__color_str)
 
     def __copy__(self):
         return Label(self.name, self.get_color_str())
@@ -54,12 +196,9 @@ class Label(object):
         """
         if other is None:
             return -1
-        label_name = strip_accents(self.name).lower()
-        other_name = strip_accents(other.name).lower()
-        cmp_r = cmp(label_name, other_name)
-        if cmp_r != 0:
-            return cmp_r
-        return cmp(self.get_color_str(), other.get_color_str())
+        if other is self:
+            return 0
+        return cmp(self.sort_key, other.sort_key)
 
     def __lt__(self, other):
         return self.__label_cmp(other) < 0
@@ -86,14 +225,15 @@ class Label(object):
         """
         get a string representing the color, using HTML notation
         """
-        return ("#%02x%02x%02x" % (self.color.red, self.color.green,
-                                   self.color.blue))
+        return ("#%02x%02x%02x"
+                % tuple([int(0.5 + (channel * 255))
+                         for channel in self.__rgba[:3]]))
 
     def get_color_str(self):
         """
         Returns a string representation of the color associated to this label.
         """
-        return self.color.to_string()
+        return self.__color_str
 
     def get_html(self):
         """
@@ -113,7 +253,7 @@ class Label(object):
             return (1.0, 1.0, 1.0)  # white
 
     def get_rgb_bg(self):
-        return (self.color.red, self.color.green, self.color.blue)
+        return self.__rgba[:3]
 
     def __str__(self):
         return ("Color: %s ; Text: %s"
@@ -125,7 +265,11 @@ class LabelGuessUpdater(object):
         self.guesser = guesser
         self.updated_docs = set()
 
-    def _get_doc_txt(self, doc):
+    @staticmethod
+    def get_doc_txt(doc):
+        """
+        Returns the text of the document used to train the label guesser
+        """
         if doc.nb_pages <= 0:
             return u""
         if not doc.can_edit:
@@ -133,13 +277,21 @@ class LabelGuessUpdater(object):
             return doc.text.strip()
         # document is added page per page --> the first page only
         # is used for evaluation
-        txt = doc.pages[0].text
-        txt = u"\n".join(txt)
-        txt = txt.strip()
-        return txt
-
-    def add_doc(self, doc):
-        doc_txt = self._get_doc_txt(doc)
+        text_cache = doc.get_text_cache(build=False)
+        if text_cache is not None and text_cache.nb_pages > 0:
+            return text_cache.get_page_text(0).strip()
+        # the text of the other pages isn't required: no need to extract it
+        # (same format as DocTextCache)
+        lines = [unicode(line).strip() for line in doc.pages[0]._get_text()]
+        return u"\n".join(lines).strip()
+
+    def add_doc(self, doc, doc_txt=None):
+        """
+        Arguments:
+            doc_txt --- result of get_doc_txt(doc), if already known
+        """
+        if doc_txt is None:
+            doc_txt = self.get_doc_txt(doc)
         if doc_txt == u"":
             return
         doc_txt = doc_txt.encode("utf-8")
@@ -156,8 +308,54 @@ class LabelGuessUpdater(object):
 
         self.updated_docs.add(doc)
 
-    def upd_doc(self, doc):
-        doc_txt = self._get_doc_txt(doc)
+    def add_docs(self, docs):
+        """
+        Train the label guesser with many new documents at once. Each label
+        is trained only twice ("yes" and "no"), with the text of all the
+        documents, instead of once per document.
+
+        Arguments:
+            docs --- list of (doc, doc_txt). doc_txt is the result of
+                get_doc_txt(doc), or None if not known yet
+        """
+        docs_txt = []
+        all_labels = set()
+        for (doc, doc_txt) in docs:
+            if doc_txt is None:
+                doc_txt = self.get_doc_txt(doc)
+            if doc_txt == u"":
+                continue
+            labels = {label.name for label in doc.labels}
+            all_labels.update(labels)
+            docs_txt.append((labels, doc_txt.encode("utf-8")))
+            self.updated_docs.add(doc)
+
+        if len(docs_txt) <= 0:
+            return
+
+        # just in case, make sure all the labels are loaded
+        for label in all_labels:
+            self.guesser.load(label)
+
+        for (label, guesser) in self.guesser._bayes.iteritems():
+            # the texts are split on whitespaces: training with all of them
+            # joined is the same as training with each one of them
+            yes_txt = "\n".join([doc_txt for (labels, doc_txt) in docs_txt
+                                 if label in labels])
+            no_txt = "\n".join([doc_txt for (labels, doc_txt) in docs_txt
+                                if label not in labels])
+            if yes_txt != "":
+                guesser.train("yes", yes_txt)
+            if no_txt != "":
+                guesser.train("no", no_txt)
+
+    def upd_doc(self, doc, doc_txt=None):
+        """
+        Arguments:
+            doc_txt --- result of get_doc_txt(doc), if already known
+        """
+        if doc_txt is None:
+            doc_txt = self.get_doc_txt(doc)
         if doc_txt == u"":
             return
         doc_txt = doc_txt.encode("utf-8")
@@ -186,7 +384,7 @@ class LabelGuessUpdater(object):
             guesser.train("no", doc_txt)
 
     def del_doc(self, doc):
-        doc_txt = self._get_doc_txt(doc)
+        doc_txt = self.get_doc_txt(doc)
         if doc_txt == u"":
             return
         doc_txt = doc_txt.encode("utf-8")
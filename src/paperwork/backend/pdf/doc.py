@@ -14,6 +14,7 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import os
 import shutil
 import logging
@@ -21,10 +22,13 @@ import urllib
 
 from gi.repository import GLib
 from gi.repository import Gio
-from gi.repository import Poppler
 
+from paperwork.backend.common.dirsnapshot import DocDirSnapshot
 from paperwork.backend.common.doc import BasicDoc
+from paperwork.backend.pdf.metadata import PdfMetadata
 from paperwork.backend.pdf.page import PdfPage
+from paperwork.backend.pdf.pool import forget_pdf
+from paperwork.backend.pdf.pool import get_pdf
 
 
 PDF_FILENAME = "doc.pdf"
@@ -77,20 +81,23 @@ class PdfPagesIterator(object):
 
 
 class PdfPages(object):
-    def __init__(self, pdfdoc, pdf):
+    """
+    Page objects of a PDF document. Kept by the document as long as it
+    lives, so the page objects (and what they cache) are reused.
+    """
+    def __init__(self, pdfdoc):
         self.pdfdoc = pdfdoc
-        self.pdf = pdf
         self.page = {}
 
     def __getitem__(self, idx):
         if idx < 0:
-            idx = self.pdf.get_n_pages() + idx
+            idx = self.pdfdoc.nb_pages + idx
         if idx not in self.page:
-            self.page[idx] = PdfPage(self.pdfdoc, self.pdf, idx)
+            self.page[idx] = PdfPage(self.pdfdoc, idx)
         return self.page[idx]
 
     def __len__(self):
-        return self.pdf.get_n_pages()
+        return self.pdfdoc.nb_pages
 
     def __iter__(self):
         return PdfPagesIterator(self.pdfdoc)
@@ -100,53 +107,111 @@ class PdfDoc(BasicDoc):
     can_edit = False
     doctype = u"PDF"
 
-    def __init__(self, docpath, docid=None):
-        BasicDoc.__init__(self, docpath, docid)
-        self._pdf = None
+    def __init__(self, docpath, docid=None, cache=None):
+        BasicDoc.__init__(self, docpath, docid, cache)
+        self.__pages = None
+        self.__metadata = None  # (PDF key, PdfMetadata)
 
     def clone(self):
         return PdfDoc(self.path, self.docid)
 
-    def __get_last_mod(self):
-        pdfpath = os.path.join(self.path, PDF_FILENAME)
-        last_mod = os.stat(pdfpath).st_mtime
-        for page in self.pages:
-            if page.last_mod > last_mod:
-                last_mod = page.last_mod
-        labels_path = os.path.join(self.path, BasicDoc.LABEL_FILE)
-        try:
-            file_last_mod = os.stat(labels_path).st_mtime
-            if file_last_mod > last_mod:
-                last_mod = file_last_mod
-        except OSError:
-            pass
-        extra_txt_path = os.path.join(self.path, BasicDoc.EXTRA_TEXT_FILE)
-        try:
-            file_last_mod = os.stat(extra_txt_path).st_mtime
-            if file_last_mod > last_mod:
-                last_mod = file_last_mod
-        except OSError:
-            pass
-
-        return last_mod
-
-    last_mod = property(__get_last_mod)
+    def _get_last_mod(self):
+        snapshot = self.get_snapshot()
+        last_mod = snapshot.get_mtime(PDF_FILENAME)
+        if last_mod is None:
+            raise OSError(errno.ENOENT, "%s not found"
+                          % os.path.join(self.path, PDF_FILENAME))
+        # box files of the pages: no need to open the PDF file to know how
+        # many pages there are
+        filenames = [
+            filename for filename in snapshot.filenames
+            if filename.endswith("." + PdfPage.EXT_BOX)
+        ]
+        filenames += [BasicDoc.LABEL_FILE, BasicDoc.EXTRA_TEXT_FILE]
+        return snapshot.get_last_mod(filenames, last_mod)
+
+    def _get_thumbnail_source_filename(self):
+        return PDF_FILENAME
 
     def get_pdf_file_path(self):
         return ("%s/%s" % (self.path, PDF_FILENAME))
 
+    def get_pdf_key(self):
+        """
+        Returns:
+            (PDF file path, mtime): identifies the content of the PDF file
+            in the process-wide caches
+        """
+        return (self.get_pdf_file_path(),
+                self.get_snapshot().get_mtime(PDF_FILENAME))
+
     def _open_pdf(self):
-        if self._pdf:
-            return self._pdf
-        self._pdf = Poppler.Document.new_from_file(
-            ("file://%s/%s" % (urllib.quote(self.path), PDF_FILENAME)),
-            password=None)
-        return self._pdf
+        """
+        The Poppler document comes from the process-wide pool (see
+        pdf.pool): don't keep a reference on it.
+
+        Raises:
+            OSError if the PDF file doesn't exist
+        """
+        (path, mtime) = self.get_pdf_key()
+        if mtime is None:
+            raise OSError(errno.ENOENT, "%s not found" % path)
+        return get_pdf(path, mtime)
 
     pdf = property(_open_pdf)
 
+    def get_metadata(self):
+        """
+        Returns:
+            The page count and page sizes of the PDF file, and the page
+            texts if they have already been extracted (see
+            metadata.PdfMetadata and get_page_text()). Poppler is only used
+            if the metadata sidecar file is missing or out of date.
+
+        Raises:
+            OSError if the PDF file doesn't exist
+        """
+        pdf_key = self.get_pdf_key()
+        if self.__metadata is not None and self.__metadata[0] == pdf_key:
+            return self.__metadata[1]
+        pdf_stat = self.get_snapshot().stat(PDF_FILENAME)
+        if pdf_stat is None:
+            raise OSError(errno.ENOENT, "%s not found"
+                          % self.get_pdf_file_path())
+        metadata = PdfMetadata.load(self.path, pdf_stat)
+        if metadata is None:
+            logger.info("Extracting the metadata of %s" % self.docid)
+            metadata = PdfMetadata.from_pdf(self.pdf)
+            metadata.write(self.path, pdf_stat)
+        self.__metadata = (pdf_key, metadata)
+        return metadata
+
+    def get_page_text(self, page_nb):
+        """
+        Returns:
+            The text of the page, as extracted by Poppler. The texts of all
+            the pages are extracted the first time one of them is requested
+            (usually when indexing the document), and then kept in the
+            metadata sidecar file.
+
+        Raises:
+            OSError if the PDF file doesn't exist
+        """
+        metadata = self.get_metadata()
+        page_texts = metadata.page_texts
+        if page_texts is None:
+            logger.info("Extracting the text of %s" % self.docid)
+            metadata.extract_texts(self.pdf)
+            page_texts = metadata.page_texts
+            pdf_stat = self.get_snapshot().stat(PDF_FILENAME)
+            if pdf_stat is not None:
+                metadata.write(self.path, pdf_stat)
+        return page_texts[page_nb]
+
     def __get_pages(self):
-        return PdfPages(self, self.pdf)
+        if self.__pages is None:
+            self.__pages = PdfPages(self)
+        return self.__pages
 
     pages = property(__get_pages)
 
@@ -154,8 +219,12 @@ class PdfDoc(BasicDoc):
         if self.is_new:
             # happens when a doc was recently deleted
             return 0
-        nb_pages = self.pdf.get_n_pages()
-        return nb_pages
+        try:
+            return self.get_metadata().nb_pages
+        except OSError, exc:
+            logger.warning("Unable to get the page count of %s: %s"
+                           % (self.docid, exc))
+            return 0
 
     def print_page_cb(self, print_op, print_context, page_nb, keep_refs={}):
         """
@@ -177,6 +246,11 @@ class PdfDoc(BasicDoc):
         f.copy(dest,
                0,  # TODO(Jflesch): Missing flags: don't keep attributes
                None, None, None)
+        self.drop_cache()
+        # the document is about to be displayed: extract its page count and
+        # page sizes right away. The page texts are extracted when indexing
+        # it.
+        self.get_metadata()
 
     @staticmethod
     def get_export_formats():
@@ -185,23 +259,29 @@ class PdfDoc(BasicDoc):
     def build_exporter(self, file_format='pdf'):
         return PdfDocExporter(self)
 
+    def destroy(self):
+        (path, mtime) = self.get_pdf_key()
+        forget_pdf(path, mtime)
+        BasicDoc.destroy(self)
+        self.__pages = None
+
     def drop_cache(self):
         BasicDoc.drop_cache(self)
-        if self._pdf:
-            del self._pdf
-        self._pdf = None
+        # the PDF file itself is never modified: the page objects remain
+        # valid, only what they have read from the other files is dropped
+        if self.__pages is not None:
+            for page in self.__pages.page.values():
+                page.drop_cache()
 
     def get_docfilehash(self):
         return BasicDoc.hash_file("%s/%s" % (self.path, PDF_FILENAME))
 
 
-def is_pdf_doc(docpath):
-    if not os.path.isdir(docpath):
-        return False
-    try:
-        filelist = os.listdir(docpath)
-    except OSError, exc:
-        logger.exception("Warning: Failed to list files in %s: %s"
-                         % (docpath, str(exc)))
-        return False
-    return PDF_FILENAME in filelist
+def is_pdf_doc(docpath, snapshot=None):
+    """
+    Arguments:
+        snapshot --- DocDirSnapshot of docpath, if already available
+    """
+    if snapshot is None:
+        snapshot = DocDirSnapshot(docpath)
+    return PDF_FILENAME in snapshot
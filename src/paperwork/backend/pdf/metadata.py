@@ -0,0 +1,130 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Metadata of the PDF documents.
+
+The number of pages, the size of each page and the text of each page are
+extracted from the PDF file once, and stored in a sidecar file in the
+document directory, along with the size and mtime of the PDF file. As long
+as they don't change, examining and indexing the document doesn't require
+opening the PDF file with Poppler.
+
+The page count and sizes are required as soon as the pages are displayed,
+so they are extracted first. The texts are only extracted when they are
+requested (usually when indexing the document).
+"""
+
+import json
+import logging
+import os
+
+from paperwork.backend.util import write_sidecar_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class PdfMetadata(object):
+    FILENAME = "pdf.cache"
+    VERSION = 1
+
+    def __init__(self, page_sizes, page_texts=None):
+        """
+        Arguments:
+            page_sizes --- (width, height) of each page, in PDF points
+            page_texts --- text of each page, as returned by Poppler. None
+                if they haven't been extracted yet (see extract_texts())
+        """
+        self.page_sizes = page_sizes
+        self.page_texts = page_texts
+
+    def __get_nb_pages(self):
+        return len(self.page_sizes)
+
+    nb_pages = property(__get_nb_pages)
+
+    @staticmethod
+    def from_pdf(pdf):
+        """
+        Only the page count and sizes are extracted (see extract_texts())
+
+        Arguments:
+            pdf --- Poppler.Document
+        """
+        page_sizes = []
+        for page_nb in xrange(0, pdf.get_n_pages()):
+            (width, height) = pdf.get_page(page_nb).get_size()
+            page_sizes.append((width, height))
+        return PdfMetadata(page_sizes)
+
+    def extract_texts(self, pdf):
+        """
+        Extract the text of all the pages
+
+        Arguments:
+            pdf --- Poppler.Document
+        """
+        page_texts = []
+        for page_nb in xrange(0, self.nb_pages):
+            txt = pdf.get_page(page_nb).get_text()
+            if txt is None:
+                txt = u""
+            elif not isinstance(txt, unicode):
+                txt = unicode(txt, encoding='utf-8')
+            page_texts.append(txt)
+        self.page_texts = page_texts
+
+    @staticmethod
+    def load(docpath, pdf_stat):
+        """
+        Arguments:
+            pdf_stat --- os.stat() of the PDF file the metadata must match
+
+        Returns:
+            The metadata of the document, or None if they are missing or out
+            of date
+        """
+        path = os.path.join(docpath, PdfMetadata.FILENAME)
+        try:
+            with open(path, 'rb') as file_desc:
+                content = json.load(file_desc)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            if (content['version'] != PdfMetadata.VERSION or
+                    content['pdf'] != [pdf_stat.st_size,
+                                       pdf_stat.st_mtime]):
+                return None
+            page_sizes = [tuple(size) for size in content['page_sizes']]
+            page_texts = content['page_texts']
+            if page_texts is not None and len(page_sizes) != len(page_texts):
+                return None
+            return PdfMetadata(page_sizes, page_texts)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def write(self, docpath, pdf_stat):
+        """
+        Store the metadata in the document directory
+        """
+        content = {
+            'version': self.VERSION,
+            'pdf': [pdf_stat.st_size, pdf_stat.st_mtime],
+            'page_sizes': self.page_sizes,
+            'page_texts': self.page_texts,
+        }
+        write_sidecar_file(os.path.join(docpath, self.FILENAME),
+                           json.dumps(content), "PDF metadata cache")
@@ -21,7 +21,10 @@ import logging
 import pyocr
 import pyocr.builders
 
+from paperwork.backend.common.boxstore import BoxStore
+from paperwork.backend.common.boxstore import load_boxes
 from paperwork.backend.common.page import BasicPage
+from paperwork.backend.pdf.rendercache import get_rendering
 from paperwork.backend.util import split_words
 from paperwork.backend.util import surface2image
 
@@ -32,44 +35,138 @@ PDF_RENDER_FACTOR = 2
 logger = logging.getLogger(__name__)
 
 
+def _get_box_position(area):
+    """
+    Arguments:
+        area --- [x1, y1, x2, y2], in PDF points, from the top left of the
+            page
+
+    Returns:
+        The position of the box on the rendered page
+    """
+    return ((int(area[0] * PDF_RENDER_FACTOR),
+             int(area[1] * PDF_RENDER_FACTOR)),
+            (int(area[2] * PDF_RENDER_FACTOR),
+             int(area[3] * PDF_RENDER_FACTOR)))
+
+
 class PdfWordBox(object):
-    def __init__(self, content, rectangle, pdf_size):
+    def __init__(self, content, area):
         self.content = content
-        # XXX(Jflesch): Coordinates seem to come from the bottom left of the
-        # page instead of the top left !?
-        self.position = ((int(rectangle.x1 * PDF_RENDER_FACTOR),
-                          int((pdf_size[1] - rectangle.y2)
-                              * PDF_RENDER_FACTOR)),
-                         (int(rectangle.x2 * PDF_RENDER_FACTOR),
-                          int((pdf_size[1] - rectangle.y1)
-                              * PDF_RENDER_FACTOR)))
+        self.position = _get_box_position(area)
 
 
 class PdfLineBox(object):
-    def __init__(self, word_boxes, rectangle, pdf_size):
+    def __init__(self, word_boxes, area):
         self.word_boxes = word_boxes
-        # XXX(Jflesch): Coordinates seem to come from the bottom left of the
-        # page instead of the top left !?
-        self.position = ((int(rectangle.x1 * PDF_RENDER_FACTOR),
-                          int((pdf_size[1] - rectangle.y2)
-                              * PDF_RENDER_FACTOR)),
-                         (int(rectangle.x2 * PDF_RENDER_FACTOR),
-                          int((pdf_size[1] - rectangle.y1)
-                              * PDF_RENDER_FACTOR)))
+        self.position = _get_box_position(area)
+
+
+def _merge_areas(area, other):
+    if area is None:
+        return list(other)
+    return [min(area[0], other[0]), min(area[1], other[1]),
+            max(area[2], other[2]), max(area[3], other[3])]
+
+
+def get_find_text_boxes(pdf_page, txt):
+    """
+    Build the boxes of a page by looking for each of its words with
+    find_text(). Much slower than get_text_layout_boxes(), and each word
+    ends up in a line of its own.
+
+    Returns:
+        A list of PdfLineBox
+    """
+    pdf_size = pdf_page.get_size()
+    words = set()
+    boxes = []
+    for line in txt.split(u"\n"):
+        for word in split_words(line):
+            words.add(word)
+    for word in words:
+        for rect in pdf_page.find_text(word):
+            # XXX(Jflesch): Coordinates seem to come from the bottom left of
+            # the page instead of the top left !?
+            area = (rect.x1, pdf_size[1] - rect.y2,
+                    rect.x2, pdf_size[1] - rect.y1)
+            word_box = PdfWordBox(word, area)
+            boxes.append(PdfLineBox([word_box], area))
+    return boxes
+
+
+def get_text_layout_boxes(pdf_page):
+    """
+    Build the line boxes of a page from the text layout Poppler gives (one
+    rectangle per character of the page text), in a single pass. If the
+    layout doesn't match the text, fall back on get_find_text_boxes().
+
+    Returns:
+        A list of PdfLineBox
+    """
+    txt = unicode(pdf_page.get_text(), encoding='utf-8')
+    layout = pdf_page.get_text_layout()
+    if isinstance(layout, tuple):
+        (has_layout, layout) = layout
+        if not has_layout:
+            layout = []
+    if len(layout) != len(txt):
+        # the characters can't be matched with their rectangles
+        logger.warning("PDF text layout doesn't match the text"
+                       " (%d rectangles, %d characters). Looking for each"
+                       " word instead" % (len(layout), len(txt)))
+        return get_find_text_boxes(pdf_page, txt)
+
+    lines = []
+    words = []
+    word = []
+    word_area = None
+    line_area = None
+    # a line return at the end flushes the last line
+    for (char, rect) in zip(txt, layout) + [(u"\n", None)]:
+        if not char.isspace():
+            word.append(char)
+            word_area = _merge_areas(word_area,
+                                     (rect.x1, rect.y1, rect.x2, rect.y2))
+            continue
+        if word:
+            words.append(PdfWordBox(u"".join(word), word_area))
+            line_area = _merge_areas(line_area, word_area)
+            word = []
+            word_area = None
+        if char == u"\n" and words:
+            lines.append(PdfLineBox(words, line_area))
+            words = []
+            line_area = None
+    return lines
 
 
 class PdfPage(BasicPage):
     EXT_TXT = "txt"
     EXT_BOX = "words"
+    EXT_BOX_STORE = "boxes"
+    EXT_LAYOUT_STORE = "layout.boxes"
 
-    def __init__(self, doc, pdf, page_nb):
+    def __init__(self, doc, page_nb):
         BasicPage.__init__(self, doc, page_nb)
-        self.pdf_page = pdf.get_page(page_nb)
-        assert(self.pdf_page is not None)
-        size = self.pdf_page.get_size()
+        size = doc.get_metadata().page_sizes[page_nb]
         self._size = (int(size[0]), int(size[1]))
         self.__boxes = None
-        self.__img_cache = {}
+
+    def __get_pdf_page(self):
+        """
+        Don't keep a reference on the Poppler page: it would keep the whole
+        Poppler document open (see pdf.pool)
+        """
+        pdf_page = self.doc.pdf.get_page(self.page_nb)
+        assert(pdf_page is not None)
+        return pdf_page
+
+    pdf_page = property(__get_pdf_page)
+
+    def drop_cache(self):
+        BasicPage.drop_cache(self)
+        self.__boxes = None
 
     def get_doc_file_path(self):
         """
@@ -83,6 +180,12 @@ class PdfPage(BasicPage):
     def __get_box_path(self):
         return self._get_filepath(self.EXT_BOX)
 
+    def __get_box_store_path(self):
+        return self._get_filepath(self.EXT_BOX_STORE)
+
+    def __get_layout_store_path(self):
+        return self._get_filepath(self.EXT_LAYOUT_STORE)
+
     def __get_last_mod(self):
         try:
             return os.stat(self.__get_box_path()).st_mtime
@@ -112,21 +215,23 @@ class PdfPage(BasicPage):
 
         boxfile = self.__get_box_path()
         try:
-            os.stat(boxfile)
-
             # reassemble text based on boxes
-            boxes = self.boxes
-            txt = []
-            for line in boxes:
-                txt_line = u""
-                for box in line.word_boxes:
-                    txt_line += u" " + box.content
-                txt.append(txt_line)
-            return txt
+            return load_boxes(boxfile, self.__get_box_store_path(),
+                              with_objects=False)
+        except IOError, exc:
+            logger.error("Unable to get boxes for '%s': %s"
+                         % (self.doc.docid, exc))
+            return []
+        except OSError, exc:  # os.stat() failed
+            pass
+
+        try:
+            txt = self.doc.get_page_text(self.page_nb)
         except OSError, exc:
-            txt = self.pdf_page.get_text()
-            txt = unicode(txt, encoding='utf-8')
-            return txt.split(u"\n")
+            logger.error("Unable to get the text of '%s': %s"
+                         % (self.doc.docid, exc))
+            return []
+        return txt.split(u"\n")
 
     def __get_boxes(self):
         """
@@ -138,71 +243,93 @@ class PdfPage(BasicPage):
         # Check first if there is an OCR file available
         boxfile = self.__get_box_path()
         try:
-            os.stat(boxfile)
-
-            box_builder = pyocr.builders.LineBoxBuilder()
-
-            try:
-                with codecs.open(boxfile, 'r', encoding='utf-8') as file_desc:
-                    self.__boxes = box_builder.read_file(file_desc)
-                return self.__boxes
-            except IOError, exc:
-                logger.error("Unable to get boxes for '%s': %s"
-                             % (self.doc.docid, exc))
-                # will fall back on pdf boxes
+            self.__boxes = load_boxes(boxfile, self.__get_box_store_path())
+            return self.__boxes
+        except IOError, exc:
+            logger.error("Unable to get boxes for '%s': %s"
+                         % (self.doc.docid, exc))
+            # will fall back on pdf boxes
         except OSError, exc:  # os.stat() failed
             pass
 
-        # fall back on what libpoppler tells us
-
-        # TODO: Line support !
-
-        txt = self.pdf_page.get_text()
-        pdf_size = self.pdf_page.get_size()
-        words = set()
-        self.__boxes = []
-        for line in txt.split("\n"):
-            for word in split_words(unicode(line, encoding='utf-8')):
-                words.add(word)
-        for word in words:
-            for rect in self.pdf_page.find_text(word):
-                word_box = PdfWordBox(word, rect, pdf_size)
-                line_box = PdfLineBox([word_box], rect, pdf_size)
-                self.__boxes.append(line_box)
+        # fall back on what libpoppler tells us. The result is kept in
+        # a box store next to the box files (see boxstore.BoxStore), valid
+        # as long as the PDF file doesn't change
+        pdf_stat = os.stat(self.get_doc_file_path())
+        layout_store_path = self.__get_layout_store_path()
+        store = BoxStore.load(layout_store_path, pdf_stat)
+        if store is not None:
+            try:
+                self.__boxes = store.get_boxes()
+            finally:
+                store.close()
+            return self.__boxes
+
+        self.__boxes = get_text_layout_boxes(self.pdf_page)
+        BoxStore.write(layout_store_path, self.__boxes, pdf_stat)
         return self.__boxes
 
     def __set_boxes(self, boxes):
         boxfile = self.__get_box_path()
         with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
             pyocr.builders.LineBoxBuilder().write_file(file_desc, boxes)
+        BoxStore.write(self.__get_box_store_path(), boxes, os.stat(boxfile))
         self.drop_cache()
         self.doc.drop_cache()
 
     boxes = property(__get_boxes, __set_boxes)
 
-    def __render_img(self, factor):
+    def __render(self, factor):
         # TODO(Jflesch): In a perfect world, we shouldn't use ImageSurface.
         # we should draw directly on the GtkImage.window.cairo_create()
         # context. It would be much more efficient.
+        logger.debug('Building img from pdf with factor: %s' % factor)
+        width = int(factor * self._size[0])
+        height = int(factor * self._size[1])
+
+        # opaque surface: surface2image() doesn't have to flatten it
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgb(1.0, 1.0, 1.0)
+        ctx.paint()
+        ctx.scale(factor, factor)
+        self.pdf_page.render(ctx)
+        return surface2image(surface)
 
-        if factor not in self.__img_cache:
-            logger.debug('Building img from pdf with factor: %s'
-                         % factor)
-            width = int(factor * self._size[0])
-            height = int(factor * self._size[1])
-
-            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-            ctx = cairo.Context(surface)
-            ctx.scale(factor, factor)
-            self.pdf_page.render(ctx)
-            self.__img_cache[factor] = surface2image(surface)
-        return self.__img_cache[factor]
+    def __render_img(self, factor):
+        return get_rendering(self.doc.get_pdf_key(), self.page_nb, factor,
+                             lambda: self.__render(factor))
 
     def __get_img(self):
         return self.__render_img(PDF_RENDER_FACTOR)
 
     img = property(__get_img)
 
+    def get_image(self, width, height):
+        # rendered directly at the requested size. Not kept in the render
+        # cache: there would be one rendering per zoom level.
+        factor = max(float(width) / self._size[0],
+                     float(height) / self._size[1])
+        return self.__render(factor)
+
+    def get_tiles(self, size, rects):
+        # each area is rendered on its own: Poppler skips what is outside
+        # of the surface
+        factor = (float(size[0]) / self._size[0],
+                  float(size[1]) / self._size[1])
+        pdf_page = self.pdf_page
+        tiles = []
+        for (x, y, width, height) in rects:
+            surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+            ctx = cairo.Context(surface)
+            ctx.set_source_rgb(1.0, 1.0, 1.0)
+            ctx.paint()
+            ctx.translate(-x, -y)
+            ctx.scale(factor[0], factor[1])
+            pdf_page.render(ctx)
+            tiles.append(surface)
+        return tiles
+
     def __get_size(self):
         return (self._size[0] * PDF_RENDER_FACTOR,
                 self._size[1] * PDF_RENDER_FACTOR)
@@ -0,0 +1,74 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Process-wide pool of open Poppler documents.
+
+Parsing a PDF file is expensive, but keeping every PDF file ever opened in
+memory (and its file descriptor) is not an option either. The documents
+borrow their Poppler document from this pool each time they need it. Only
+the most recently used ones are kept open.
+"""
+
+import logging
+import urllib
+
+from gi.repository import Poppler
+
+from paperwork.backend.util import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_DOCS = 16
+
+# (PDF file path, mtime) --> Poppler.Document
+_pool = LRUCache(DEFAULT_MAX_DOCS)
+
+
+def set_max_docs(max_docs):
+    """
+    Change the maximum number of Poppler documents kept open
+    """
+    _pool.max_size = max_docs
+
+
+def get_pdf(path, mtime):
+    """
+    Arguments:
+        mtime --- modification time of the PDF file: an outdated Poppler
+            document is never returned
+
+    Returns:
+        A Poppler.Document. Callers must not keep a reference on it (or on
+        its pages) longer than required, otherwise the pool can't close it.
+    """
+    key = (path, mtime)
+    pdf = _pool.get(key)
+    if pdf is not None:
+        return pdf
+    logger.debug("Opening PDF file %s" % path)
+    pdf = Poppler.Document.new_from_file(
+        "file://%s" % urllib.quote(path), password=None)
+    _pool.put(key, pdf)
+    return pdf
+
+
+def forget_pdf(path, mtime):
+    _pool.pop((path, mtime))
+
+
+def get_stats():
+    return _pool.get_stats()
@@ -0,0 +1,73 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Process-wide cache of the rendered PDF pages.
+
+Rendered pages are big (a few megabytes each), so the cache is limited by
+the memory used by the images it contains, not by their number. The least
+recently used renderings are dropped first.
+"""
+
+from paperwork.backend.util import LRUCache
+
+
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+
+def get_img_size(img):
+    """
+    Returns:
+        An estimation of the memory used by the pixels of a PIL image
+    """
+    # PIL stores RGB images with 4 bytes per pixel
+    bytes_per_pixel = 1 if img.mode in ("1", "L", "P") else 4
+    return img.size[0] * img.size[1] * bytes_per_pixel
+
+
+# ((PDF file path, mtime), page number, factor) --> PIL image
+_cache = LRUCache(DEFAULT_MAX_BYTES, get_size=get_img_size)
+
+
+def set_max_bytes(max_bytes):
+    """
+    Change the memory budget of the render cache
+    """
+    _cache.max_size = max_bytes
+
+
+def get_rendering(pdf_key, page_nb, factor, render_func):
+    """
+    Arguments:
+        pdf_key --- (PDF file path, mtime) (see PdfDoc.get_pdf_key())
+        render_func --- called to render the page if it isn't in the
+            cache. Must return a PIL image.
+
+    Returns:
+        A PIL image. It is shared: it must not be modified.
+    """
+    key = (pdf_key, page_nb, factor)
+    img = _cache.get(key)
+    if img is None:
+        img = render_func()
+        _cache.put(key, img)
+    return img
+
+
+def get_stats():
+    """
+    See LRUCache.get_stats(). Sizes are in bytes.
+    """
+    return _cache.get_stats()
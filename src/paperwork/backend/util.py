@@ -14,11 +14,12 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>
 
-import array
+import collections
 import errno
 import logging
 import os
 import re
+import tempfile
 import threading
 import unicodedata
 
@@ -32,6 +33,13 @@ WISHED_SPLIT_KEYWORDS_REGEX = re.compile("[^\w!]", re.UNICODE)
 
 MIN_KEYWORD_LEN = 3
 
+# size of the chunks of pixels encoded at once by image2surface() (bytes)
+IMG_CONV_CHUNK_SIZE = 256 * 1024
+# major versions of Pillow with which image2surface() may encode the pixels
+# directly in the surface (see _encode_img()). With any other version (or
+# with the original PIL), it uses the public img.tobytes()
+DIRECT_IMG_CONV_PILLOW_VERSIONS = range(2, 11)
+
 
 def strip_accents(string):
     """
@@ -201,34 +209,245 @@ def rm_rf(path):
         os.rmdir(path)
 
 
+def write_file_atomically(path, data):
+    """
+    Replace the content of the file with 'data' (str). Readers see either
+    the previous content or the new one, never a partial file. The data is
+    first written in a temporary file with a unique name in the same
+    directory, so many threads or processes can write the same file.
+
+    Raises:
+        IOError or OSError
+    """
+    (dirpath, filename) = os.path.split(path)
+    (fd, tmp_path) = tempfile.mkstemp(prefix=filename + ".", suffix=".tmp",
+                                      dir=dirpath or ".")
+    try:
+        with os.fdopen(fd, 'wb') as file_desc:
+            file_desc.write(data)
+        # mkstemp() only gives access to the owner
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_sidecar_file(path, data, description):
+    """
+    Write a file that only caches data computed from other files (see
+    write_file_atomically()). Failing to write it is not an error: the data
+    will simply be computed again next time.
+
+    Arguments:
+        description --- what the file is, for the logs
+
+    Returns:
+        True if the file has been written
+    """
+    try:
+        write_file_atomically(path, data)
+        return True
+    except (IOError, OSError), exc:
+        logger.warning("Unable to write the %s %s: %s"
+                       % (description, path, exc))
+        return False
+
+
+class LRUCache(object):
+    """
+    Thread-safe least-recently-used cache.
+
+    Entries are evicted when the sum of their sizes exceeds 'max_size'. By
+    default, each entry has a size of 1 (so 'max_size' is a number of
+    entries). Give 'get_size' to use another measure (bytes for instance).
+    """
+
+    def __init__(self, max_size, get_size=lambda value: 1):
+        self.max_size = max_size
+        self.get_size = get_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = collections.OrderedDict()  # key --> (value, size)
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                (value, size) = self.__entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # re-inserted --> most recently used
+            self.__entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def put(self, key, value):
+        size = self.get_size(value)
+        with self.__lock:
+            if key in self.__entries:
+                self.size -= self.__entries.pop(key)[1]
+            if size > self.max_size:
+                # would evict everything else and still not fit
+                return
+            self.__entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                (_, (_, evicted_size)) = self.__entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            try:
+                (value, size) = self.__entries.pop(key)
+            except KeyError:
+                return default
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self.__lock:
+            self.__entries = collections.OrderedDict()
+            self.size = 0
+
+    def get_stats(self):
+        """
+        Returns a dict of statistics, useful to tune max_size
+        """
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.__entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (float(self.hits) / lookups) if lookups else 0.0,
+            }
+
+
 def surface2image(surface):
     """
-    Convert a cairo surface into a PIL image
+    Convert a cairo surface into a PIL image (RGB). The pixels are copied
+    only once. The surface is not modified.
     """
+    import cairo
     import PIL.Image
-    import PIL.ImageDraw
 
     if surface is None:
         return None
-    dimension = (surface.get_width(), surface.get_height())
-    img = PIL.Image.frombuffer("RGBA", dimension,
-                               surface.get_data(), "raw", "BGRA", 0, 1)
+    (width, height) = (surface.get_width(), surface.get_height())
+    if surface.get_format() != cairo.FORMAT_RGB24:
+        # flatten the surface on a white background: cairo does it faster
+        # than PIL, and it avoids splitting the alpha channel
+        flat = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        ctx = cairo.Context(flat)
+        ctx.set_source_rgb(1.0, 1.0, 1.0)
+        ctx.paint()
+        ctx.set_source_surface(surface, 0, 0)
+        ctx.paint()
+        surface = flat
+    surface.flush()
+    # with a raw mode different from the image mode, PIL decodes the buffer
+    # into its own memory: the image doesn't depend on the surface
+    return PIL.Image.frombuffer("RGB", (width, height), surface.get_data(),
+                                "raw", "BGRX", surface.get_stride(), 1)
+
+
+def _can_encode_img():
+    """
+    Returns:
+        True if _encode_img() can be used with this version of PIL/Pillow
+    """
+    import PIL
+    import PIL.Image
+
+    version = getattr(PIL, "__version__",
+                      getattr(PIL, "PILLOW_VERSION", None))
+    if version is None or not hasattr(PIL.Image, "_getencoder"):
+        return False
+    try:
+        major = int(version.split(".")[0])
+    except ValueError:
+        return False
+    return major in DIRECT_IMG_CONV_PILLOW_VERSIONS
 
-    background = PIL.Image.new("RGB", img.size, (255, 255, 255))
-    background.paste(img, mask=img.split()[3])  # 3 is the alpha channel
-    return background
+
+def _encode_img(img, rawmode, buf):
+    """
+    Encode the pixels of the image directly into 'buf', chunk by chunk,
+    without an intermediate copy of the whole image.
+
+    Relies on PIL.Image._getencoder(), which is not part of the public API
+    of PIL/Pillow: only used if _can_encode_img() says so.
+    """
+    import PIL.Image
+
+    encoder = PIL.Image._getencoder(img.mode, "raw", rawmode)
+    encoder.setimage(img.im)
+    bufsize = max(IMG_CONV_CHUNK_SIZE, img.size[0] * 4)
+    offset = 0
+    while True:
+        (_, status, chunk) = encoder.encode(bufsize)
+        buf[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+        if status:
+            break
+    if status < 0:
+        raise RuntimeError("encoder error %d" % status)
 
 
 def image2surface(img):
     """
-    Convert a PIL image into a Cairo surface
+    Convert a PIL image into an opaque Cairo surface (FORMAT_RGB24). The
+    pixels are encoded directly in the memory of the surface, chunk by
+    chunk: there is no intermediate copy of the whole image. If the version
+    of PIL doesn't allow it (see DIRECT_IMG_CONV_PILLOW_VERSIONS), they are
+    encoded with img.tobytes() and copied once. The image is not modified
+    (its alpha channel, if any, is ignored).
     """
     import cairo
 
-    img.putalpha(256)
+    if img.mode == "RGBA":
+        rawmode = "BGRA"
+    elif img.mode == "RGB":
+        rawmode = "BGRX"
+    else:
+        img = img.convert("RGB")
+        rawmode = "BGRX"
     (width, height) = img.size
-    imgd = img.tobytes('raw', 'BGRA')
-    imga = array.array('B', imgd)
-    stride = width * 4
-    return cairo.ImageSurface.create_for_data(
-        imga, cairo.FORMAT_ARGB32, width, height, stride)
+
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    # The fourth byte of each pixel is ignored with FORMAT_RGB24, and the
+    # stride of 32bits formats is always width * 4: the encoded rows match
+    # the surface layout
+    assert(surface.get_stride() == width * 4)
+    surface.flush()
+    buf = surface.get_data()
+
+    img.load()
+    if _can_encode_img():
+        try:
+            _encode_img(img, rawmode, buf)
+            surface.mark_dirty()
+            return surface
+        except (AttributeError, TypeError, ValueError, RuntimeError), exc:
+            logger.warning("Unable to encode the image directly into the"
+                           " surface (%s). Using tobytes()" % exc)
+    data = img.tobytes("raw", rawmode)
+    buf[0:len(data)] = data
+    surface.mark_dirty()
+    return surface
@@ -0,0 +1,378 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Work directory watcher.
+
+Looks for changes made in the work directory by other programs and reports
+them as batches of document ids, once they have settled down. Uses inotify
+when available (Linux), and falls back on periodically fingerprinting the
+document directories otherwise.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+from paperwork.backend.common.dirsnapshot import is_ignored_file
+from paperwork.backend.common.doc import get_doc_fingerprint
+
+
+logger = logging.getLogger(__name__)
+
+
+class _InotifyBackend(object):
+    """
+    Watch the work directory and each document directory with inotify.
+    Uses directly the libc through ctypes, so no extra dependency is required.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    IN_NONBLOCK = 0o4000
+
+    ROOTDIR_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+                    IN_ONLYDIR)
+    DOCDIR_MASK = (IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM |
+                   IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, rootdir, on_docid_touched, on_overflow):
+        self.rootdir = rootdir
+        self.on_docid_touched = on_docid_touched
+        self.on_overflow = on_overflow
+
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify not available")
+
+        self._fd = self._libc.inotify_init1(self.IN_CLOEXEC |
+                                            self.IN_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+        self._wds = {}  # watch descriptor --> docid (None for the rootdir)
+
+        try:
+            self.__add_watch(None)
+            self.__add_docdir_watches()
+        except OSError:
+            os.close(self._fd)
+            raise
+        logger.info("Watching %s with inotify (%d directories)"
+                    % (rootdir, len(self._wds)))
+
+    def __add_watch(self, docid):
+        if docid is None:
+            (path, mask) = (self.rootdir, self.ROOTDIR_MASK)
+        else:
+            (path, mask) = (os.path.join(self.rootdir, docid),
+                            self.DOCDIR_MASK)
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        wd = self._libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOENT and docid is not None:
+                # directory already gone
+                return
+            # ENOSPC: fs.inotify.max_user_watches is too low for this work
+            # directory
+            raise OSError(err, "inotify_add_watch(%s) failed: %s"
+                          % (path, os.strerror(err)))
+        self._wds[wd] = docid
+
+    def __add_docdir_watches(self):
+        # watching a directory already watched simply returns the same watch
+        # descriptor
+        for docid in os.listdir(self.rootdir):
+            if os.path.isdir(os.path.join(self.rootdir, docid)):
+                self.__add_watch(docid)
+
+    def wait(self, timeout):
+        """
+        Wait at most 'timeout' seconds for events, and report the documents
+        touched
+        """
+        (readable, _, _) = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except OSError, exc:
+            if exc.errno == errno.EAGAIN:
+                return
+            raise
+
+        offset = 0
+        while offset + self._EVENT.size <= len(buf):
+            (wd, mask, _, name_len) = self._EVENT.unpack_from(buf, offset)
+            offset += self._EVENT.size
+            name = buf[offset:offset + name_len].rstrip("\0")
+            offset += name_len
+
+            if mask & self.IN_Q_OVERFLOW:
+                # some events have been lost, including maybe the creation
+                # of new document directories
+                logger.warning("Inotify queue overflow. The whole work"
+                               " directory %s must be examined again"
+                               % self.rootdir)
+                self.__add_docdir_watches()
+                self.on_overflow()
+                continue
+            if wd not in self._wds:
+                continue
+
+            docid = self._wds[wd]
+            if mask & self.IN_IGNORED:
+                self._wds.pop(wd)
+                continue
+            if docid is not None:
+                # the files written by Paperwork itself (thumbnails, caches,
+                # etc) don't change the document
+                if not name or not is_ignored_file(name):
+                    self.on_docid_touched(docid)
+                continue
+
+            # event on the rootdir itself
+            if not name:
+                continue
+            self.on_docid_touched(name)
+            if ((mask & self.IN_ISDIR) and
+                    (mask & (self.IN_CREATE | self.IN_MOVED_TO))):
+                self.__add_watch(name)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _PollingBackend(object):
+    """
+    Fingerprint all the document directories every 'poll_interval' seconds.
+    """
+
+    def __init__(self, rootdir, on_docid_touched, poll_interval):
+        self.rootdir = rootdir
+        self.on_docid_touched = on_docid_touched
+        self.poll_interval = poll_interval
+        self._fingerprints = self.__get_fingerprints()
+        self._next_poll = time.time() + poll_interval
+        logger.info("Polling %s every %ds (%d directories)"
+                    % (rootdir, poll_interval, len(self._fingerprints)))
+
+    def __get_fingerprints(self):
+        fingerprints = {}
+        for docid in os.listdir(self.rootdir):
+            fingerprint = get_doc_fingerprint(
+                os.path.join(self.rootdir, docid))
+            if fingerprint is not None:
+                fingerprints[docid] = fingerprint
+        return fingerprints
+
+    def wait(self, timeout):
+        now = time.time()
+        if now < self._next_poll:
+            time.sleep(min(timeout, self._next_poll - now))
+            return
+        fingerprints = self.__get_fingerprints()
+        for (docid, fingerprint) in fingerprints.iteritems():
+            if self._fingerprints.get(docid) != fingerprint:
+                self.on_docid_touched(docid)
+        for docid in self._fingerprints.iterkeys():
+            if docid not in fingerprints:
+                self.on_docid_touched(docid)
+        self._fingerprints = fingerprints
+        self._next_poll = time.time() + self.poll_interval
+
+    def close(self):
+        pass
+
+
+class WorkdirWatcher(object):
+    """
+    Watch the work directory for changes made to the documents.
+
+    callback(docids) is called from the watcher thread each time a batch of
+    documents has been modified, added or removed. A document is only reported
+    once no change has been made to it for 'debounce' seconds. Use
+    DocDirExaminer.examine_docids() to find out what actually happened to
+    them.
+
+    rescan_cb() is called from the watcher thread when changes may have been
+    missed (inotify queue overflow): the whole work directory must then be
+    examined again (see DocDirExaminer.examine_rootdir()). If rescan_cb is
+    None, all the documents of the work directory are reported to callback()
+    instead (documents removed in the meantime are missed).
+
+    Documents being written by Paperwork itself (scan, import, etc) can be
+    held (see hold()): they are only reported once released.
+    """
+    DEFAULT_DEBOUNCE = 2.0  # seconds
+    DEFAULT_POLL_INTERVAL = 60  # seconds
+    MAX_BATCH_DELAY = 30.0  # seconds
+
+    def __init__(self, rootdir, callback, rescan_cb=None,
+                 debounce=DEFAULT_DEBOUNCE,
+                 poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        self.rootdir = rootdir
+        self.callback = callback
+        self.rescan_cb = rescan_cb
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+
+        self._pending = {}  # docid --> (first event time, last event time)
+        self._rescan = False
+        self._held = {}  # docid (None: all the documents) --> hold count
+        self._lock = threading.Lock()
+        self._thread = None
+        self.running = False
+
+    def __make_backend(self):
+        if self.use_inotify:
+            try:
+                return _InotifyBackend(self.rootdir, self.__on_docid_touched,
+                                       self.__on_overflow)
+            except OSError, exc:
+                logger.warning("Can't use inotify to watch %s: %s."
+                               " Falling back on polling"
+                               % (self.rootdir, exc))
+        return _PollingBackend(self.rootdir, self.__on_docid_touched,
+                               self.poll_interval)
+
+    def start(self):
+        assert(not self.running)
+        self.running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        logger.info("Stopping the watcher on %s" % self.rootdir)
+        self.running = False
+        self._thread.join()
+        self._thread = None
+
+    def hold(self, docid=None):
+        """
+        Don't report the changes made to the document until release() is
+        called, for instance because a scan or an import is writing it. If
+        docid is None, no document at all is reported until then. Holds can
+        be nested.
+        """
+        with self._lock:
+            self._held[docid] = self._held.get(docid, 0) + 1
+
+    def release(self, docid=None):
+        """
+        Counterpart of hold(). The changes made to the document while it was
+        held are reported once it has settled down.
+        """
+        with self._lock:
+            if docid not in self._held:
+                return
+            count = self._held.pop(docid) - 1
+            if count > 0:
+                self._held[docid] = count
+                return
+            if docid in self._pending:
+                # debounce from now on
+                (first, _) = self._pending[docid]
+                self._pending[docid] = (first, time.time())
+
+    def __on_docid_touched(self, docid):
+        now = time.time()
+        with self._lock:
+            (first, _) = self._pending.get(docid, (now, now))
+            self._pending[docid] = (first, now)
+
+    def __on_overflow(self):
+        with self._lock:
+            self._rescan = True
+            # all the documents are going to be examined anyway
+            self._pending = {}
+
+    def __get_settled_docids(self):
+        now = time.time()
+        docids = set()
+        for (docid, (first, last)) in self._pending.items():
+            if docid in self._held:
+                continue
+            if (now - last >= self.debounce or
+                    now - first >= self.MAX_BATCH_DELAY):
+                docids.add(docid)
+                self._pending.pop(docid)
+        return docids
+
+    def __flush(self):
+        """
+        Report the documents that have settled down. Documents modified
+        continuously are still reported every MAX_BATCH_DELAY seconds.
+        """
+        with self._lock:
+            if None in self._held:
+                return
+            rescan = self._rescan
+            self._rescan = False
+            docids = self.__get_settled_docids()
+        if rescan:
+            if self.rescan_cb is not None:
+                logger.info("Watcher: examining the whole work directory %s"
+                            % self.rootdir)
+                self.rescan_cb()
+                return
+            docids.update(os.listdir(self.rootdir))
+        if len(docids) > 0:
+            logger.info("Watcher: %d documents changed in %s"
+                        % (len(docids), self.rootdir))
+            self.callback(docids)
+
+    def _run(self):
+        try:
+            backend = self.__make_backend()
+        except OSError, exc:
+            logger.error("Unable to watch %s: %s" % (self.rootdir, exc))
+            self.running = False
+            return
+        try:
+            while self.running:
+                backend.wait(min(0.5, self.debounce))
+                self.__flush()
+        except Exception, exc:
+            logger.exception("Watcher on %s failed: %s"
+                             % (self.rootdir, exc))
+            self.running = False
+        finally:
+            backend.close()
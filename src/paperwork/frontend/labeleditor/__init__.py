@@ -23,6 +23,7 @@ from gi.repository import GdkPixbuf
 from gi.repository import Gtk
 
 from paperwork.backend.labels import Label
+from paperwork.frontend.util import get_label_rgba
 from paperwork.frontend.util import load_uifile
 from paperwork.frontend.util.actions import SimpleAction
 
@@ -224,7 +225,7 @@ class LabelEditor(object):
         PickColorAction(self).connect([self._pick_button])
 
         self._color_chooser = widget_tree.get_object("labelColorChooser")
-        self._color_chooser.set_rgba(self.label.color)
+        self._color_chooser.set_rgba(get_label_rgba(self.label))
 
         name_entry = widget_tree.get_object("entryLabelName")
         name_entry.connect("changed", self.__on_label_entry_changed)
@@ -239,7 +240,7 @@ class LabelEditor(object):
         if (response == Gtk.ResponseType.OK):
             logger.info("Label validated")
             self.label.name = unicode(name_entry.get_text(), encoding='utf-8')
-            self.label.color = self._color_chooser.get_rgba()
+            self.label.color = self._color_chooser.get_rgba().to_string()
         else:
             logger.info("Label editing cancelled")
 
@@ -20,6 +20,7 @@ import logging
 import os
 import sys
 import threading
+import time
 
 import gettext
 from gi.repository import Gdk
@@ -37,6 +38,7 @@ from paperwork.frontend.mainwindow.pages import PageDrawer
 from paperwork.frontend.mainwindow.pages import PageDropHandler
 from paperwork.frontend.mainwindow.pages import JobFactoryPageBoxesLoader
 from paperwork.frontend.mainwindow.pages import JobFactoryPageImgLoader
+from paperwork.frontend.mainwindow.pages import JobFactoryPageTilesLoader
 from paperwork.frontend.mainwindow.scan import ScanWorkflow
 from paperwork.frontend.mainwindow.scan import MultiAnglesScanWorkflowDrawer
 from paperwork.frontend.mainwindow.scan import SingleAngleScanWorkflowDrawer
@@ -327,9 +329,21 @@ class JobIndexUpdater(Job):
     can_stop = True
     priority = 15
 
+    # when rebuilding the index, above this number of new documents, they
+    # are indexed using all the CPUs (see DocIndexRebuilder)
+    MIN_NEW_DOCS_FOR_REBUILDER = 50
+
     def __init__(self, factory, id, config, docsearch,
                  new_docs=set(), upd_docs=set(), del_docs=set(),
-                 optimize=True):
+                 optimize=True, examine_docids=None, rebuild=False):
+        """
+        Arguments:
+            examine_docids --- documents to examine first to find out if they
+                are new, modified or deleted (see
+                DocDirExaminer.examine_docids())
+            rebuild --- True if the index is being (re)built from the whole
+                work directory
+        """
         Job.__init__(self, factory, id)
         self.__docsearch = docsearch
         self.__config = config
@@ -339,11 +353,14 @@ class JobIndexUpdater(Job):
         self.new_docs = new_docs
         self.upd_docs = upd_docs
         self.del_docs = del_docs
+        self.examine_docids = examine_docids
 
         self.update_only = len(new_docs) == 0 and len(del_docs) == 0
 
         self.optimize = optimize
+        self.rebuild = rebuild
         self.index_updater = None
+        self.rebuilding = False
         self.total = (len(self.new_docs) + len(self.upd_docs) +
                       len(self.del_docs))
         self.progression = float(0)
@@ -369,19 +386,37 @@ class JobIndexUpdater(Job):
 
         self.can_run = True
 
+        if self.examine_docids is not None:
+            self.__examine()
+
         total = len(self.new_docs) + len(self.upd_docs) + len(self.del_docs)
         if total <= 0 and not self.optimize and self.index_updater is None:
             return
 
         if self.index_updater is None:
             self.emit('index-update-start')
-            self.index_updater = self.__docsearch.get_index_updater(
-                optimize=self.optimize)
+            self.rebuilding = (self.rebuild and
+                               len(self.new_docs) >=
+                               self.MIN_NEW_DOCS_FOR_REBUILDER)
+            if self.rebuilding:
+                self.index_updater = self.__docsearch.get_index_rebuilder(
+                    optimize=self.optimize,
+                    progress_cb=self.__on_doc_rebuilt)
+            else:
+                self.index_updater = self.__docsearch.get_index_updater(
+                    optimize=self.optimize)
 
         if not self.can_run:
             self.emit('index-update-interrupted')
             return
 
+        if self.rebuilding and len(self.new_docs) > 0:
+            try:
+                self.index_updater.add_docs(set(self.new_docs))
+            except StopIteration:
+                self.emit('index-update-interrupted')
+                return
+
         docs = [
             (_("Indexing new document ..."), self.new_docs,
              self.index_updater.add_doc),
@@ -421,6 +456,33 @@ class JobIndexUpdater(Job):
         self.emit('index-update-progression', 1.0, "")
         self.emit('index-update-end')
 
+    def __examine(self):
+        # new sets: the default ones are shared between instances
+        self.new_docs = set(self.new_docs)
+        self.upd_docs = set(self.upd_docs)
+        self.del_docs = set(self.del_docs)
+        self.__docsearch.get_doc_examiner().examine_docids(
+            self.examine_docids, self.new_docs.add, self.upd_docs.add,
+            self.del_docs.add, lambda doc: None)
+        logger.info("Work directory changed: %d new, %d modified,"
+                    " %d deleted documents"
+                    % (len(self.new_docs), len(self.upd_docs),
+                       len(self.del_docs)))
+        self.examine_docids = None
+        self.update_only = (len(self.new_docs) == 0 and
+                            len(self.del_docs) == 0)
+        self.total = (len(self.new_docs) + len(self.upd_docs) +
+                      len(self.del_docs))
+
+    def __on_doc_rebuilt(self, progression, total, step, doc):
+        self.new_docs.discard(doc)
+        self.progression += 1
+        self.emit('index-update-progression',
+                  (self.progression * 0.75) / self.total,
+                  "%s (%s)" % (_("Indexing new document ..."), str(doc)))
+        if not self.can_run:
+            raise StopIteration()
+
     def stop(self, will_resume=False):
         self.can_run = False
         if not will_resume:
@@ -440,10 +502,11 @@ class JobFactoryIndexUpdater(JobFactory):
 
     def make(self, docsearch,
              new_docs=set(), upd_docs=set(), del_docs=set(),
-             optimize=True, reload_list=False):
+             optimize=True, reload_list=False, examine_docids=None,
+             rebuild=False):
         job = JobIndexUpdater(self, next(self.id_generator), self.__config,
                               docsearch, new_docs, upd_docs, del_docs,
-                              optimize)
+                              optimize, examine_docids, rebuild)
         job.connect('index-update-start',
                     lambda updater:
                     GLib.idle_add(self.__main_win.on_index_update_start_cb,
@@ -481,6 +544,10 @@ class JobDocSearcher(Job):
                            # object into a string object
                            (GObject.TYPE_PYOBJECT,
                             GObject.TYPE_PYOBJECT,)),
+        # array of (position, document): the documents found after those of
+        # 'search-results', and where they go in the sorted list
+        'search-results-more': (GObject.SignalFlags.RUN_LAST, None,
+                                (GObject.TYPE_PYOBJECT,)),
         # array of suggestions
         'search-suggestions': (GObject.SignalFlags.RUN_LAST, None,
                                (GObject.TYPE_PYOBJECT,)),
@@ -489,6 +556,12 @@ class JobDocSearcher(Job):
     can_stop = True
     priority = 500
 
+    # results of a search are displayed as soon as there are enough of them
+    # to fill the list (FIRST_RESULTS). The others are added afterwards, by
+    # bunches of MORE_RESULTS
+    FIRST_RESULTS = 50
+    MORE_RESULTS = 200
+
     def __init__(self, factory, id, config, docsearch, sort_func,
                  search_type, search):
         Job.__init__(self, factory, id)
@@ -501,17 +574,35 @@ class JobDocSearcher(Job):
     def do(self):
         self.can_run = True
 
-        self._wait(0.5)
+        self._wait(self.factory.get_debounce())
         if not self.can_run:
             return
 
         self.emit('search-start')
 
+        docids = None
         try:
             logger.info("Searching: [%s]" % self.search)
-            documents = self.__docsearch.find_documents(
-                self.search,
-                search_type=self.__search_type)
+            start = time.time()
+            if self.search.strip() == u"":
+                # all the documents: no need for the index
+                documents = self.__docsearch.find_documents(
+                    self.search,
+                    search_type=self.__search_type)
+                # when no specific search has been done, the sorting is
+                # always the same
+                sort_documents_by_date(documents)
+            else:
+                # the index returns the results by relevance, not in the
+                # order the user chose: the documents are sorted as they
+                # come (see the loop below)
+                docids = iter(self.__docsearch.find_docids(
+                    self.search,
+                    search_type=self.__search_type))
+                documents = self.__docsearch.get_docs_from_docids(
+                    docids, self.FIRST_RESULTS)
+                self.__sort_func(documents)
+            self.factory.add_latency(time.time() - start)
         except Exception, exc:
             logger.error("Invalid search: [%s]" % self.search)
             logger.error("Exception was: %s: %s" % (type(exc), str(exc)))
@@ -519,15 +610,6 @@ class JobDocSearcher(Job):
             return
         if not self.can_run:
             return
-
-        if self.search == u"":
-            # when no specific search has been done, the sorting is always
-            # the same
-            sort_documents_by_date(documents)
-        else:
-            self.__sort_func(documents)
-        if not self.can_run:
-            return
         self.emit('search-results', self.search, documents)
 
         suggestions = self.__docsearch.find_suggestions(self.search)
@@ -535,6 +617,26 @@ class JobDocSearcher(Job):
             return
         self.emit('search-suggestions', suggestions)
 
+        shown = documents[:]
+        while docids is not None and self.can_run:
+            try:
+                documents = self.__docsearch.get_docs_from_docids(
+                    docids, self.MORE_RESULTS)
+            except Exception, exc:
+                # the index may have been reloaded in the meantime
+                logger.warning("Unable to get more results for [%s]: %s"
+                               % (self.search, exc))
+                return
+            if len(documents) <= 0 or not self.can_run:
+                return
+            # the new documents may go anywhere in the list already shown
+            shown += documents
+            self.__sort_func(shown)
+            new_docids = set([doc.docid for doc in documents])
+            self.emit('search-results-more',
+                      [(position, doc) for (position, doc) in enumerate(shown)
+                       if doc.docid in new_docids])
+
     def stop(self, will_resume=False):
         self.can_run = False
         self._stop_wait()
@@ -544,10 +646,35 @@ GObject.type_register(JobDocSearcher)
 
 
 class JobFactoryDocSearcher(JobFactory):
+    # Searches are only started once the user stops typing for a while.
+    # The delay follows the time searches actually take: no need to make the
+    # user wait when they are fast, but when they are slow, starting one on
+    # each keystroke would only delay the one the user is waiting for.
+    MIN_DEBOUNCE = 0.1  # seconds
+    MAX_DEBOUNCE = 0.5  # seconds
+    LATENCY_FACTOR = 2.0
+    LATENCY_SMOOTHING = 0.3
+
     def __init__(self, main_win, config):
         JobFactory.__init__(self, "Search")
         self.__main_win = main_win
         self.__config = config
+        self.__latency = None  # moving average, in seconds
+
+    def add_latency(self, latency):
+        if self.__latency is None:
+            self.__latency = latency
+        else:
+            self.__latency = ((self.LATENCY_SMOOTHING * latency) +
+                              ((1.0 - self.LATENCY_SMOOTHING) *
+                               self.__latency))
+
+    def get_debounce(self):
+        if self.__latency is None:
+            return self.MAX_DEBOUNCE
+        return min(self.MAX_DEBOUNCE,
+                   max(self.MIN_DEBOUNCE,
+                       self.LATENCY_FACTOR * self.__latency))
 
     def make(self, docsearch, sort_func, search_type, search):
         job = JobDocSearcher(self, next(self.id_generator), self.__config,
@@ -557,7 +684,11 @@ class JobFactoryDocSearcher(JobFactory):
         job.connect('search-results',
                     lambda searcher, search, documents:
                     GLib.idle_add(self.__main_win.on_search_results_cb,
-                                  search, documents))
+                                  searcher, search, documents))
+        job.connect('search-results-more',
+                    lambda searcher, documents:
+                    GLib.idle_add(self.__main_win.on_search_results_more_cb,
+                                  searcher, documents))
         job.connect('search-invalid',
                     lambda searcher: GLib.idle_add(
                         self.__main_win.on_search_invalid_cb))
@@ -857,12 +988,16 @@ class JobImporter(Job):
 
     def do(self):
         self.__main_win.set_mouse_cursor("Busy")
+        # we don't know yet which documents are going to be written: the
+        # watcher mustn't report any document until the import is done
+        self.__main_win.hold_workdir_changes()
         try:
             (docs, page, must_add_labels) = self.importer.import_doc(
                 self.file_uri, self.__main_win.docsearch,
                 self.__main_win.doc
             )
         finally:
+            self.__main_win.release_workdir_changes()
             self.__main_win.set_mouse_cursor("Normal")
 
         if docs is None or len(docs) <= 0:
@@ -1115,20 +1250,14 @@ class ActionToggleLabel(object):
         if label not in self.__main_win.doc.labels:
             logger.info("Action: Adding label '%s' on document '%s'"
                         % (label.name, str(self.__main_win.doc)))
-            self.__main_win.docsearch.add_label(self.__main_win.doc, label,
-                                                update_index=False)
+            self.__main_win.docsearch.add_label(self.__main_win.doc, label)
         else:
             logger.info("Action: Removing label '%s' on document '%s'"
                         % (label.name, self.__main_win.doc))
-            self.__main_win.docsearch.remove_label(self.__main_win.doc, label,
-                                                   update_index=False)
+            self.__main_win.docsearch.remove_label(self.__main_win.doc, label)
         self.__main_win.refresh_label_list()
         self.__main_win.refresh_docs({self.__main_win.doc},
                                      redo_thumbnails=False)
-        job = self.__main_win.job_factories['index_updater'].make(
-            self.__main_win.docsearch, upd_docs={self.__main_win.doc},
-            optimize=False)
-        self.__main_win.schedulers['index'].schedule(job)
 
     def connect(self, cellrenderers):
         for cellrenderer in cellrenderers:
@@ -1812,6 +1941,7 @@ class ActionRefreshIndex(SimpleAction):
         self.__main_win.schedulers['index'].cancel_all(
             self.__main_win.job_factories['index_updater'])
         docsearch = self.__main_win.docsearch
+        self.__main_win.stop_workdir_watcher()
         self.__main_win.docsearch = DummyDocSearch()
         self.__main_win.doclist.clear()
         if self.__force:
@@ -1824,35 +1954,7 @@ class ActionRefreshIndex(SimpleAction):
     def __on_index_reload_end(self, job, docsearch):
         if docsearch is None:
             return
-        job = self.__main_win.job_factories['doc_examiner'].make(docsearch)
-        job.connect('doc-examination-end', lambda job: GLib.idle_add(
-            self.__on_doc_exam_end, job))
-        self.__main_win.schedulers['main'].schedule(job)
-
-    def __on_doc_exam_end(self, examiner):
-        logger.info("Document examen finished. Updating index ...")
-        logger.info("%d labels found" % len(examiner.labels))
-        logger.info("New document: %d" % len(examiner.new_docs))
-        logger.info("Updated document: %d" % len(examiner.docs_changed))
-        logger.info("Deleted document: %d" % len(examiner.docs_missing))
-
-        examiner.docsearch.label_list = examiner.labels
-
-        if (len(examiner.new_docs) == 0 and
-                len(examiner.docs_changed) == 0 and
-                len(examiner.docs_missing) == 0):
-            logger.info("No changes")
-            return
-
-        job = self.__main_win.job_factories['index_updater'].make(
-            docsearch=examiner.docsearch,
-            new_docs=examiner.new_docs,
-            upd_docs=examiner.docs_changed,
-            del_docs=examiner.docs_missing,
-            reload_list=True,
-            optimize=False
-        )
-        self.__main_win.schedulers['index'].schedule(job)
+        self.__main_win.examine_workdir(docsearch)
 
 
 class MainWindow(object):
@@ -1883,6 +1985,11 @@ class MainWindow(object):
         self.__scan_progress_job = None
 
         self.docsearch = DummyDocSearch()
+        self.workdir_watcher = None
+        # index updates of the batches taken from docsearch.index_batch
+        self.index_batch_jobs = []
+        # last search job that returned results
+        self.last_searcher = None
 
         # All the pages are displayed on the canvas,
         # however, only one is the "active one"
@@ -2044,6 +2151,7 @@ class MainWindow(object):
             ),
             'page_img_renderer': JobFactoryPageImgRenderer(),
             'page_img_loader': JobFactoryPageImgLoader(),
+            'page_tiles_loader': JobFactoryPageTilesLoader(),
             'page_boxes_loader': JobFactoryPageBoxesLoader(),
         }
 
@@ -2418,6 +2526,145 @@ class MainWindow(object):
         self.docsearch = docsearch
         self.refresh_doc_list()
         self.refresh_label_list()
+        self.start_workdir_watcher()
+        # label changes are batched by the docsearch object. The batches are
+        # written by the index scheduler
+        docsearch.index_batch.flush_cb = (
+            lambda batch: GLib.idle_add(self.on_index_batch_ready_cb,
+                                        docsearch)
+        )
+
+    def on_index_batch_ready_cb(self, docsearch):
+        (new_docs, upd_docs, del_docs) = docsearch.index_batch.take()
+        if len(new_docs) == 0 and len(upd_docs) == 0 and len(del_docs) == 0:
+            return
+        job = self.job_factories['index_updater'].make(
+            docsearch=docsearch,
+            new_docs=new_docs,
+            upd_docs=upd_docs,
+            del_docs=del_docs,
+            optimize=False
+        )
+        self.index_batch_jobs = [
+            batch_job for batch_job in self.index_batch_jobs
+            if self.schedulers['index'].is_scheduled(batch_job)
+        ]
+        self.index_batch_jobs.append(job)
+        self.schedulers['index'].schedule(job)
+
+    def flush_index_batch(self, timeout=60.0):
+        """
+        Write the pending index updates (see docsearch.index_batch). Must be
+        called before stopping the schedulers: stopping them would cancel
+        the updates. Runs the Gtk main loop until they are written (the
+        index jobs need it).
+        """
+        if isinstance(self.docsearch, DummyDocSearch):
+            return
+        self.on_index_batch_ready_cb(self.docsearch)
+        deadline = time.time() + timeout
+        while any(self.schedulers['index'].is_scheduled(job)
+                  for job in self.index_batch_jobs):
+            if time.time() >= deadline:
+                logger.warning("Timeout while writing the pending index"
+                               " updates. Some of them may be lost")
+                break
+            if Gtk.events_pending():
+                Gtk.main_iteration_do(False)
+            else:
+                time.sleep(0.05)
+        self.index_batch_jobs = []
+
+    def start_workdir_watcher(self):
+        """
+        Look for changes made to the work directory by other programs and
+        update the index accordingly
+        """
+        self.stop_workdir_watcher()
+        docsearch = self.docsearch
+        self.workdir_watcher = docsearch.get_watcher(
+            lambda docids: GLib.idle_add(self.on_workdir_changes_cb,
+                                         docsearch, docids),
+            rescan_cb=lambda: GLib.idle_add(self.on_workdir_rescan_cb,
+                                            docsearch))
+        self.workdir_watcher.start()
+
+    def stop_workdir_watcher(self):
+        if self.workdir_watcher is None:
+            return
+        self.workdir_watcher.stop()
+        self.workdir_watcher = None
+
+    def hold_workdir_changes(self, docid=None):
+        """
+        Paperwork is writing this document itself (None: some documents not
+        known yet): the watcher must not report it until
+        release_workdir_changes() is called (see WorkdirWatcher.hold())
+        """
+        watcher = self.workdir_watcher
+        if watcher is not None:
+            watcher.hold(docid)
+
+    def release_workdir_changes(self, docid=None):
+        watcher = self.workdir_watcher
+        if watcher is not None:
+            watcher.release(docid)
+
+    def examine_workdir(self, docsearch):
+        """
+        Look for the documents added, modified or removed in the whole work
+        directory, and update the index accordingly
+        """
+        job = self.job_factories['doc_examiner'].make(docsearch)
+        job.connect('doc-examination-end', lambda job: GLib.idle_add(
+            self.__on_workdir_examined, job))
+        self.schedulers['main'].schedule(job)
+
+    def __on_workdir_examined(self, examiner):
+        logger.info("Document examen finished. Updating index ...")
+        logger.info("%d labels found" % len(examiner.labels))
+        logger.info("New document: %d" % len(examiner.new_docs))
+        logger.info("Updated document: %d" % len(examiner.docs_changed))
+        logger.info("Deleted document: %d" % len(examiner.docs_missing))
+
+        examiner.docsearch.label_list = examiner.labels
+
+        if (len(examiner.new_docs) == 0 and
+                len(examiner.docs_changed) == 0 and
+                len(examiner.docs_missing) == 0):
+            logger.info("No changes")
+            return
+
+        job = self.job_factories['index_updater'].make(
+            docsearch=examiner.docsearch,
+            new_docs=examiner.new_docs,
+            upd_docs=examiner.docs_changed,
+            del_docs=examiner.docs_missing,
+            reload_list=True,
+            optimize=False,
+            rebuild=True
+        )
+        self.schedulers['index'].schedule(job)
+
+    def on_workdir_rescan_cb(self, docsearch):
+        if docsearch is not self.docsearch:
+            # index reloaded in the meantime
+            return
+        # the watcher may have missed some changes
+        self.examine_workdir(docsearch)
+
+    def on_workdir_changes_cb(self, docsearch, docids):
+        if docsearch is not self.docsearch:
+            # index reloaded in the meantime
+            return
+        # the documents are examined by the job, out of the Gtk thread
+        job = self.job_factories['index_updater'].make(
+            docsearch=docsearch,
+            examine_docids=docids,
+            reload_list=True,
+            optimize=False
+        )
+        self.schedulers['index'].schedule(job)
 
     def on_doc_examination_start_cb(self, src):
         self.set_progression(src, 0.0, None)
@@ -2459,13 +2706,21 @@ class MainWindow(object):
             for revealer in revealers:
                 revealer.set_reveal_child(visible)
 
-    def on_search_results_cb(self, search, documents):
+    def on_search_results_cb(self, searcher, search, documents):
         logger.debug("Got %d documents" % len(documents))
+        self.last_searcher = searcher
         self.doclist.set_docs(
             documents,
             need_new_doc=(search.strip() == u"")
         )
 
+    def on_search_results_more_cb(self, searcher, rows):
+        if searcher is not self.last_searcher:
+            # results of a previous search
+            return
+        logger.debug("Got %d more documents" % len(rows))
+        self.doclist.add_docs(rows)
+
     def on_search_suggestions_cb(self, suggestions):
         logger.debug("Got %d suggestions" % len(suggestions))
         self.lists['suggestions']['gui'].freeze_child_notify()
@@ -2519,6 +2774,9 @@ class MainWindow(object):
         self.schedulers['main'].cancel_all(
             self.job_factories['page_img_loader']
         )
+        self.schedulers['main'].cancel_all(
+            self.job_factories['page_tiles_loader']
+        )
         self.schedulers['main'].cancel_all(
             self.job_factories['page_boxes_loader']
         )
@@ -2572,6 +2830,9 @@ class MainWindow(object):
         self.schedulers['main'].cancel_all(
             self.job_factories['page_img_loader']
         )
+        self.schedulers['main'].cancel_all(
+            self.job_factories['page_tiles_loader']
+        )
         self.schedulers['main'].cancel_all(
             self.job_factories['page_boxes_loader']
         )
@@ -2582,10 +2843,12 @@ class MainWindow(object):
 
         factories = {
             'page_img_loader': self.job_factories['page_img_loader'],
+            'page_tiles_loader': self.job_factories['page_tiles_loader'],
             'page_boxes_loader': self.job_factories['page_boxes_loader']
         }
         schedulers = {
             'page_img_loader': self.schedulers['main'],
+            'page_tiles_loader': self.schedulers['main'],
             'page_boxes_loader': self.schedulers['page_boxes_loader'],
         }
 
@@ -2959,12 +3222,17 @@ class MainWindow(object):
                 if (scan_workflow == drawer or
                         scan_workflow == drawer.scan_workflow):
                     drawers.pop(page_nb)
+                    self.release_workdir_changes(docid)
                     return docid
         raise ValueError("ScanWorkflow not found")
 
     def add_scan_workflow(self, doc, scan_workflow_drawer, page_nb=-1):
         if doc.docid not in self.scan_drawers:
             self.scan_drawers[doc.docid] = {}
+        if page_nb not in self.scan_drawers[doc.docid]:
+            # the document is being scanned or OCR-ed: the watcher mustn't
+            # report it until the workflow is removed
+            self.hold_workdir_changes(doc.docid)
         self.scan_drawers[doc.docid][page_nb] = scan_workflow_drawer
 
         if (self.doc.docid == doc.docid or
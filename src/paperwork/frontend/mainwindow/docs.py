@@ -15,6 +15,7 @@ from paperwork.backend.img.doc import ImgDoc
 from paperwork.backend.labels import Label
 from paperwork.frontend.labeleditor import LabelEditor
 from paperwork.frontend.util import connect_actions
+from paperwork.frontend.util import get_label_rgba
 from paperwork.frontend.util.actions import SimpleAction
 from paperwork.frontend.util.canvas import Canvas
 from paperwork.frontend.util.canvas.animations import SpinnerAnimation
@@ -99,23 +100,26 @@ class JobDocThumbnailer(Job):
             if doc.nb_pages <= 0:
                 continue
 
-            # always request the same size, even for small thumbnails
-            # so we don't invalidate cache + previous thumbnails
-            img = doc.pages[0].get_thumbnail(BasicPage.DEFAULT_THUMB_WIDTH,
-                                             BasicPage.DEFAULT_THUMB_HEIGHT)
+            # only the first page is shown in the list
+            img = doc.pages[0].get_thumbnail(
+                JobDocThumbnailer.SMALL_THUMBNAIL_WIDTH,
+                JobDocThumbnailer.SMALL_THUMBNAIL_HEIGHT,
+                whole_doc=False)
             if not self.can_run:
                 return
 
             (w, h) = img.size
-            factor = max(
-                (float(w) / JobDocThumbnailer.SMALL_THUMBNAIL_WIDTH),
-                (float(h) / JobDocThumbnailer.SMALL_THUMBNAIL_HEIGHT)
-            )
-            w /= factor
-            h /= factor
-            img = img.resize((int(w), int(h)), PIL.Image.ANTIALIAS)
-            if not self.can_run:
-                return
+            if (w > JobDocThumbnailer.SMALL_THUMBNAIL_WIDTH or
+                    h > JobDocThumbnailer.SMALL_THUMBNAIL_HEIGHT):
+                factor = max(
+                    (float(w) / JobDocThumbnailer.SMALL_THUMBNAIL_WIDTH),
+                    (float(h) / JobDocThumbnailer.SMALL_THUMBNAIL_HEIGHT)
+                )
+                w /= factor
+                h /= factor
+                img = img.resize((int(w), int(h)), PIL.Image.ANTIALIAS)
+                if not self.can_run:
+                    return
 
             img = self.__resize(img)
             if not self.can_run:
@@ -125,6 +129,7 @@ class JobDocThumbnailer(Job):
             if not self.can_run:
                 return
 
+            self.factory.add_atlas_thumbnail(doc, img)
             pixbuf = image2pixbuf(img)
             doc.drop_cache()
 
@@ -133,6 +138,7 @@ class JobDocThumbnailer(Job):
 
             self.__current_idx = idx
 
+        self.factory.write_atlas()
         self.emit('doc-thumbnailing-end')
 
     def stop(self, will_resume=False):
@@ -150,6 +156,12 @@ class JobFactoryDocThumbnailer(JobFactory):
         JobFactory.__init__(self, "DocThumbnailer")
         self.__doclist = doclist
 
+    def add_atlas_thumbnail(self, doc, img):
+        self.__doclist.add_atlas_thumbnail(doc, img)
+
+    def write_atlas(self):
+        self.__doclist.write_atlas()
+
     def make(self, doclist):
         """
         Arguments:
@@ -328,6 +340,51 @@ class JobLabelDeleter(Job):
 GObject.type_register(JobLabelDeleter)
 
 
+class JobLabelCounter(Job):
+    """
+    Count the documents having each label (see DocSearch.get_facets())
+    """
+    __gsignals__ = {
+        # {label name: number of documents}
+        'label-counts': (GObject.SignalFlags.RUN_LAST, None,
+                         (GObject.TYPE_PYOBJECT, )),
+    }
+
+    can_stop = True
+    priority = 10
+
+    def __init__(self, factory, id, docsearch):
+        Job.__init__(self, factory, id)
+        self.__docsearch = docsearch
+
+    def do(self):
+        self.can_run = True
+        counts = self.__docsearch.get_facets()['labels']
+        if not self.can_run:
+            return
+        self.emit('label-counts', counts)
+
+    def stop(self, will_resume=False):
+        self.can_run = False
+
+
+GObject.type_register(JobLabelCounter)
+
+
+class JobFactoryLabelCounter(JobFactory):
+    def __init__(self, properties_panel):
+        JobFactory.__init__(self, "LabelCounter")
+        self.__properties_panel = properties_panel
+
+    def make(self, docsearch):
+        job = JobLabelCounter(self, next(self.id_generator), docsearch)
+        job.connect('label-counts',
+                    lambda counter, counts:
+                    GLib.idle_add(
+                        self.__properties_panel.on_label_counts_cb, counts))
+        return job
+
+
 class JobFactoryLabelDeleter(JobFactory):
     def __init__(self, doc_list):
         JobFactory.__init__(self, "LabelDeleter")
@@ -767,10 +824,51 @@ class DocList(object):
         finally:
             self.gui['list'].thaw_child_notify()
 
+    def get_atlas_thumbnail(self, doc):
+        """
+        Returns:
+            The thumbnail of the document from the thumbnail atlas (pixbuf),
+            or None if it is missing or out of date
+        """
+        docsearch = self.__main_win.docsearch
+        if docsearch.thumbnail_atlas is None:
+            return None
+        # the thumbnail only depends on the first page image (or PDF file),
+        # not on the labels or the text of the document
+        mtime = doc.get_thumbnail_source_mtime()
+        if mtime is None:
+            return None
+        img = docsearch.thumbnail_atlas.get(doc.docid, mtime)
+        if img is None:
+            return None
+        return image2pixbuf(img)
+
+    def add_atlas_thumbnail(self, doc, img):
+        """
+        Arguments:
+            img --- thumbnail of the document, as displayed (PIL image)
+        """
+        docsearch = self.__main_win.docsearch
+        if docsearch.thumbnail_atlas is None:
+            return
+        mtime = doc.get_thumbnail_source_mtime()
+        if mtime is None:
+            return
+        docsearch.thumbnail_atlas.put(doc.docid, mtime, img)
+
+    def write_atlas(self):
+        atlas = self.__main_win.docsearch.thumbnail_atlas
+        if atlas is not None:
+            atlas.write()
+
     def _make_listboxrow_doc_widget(self, doc, rowbox, selected=False):
         globalbox = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 10)
 
         # thumbnail
+        if doc.docid not in self.model['thumbnails']:
+            pixbuf = self.get_atlas_thumbnail(doc)
+            if pixbuf is not None:
+                self.model['thumbnails'][doc.docid] = pixbuf
         if doc.docid in self.model['thumbnails']:
             thumbnail = self.model['thumbnails'][doc.docid]
             thumbnail = Gtk.Image.new_from_pixbuf(thumbnail)
@@ -856,17 +954,7 @@ class DocList(object):
 
         self.clear()
 
-        self.gui['list'].freeze_child_notify()
-        try:
-            for doc in documents:
-                rowbox = Gtk.ListBoxRow()
-                selected = (doc.docid == self.__main_win.doc.docid)
-                self._make_listboxrow_doc_widget(doc, rowbox, selected)
-                self.model['by_row'][rowbox] = doc.docid
-                self.model['by_id'][doc.docid] = rowbox
-                self.gui['list'].add(rowbox)
-        finally:
-            self.gui['list'].thaw_child_notify()
+        self.__add_rows(documents)
 
         if need_new_doc:
             self.insert_new_doc()
@@ -884,6 +972,50 @@ class DocList(object):
 
         GLib.idle_add(self._on_scrollbar_value_changed)
 
+    def add_docs(self, rows):
+        """
+        Insert documents in the list (see set_docs())
+
+        Arguments:
+            rows --- list of (position, document), sorted by position. The
+                positions are those of the documents once they are all
+                inserted (the new document row excluded)
+        """
+        logger.info("Got %d more documents" % len(rows))
+        rows = [(position, doc) for (position, doc) in rows
+                if doc.docid not in self.model['by_id']]
+        offset = 1 if self.model['has_new'] else 0
+        self.gui['list'].freeze_child_notify()
+        try:
+            for (position, doc) in rows:
+                self.__add_row(doc, position + offset)
+        finally:
+            self.gui['list'].thaw_child_notify()
+
+        if (self.__main_win.doc
+                and self.__main_win.doc.docid in
+                [doc.docid for (_, doc) in rows]):
+            row = self.model['by_id'][self.__main_win.doc.docid]
+            self.gui['list'].select_row(row)
+
+        GLib.idle_add(self._on_scrollbar_value_changed)
+
+    def __add_row(self, doc, position=-1):
+        rowbox = Gtk.ListBoxRow()
+        selected = (doc.docid == self.__main_win.doc.docid)
+        self._make_listboxrow_doc_widget(doc, rowbox, selected)
+        self.model['by_row'][rowbox] = doc.docid
+        self.model['by_id'][doc.docid] = rowbox
+        self.gui['list'].insert(rowbox, position)
+
+    def __add_rows(self, documents):
+        self.gui['list'].freeze_child_notify()
+        try:
+            for doc in documents:
+                self.__add_row(doc)
+        finally:
+            self.gui['list'].thaw_child_notify()
+
     def refresh_docs(self, docs, redo_thumbnails=True):
         """
         Refresh specific documents in the document list
@@ -1036,6 +1168,7 @@ class DocPropertiesPanel(object):
             GLib.idle_add(self._open_calendar))
 
         self.job_factories = {
+            'label_counter': JobFactoryLabelCounter(self),
             'label_creator': JobFactoryLabelCreator(self),
             'label_deleter': JobFactoryLabelDeleter(self),
             'label_updater': JobFactoryLabelUpdater(self),
@@ -1053,6 +1186,7 @@ class DocPropertiesPanel(object):
 
         labels = sorted(main_window.docsearch.label_list)
         self.labels = {label: (None, None) for label in labels}
+        self.label_counts = {}  # label --> Gtk.Label
 
         default_buf = self.widgets['extra_keywords_default_buffer']
         self.default_extra_text = self.get_text_from_buffer(default_buf)
@@ -1168,10 +1302,12 @@ class DocPropertiesPanel(object):
                 self.widgets['labels'].remove(row)
         finally:
             self.labels = {}
+            self.label_counts = {}
             self.widgets['labels'].thaw_child_notify()
 
     def _readd_label_widgets(self, labels):
         label_widgets = {}
+        label_counts = {}
         self.widgets['labels'].freeze_child_notify()
         try:
             # Add a row for each label
@@ -1194,9 +1330,15 @@ class DocPropertiesPanel(object):
                 label_box.add(label_widget)
                 label_box.child_set_property(label_widget, 'expand', True)
 
+                # Number of documents with this label
+                count_widget = Gtk.Label.new("")
+                count_widget.get_style_context().add_class("dim-label")
+                label_box.add(count_widget)
+                label_counts[label] = count_widget
+
                 # Custom color_button wich opens custom dialog
                 edit_button = LabelColorButton()
-                edit_button.set_rgba(label.color)
+                edit_button.set_rgba(get_label_rgba(label))
                 edit_button.set_relief(Gtk.ReliefStyle.NONE)
                 edit_button.connect("clicked", self.on_label_button_clicked)
                 ActionEditLabel(self.__main_win, self).connect([edit_button])
@@ -1214,6 +1356,7 @@ class DocPropertiesPanel(object):
             self.widgets['labels'].add(self.widgets['row_add_label'])
         finally:
             self.labels = label_widgets
+            self.label_counts = label_counts
             self.widgets['labels'].connect(
                 "row-activated", self.on_row_activated)
             self.widgets['labels'].thaw_child_notify()
@@ -1264,6 +1407,20 @@ class DocPropertiesPanel(object):
             else:
                 active = False
             self.labels[label][0].set_active(active)
+        self.refresh_label_counts()
+
+    def refresh_label_counts(self):
+        # the counts come from a query on the whole index: not done in the
+        # Gtk thread
+        self.__main_win.schedulers['main'].cancel_all(
+            self.job_factories['label_counter'])
+        job = self.job_factories['label_counter'].make(
+            self.__main_win.docsearch)
+        self.__main_win.schedulers['main'].schedule(job)
+
+    def on_label_counts_cb(self, counts):
+        for (label, count_widget) in self.label_counts.iteritems():
+            count_widget.set_text(str(counts.get(label.name, 0)))
 
     def on_keywords_focus_in(self, textarea, event):
         extra_style = self.widgets['extra_keywords'].get_style_context()
@@ -28,7 +28,7 @@ from gi.repository import Pango
 from gi.repository import PangoCairo
 import PIL.Image
 
-from paperwork.backend.common.page import BasicPage
+from paperwork.backend.common.thumbnails import THUMB_SIZES
 from paperwork.backend.util import image2surface
 from paperwork.backend.util import split_words
 from paperwork.frontend.util.canvas.animations import SpinnerAnimation
@@ -36,6 +36,7 @@ from paperwork.frontend.util.canvas.drawers import Drawer
 from paperwork.frontend.util.imgcutting import ImgGripHandler
 from paperwork.frontend.util.jobs import Job
 from paperwork.frontend.util.jobs import JobFactory
+from paperwork.frontend.util import surfacecache
 
 
 _ = gettext.gettext
@@ -72,30 +73,44 @@ class JobPageImgLoader(Job):
             if not self.can_run:
                 return
 
-            use_thumbnail = True
-            if self.size[1] > (BasicPage.DEFAULT_THUMB_HEIGHT * 1.5):
-                use_thumbnail = False
-            if not self.can_run:
-                return
-            if not use_thumbnail:
-                img = self.page.img
-            else:
-                img = self.page.get_thumbnail(BasicPage.DEFAULT_THUMB_WIDTH,
-                                              BasicPage.DEFAULT_THUMB_HEIGHT)
-            if not self.can_run:
-                return
-            if self.size != img.size:
-                img = img.resize(self.size, PIL.Image.ANTIALIAS)
-            if not self.can_run:
-                return
-            img.load()
-            if not self.can_run:
-                return
-            self.emit('page-loading-img', image2surface(img))
+            key = surfacecache.get_key(self.page, self.size)
+            surface = surfacecache.get_surface(key)
+            if surface is None:
+                surface = self.__load_surface()
+                if surface is None:
+                    return
+                surfacecache.put_surface(key, surface)
+            self.emit('page-loading-img', surface)
 
         finally:
             self.emit('page-loading-done')
 
+    def __load_surface(self):
+        """
+        Returns:
+            The page image at the requested size, as a cairo surface. None if
+            the job has been stopped.
+        """
+        use_thumbnail = True
+        if self.size[1] > (THUMB_SIZES[-1][1][1] * 1.5):
+            use_thumbnail = False
+        if not use_thumbnail:
+            # decoded (or rendered) near the requested size, not at full
+            # resolution
+            img = self.page.get_image(self.size[0], self.size[1])
+        else:
+            img = self.page.get_thumbnail(self.size[0], self.size[1])
+        if not self.can_run:
+            return None
+        if self.size != img.size:
+            img = img.resize(self.size, PIL.Image.ANTIALIAS)
+        if not self.can_run:
+            return None
+        img.load()
+        if not self.can_run:
+            return None
+        return image2surface(img)
+
     def stop(self, will_resume=False):
         self.__cond.acquire()
         try:
@@ -126,6 +141,84 @@ class JobFactoryPageImgLoader(JobFactory):
         return job
 
 
+class JobPageTilesLoader(Job):
+    can_stop = True
+    priority = 500
+
+    __gsignals__ = {
+        'page-loading-start': (GObject.SignalFlags.RUN_LAST, None, ()),
+        'page-loading-tiles': (GObject.SignalFlags.RUN_LAST, None,
+                               (
+                                   GObject.TYPE_PYOBJECT,  # page size
+                                   # list of (tile, surface)
+                                   GObject.TYPE_PYOBJECT,
+                               )),
+        'page-loading-done': (GObject.SignalFlags.RUN_LAST, None, ()),
+    }
+
+    def __init__(self, factory, job_id, page, size, tiles):
+        """
+        Arguments:
+            size --- size of the whole page
+            tiles --- list of (tile, (x, y, width, height)): the tiles to
+                load and the area of the page they cover
+        """
+        Job.__init__(self, factory, job_id)
+        self.page = page
+        self.size = size
+        self.tiles = tiles
+
+    def do(self):
+        self.can_run = True
+        self.emit('page-loading-start')
+        try:
+            key = surfacecache.get_key(self.page, self.size)
+            loaded = []
+            missing = []
+            for (tile, rect) in self.tiles:
+                surface = surfacecache.get_surface(key + (tile, ))
+                if surface is None:
+                    missing.append((tile, rect))
+                else:
+                    loaded.append((tile, surface))
+            if missing and self.can_run:
+                surfaces = self.page.get_tiles(
+                    self.size, [rect for (_, rect) in missing])
+                for ((tile, _), surface) in zip(missing, surfaces):
+                    surfacecache.put_surface(key + (tile, ), surface)
+                    loaded.append((tile, surface))
+            if not self.can_run:
+                return
+            self.emit('page-loading-tiles', self.size, loaded)
+        finally:
+            self.emit('page-loading-done')
+
+    def stop(self, will_resume=False):
+        self.can_run = False
+
+
+GObject.type_register(JobPageTilesLoader)
+
+
+class JobFactoryPageTilesLoader(JobFactory):
+
+    def __init__(self):
+        JobFactory.__init__(self, "PageTilesLoader")
+
+    def make(self, drawer, page, size, tiles):
+        job = JobPageTilesLoader(self, next(self.id_generator), page, size,
+                                 tiles)
+        job.connect('page-loading-tiles',
+                    lambda job, size, tiles:
+                    GLib.idle_add(drawer.on_page_loading_tiles,
+                                  job.page, size, tiles))
+        job.connect('page-loading-done',
+                    lambda job:
+                    GLib.idle_add(drawer.on_page_loading_done,
+                                  job.page))
+        return job
+
+
 class JobPageBoxesLoader(Job):
     can_stop = True
     priority = 100
@@ -244,6 +337,11 @@ class PageDrawer(Drawer, GObject.GObject):
     BORDER_HIGHLIGHTED = (5, (0, 0.85, 0))
     TMP_AREA = (0.85, 0.85, 0.85)
 
+    # pages displayed bigger than this are split into tiles, and only the
+    # visible tiles are loaded
+    TILING_MIN_PIXELS = 2048 * 2048
+    TILE_SIZE = 512
+
     BUTTON_SIZE = 32
     BUTTON_BACKGROUND = (0.85, 0.85, 0.85)
     TOOLTIP_LENGTH = 200
@@ -292,6 +390,8 @@ class PageDrawer(Drawer, GObject.GObject):
         self.drag_enabled = True
 
         self.surface = None
+        self.tiles = {}  # (column, row) --> surface. Only the visible ones
+        self.tile_key = None  # see surfacecache.get_key()
         self.boxes = {
             'all': set(),
             'highlighted': set(),
@@ -496,9 +596,98 @@ class PageDrawer(Drawer, GObject.GObject):
         self.size = (int(factor * self.max_size[0]),
                      int(factor * self.max_size[1]))
 
+    def _is_tiled(self):
+        return self.size[0] * self.size[1] > self.TILING_MIN_PIXELS
+
+    def _get_tile_rect(self, tile):
+        (col, row) = tile
+        x = col * self.TILE_SIZE
+        y = row * self.TILE_SIZE
+        return (x, y,
+                min(self.TILE_SIZE, self.size[0] - x),
+                min(self.TILE_SIZE, self.size[1] - y))
+
+    def _get_visible_tiles(self, margin=0):
+        """
+        Arguments:
+            margin --- number of tiles to add around the visible area
+
+        Returns:
+            The tiles in the visible part of the canvas: list of
+            (column, row)
+        """
+        nb_cols = (self.size[0] + self.TILE_SIZE - 1) / self.TILE_SIZE
+        nb_rows = (self.size[1] + self.TILE_SIZE - 1) / self.TILE_SIZE
+        if self.angle != 0:
+            # being rotated in the editor
+            cols = xrange(0, nb_cols)
+            rows = xrange(0, nb_rows)
+        else:
+            area = (
+                int(self.canvas.offset[0] - self.position[0]),
+                int(self.canvas.offset[1] - self.position[1]),
+            )
+            area += (
+                area[0] + int(self.canvas.size[0]),
+                area[1] + int(self.canvas.size[1]),
+            )
+            cols = xrange(max(0, area[0] / self.TILE_SIZE - margin),
+                          min(nb_cols, area[2] / self.TILE_SIZE + margin + 1))
+            rows = xrange(max(0, area[1] / self.TILE_SIZE - margin),
+                          min(nb_rows, area[3] / self.TILE_SIZE + margin + 1))
+        return [(col, row) for row in rows for col in cols]
+
+    def _get_tiles(self):
+        """
+        Returns:
+            The visible tiles already loaded: list of ((x, y), surface).
+            Schedules the loading of the missing ones.
+        """
+        if self.tile_key is None:
+            self.tile_key = surfacecache.get_key(self.page, self.size)
+        tiles = {}
+        missing = False
+        for tile in self._get_visible_tiles():
+            surface = self.tiles.get(tile)
+            if surface is None:
+                surface = surfacecache.get_surface(self.tile_key + (tile, ))
+            if surface is None:
+                missing = True
+                continue
+            tiles[tile] = surface
+        # tiles out of view are only kept by the surface cache
+        self.tiles = tiles
+        if missing and not self.loading:
+            self._load_tiles()
+        return [(self._get_tile_rect(tile)[:2], surface)
+                for (tile, surface) in tiles.iteritems()]
+
+    def _load_tiles(self):
+        # the tiles around the visible area are loaded at the same time, so
+        # scrolling a little doesn't require loading more tiles
+        tiles = [(tile, self._get_tile_rect(tile))
+                 for tile in self._get_visible_tiles(margin=1)
+                 if tile not in self.tiles]
+        self.canvas.add_drawer(self.spinner)
+        self.loading = True
+        job = self.factories['page_tiles_loader'].make(self, self.page,
+                                                       self.size, tiles)
+        self.schedulers['page_tiles_loader'].schedule(job)
+
     def load_content(self):
         if self.loading:
             return
+        if self._is_tiled():
+            # the tiles are loaded by draw(), when they become visible
+            self._load_boxes()
+            return
+        # pages the user already looked at are displayed immediately
+        surface = surfacecache.get_surface(
+            surfacecache.get_key(self.page, self.size))
+        if surface is not None:
+            self.surface = surface
+            self._load_boxes()
+            return
         self.canvas.add_drawer(self.spinner)
         self.loading = True
         job = self.factories['page_img_loader'].make(self, self.page,
@@ -509,6 +698,18 @@ class PageDrawer(Drawer, GObject.GObject):
         if not self.visible:
             return
         self.surface = surface
+        self._load_boxes()
+
+    def on_page_loading_tiles(self, page, size, tiles):
+        if not self.visible or size != self.size:
+            return
+        visible = set(self._get_visible_tiles())
+        for (tile, surface) in tiles:
+            if tile in visible:
+                self.tiles[tile] = surface
+        self.redraw()
+
+    def _load_boxes(self):
         if (len(self.boxes['all']) <= 0
                 and (self.show_boxes or self.show_border)):
             job = self.factories['page_boxes_loader'].make(self, self.page)
@@ -518,7 +719,12 @@ class PageDrawer(Drawer, GObject.GObject):
         if self.loading:
             self.canvas.remove_drawer(self.spinner)
             self.loading = False
-        if self.visible and not self.surface:
+        if not self.visible:
+            return
+        if self._is_tiled():
+            # draw() loads the tiles still missing
+            self.redraw()
+        elif not self.surface:
             self.load_content()
 
     def _get_highlighted_boxes(self, sentence):
@@ -569,6 +775,8 @@ class PageDrawer(Drawer, GObject.GObject):
         if self.surface is not None:
             del(self.surface)
             self.surface = None
+        self.tiles = {}
+        self.tile_key = None
         self.boxes = {
             'all': set(),
             'highlighted': set(),
@@ -809,7 +1017,13 @@ class PageDrawer(Drawer, GObject.GObject):
                 and (self.mouse_over or self.boxes['highlighted'])):
             self.draw_border(cairo_context)
 
-        if not self.surface:
+        if self._is_tiled():
+            tiles = self._get_tiles()
+            if len(tiles) < len(self._get_visible_tiles()):
+                self.draw_tmp_area(cairo_context)
+            self.draw_tiles(cairo_context, tiles, self.position, self.size,
+                            angle=self.angle)
+        elif not self.surface:
             self.draw_tmp_area(cairo_context)
         else:
             self.draw_surface(cairo_context,
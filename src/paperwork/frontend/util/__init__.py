@@ -125,6 +125,16 @@ def sizeof_fmt(num):
     return _SIZEOF_FMT_STRINGS[-1] % (num)
 
 
+def get_label_rgba(label):
+    """
+    Returns:
+        The color of the label, as a Gdk.RGBA. The backend labels only know
+        their color as a string and a (r, g, b, a) tuple.
+    """
+    (red, green, blue, alpha) = label.rgba
+    return Gdk.RGBA(red=red, green=green, blue=blue, alpha=alpha)
+
+
 class PriorityQueueIter(object):
 
     def __init__(self, queue):
@@ -70,7 +70,6 @@ class Drawer(object):
             angle --- rotation to apply (WARNING: applied after positioning,
                       and rotated at the center of the surface !)
         """
-        angle = math.pi * angle / 180
         surface_size = (surface.get_width(), surface.get_height())
         scaling = (
             (float(img_size[0]) / float(surface_size[0])),
@@ -81,12 +80,7 @@ class Drawer(object):
         # context here
         cairo_ctx.save()
         try:
-            cairo_ctx.translate(img_position[0], img_position[1])
-            cairo_ctx.translate(-self.canvas.offset[0], -self.canvas.offset[1])
-            if angle != 0:
-                cairo_ctx.translate(img_size[0] / 2, img_size[1] / 2)
-                cairo_ctx.rotate(angle)
-                cairo_ctx.translate(-img_size[0] / 2, -img_size[1] / 2)
+            self.__transform(cairo_ctx, img_position, img_size, angle)
             cairo_ctx.scale(scaling[0], scaling[1])
 
             cairo_ctx.set_source_surface(
@@ -99,6 +93,38 @@ class Drawer(object):
         finally:
             cairo_ctx.restore()
 
+    def draw_tiles(self, cairo_ctx, tiles, img_position, img_size, angle=0):
+        """
+        Draw an image made of tiles. The tiles are not scaled.
+
+        Arguments:
+            cairo_ctx --- cairo context to draw on
+            tiles --- list of ((x, y), surface): the tiles and their position
+                      in the image
+            img_position --- target position for the image once on the canvas
+            img_size --- size of the whole image
+            angle --- rotation to apply (see draw_surface())
+        """
+        cairo_ctx.save()
+        try:
+            self.__transform(cairo_ctx, img_position, img_size, angle)
+            for ((x, y), surface) in tiles:
+                cairo_ctx.set_source_surface(surface, x, y)
+                cairo_ctx.rectangle(x, y,
+                                    surface.get_width(), surface.get_height())
+                cairo_ctx.fill()
+        finally:
+            cairo_ctx.restore()
+
+    def __transform(self, cairo_ctx, img_position, img_size, angle):
+        angle = math.pi * angle / 180
+        cairo_ctx.translate(img_position[0], img_position[1])
+        cairo_ctx.translate(-self.canvas.offset[0], -self.canvas.offset[1])
+        if angle != 0:
+            cairo_ctx.translate(img_size[0] / 2, img_size[1] / 2)
+            cairo_ctx.rotate(angle)
+            cairo_ctx.translate(-img_size[0] / 2, -img_size[1] / 2)
+
     def do_draw(self, cairo_ctx):
         """
         Arguments:
@@ -299,6 +299,19 @@ class JobScheduler(object):
         finally:
             self._job_queue_cond.release()
 
+    def is_scheduled(self, job):
+        """
+        Returns:
+            True if the job is queued or running
+        """
+        self._job_queue_cond.acquire()
+        try:
+            if self._active_job is job:
+                return True
+            return any(queued[2] is job for queued in self._job_queue)
+        finally:
+            self._job_queue_cond.release()
+
     def cancel(self, target_job):
         logger.debug("[Scheduler %s] Canceling job %s"
                      % (self.name, str(target_job)))
@@ -0,0 +1,88 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Process-wide cache of the decoded page images.
+
+The page drawers drop their surface as soon as they are out of view or
+resized. Decoding a page image again each time the user scrolls back to it
+is slow, so the surfaces (at the size they are displayed) are kept in this
+cache. It is limited by the memory used by the surfaces. The least recently
+used ones are dropped first.
+"""
+
+import os
+
+from paperwork.backend.util import LRUCache
+
+
+DEFAULT_MAX_BYTES = 96 * 1024 * 1024
+
+
+def get_surface_size(surface):
+    """
+    Returns:
+        The memory used by the pixels of a cairo image surface
+    """
+    return surface.get_stride() * surface.get_height()
+
+
+# (page id, size, inode, mtime) --> cairo.ImageSurface
+_cache = LRUCache(DEFAULT_MAX_BYTES, get_size=get_surface_size)
+
+
+def set_max_bytes(max_bytes):
+    """
+    Change the memory budget of the surface cache
+    """
+    _cache.max_size = max_bytes
+
+
+def get_key(page, size):
+    """
+    Arguments:
+        page --- page (see backend.common.page.BasicPage)
+        size --- (width, height) of the surface
+
+    Returns:
+        The cache key of the surface. It changes when the file the page
+        image comes from changes.
+    """
+    try:
+        stat = os.stat(page.get_doc_file_path())
+        file_id = (stat.st_ino, stat.st_mtime)
+    except OSError:
+        file_id = (None, None)
+    return (page.id, tuple(size)) + file_id
+
+
+def get_surface(key):
+    """
+    Returns:
+        The cached surface, or None. Surfaces are shared: they must not be
+        modified.
+    """
+    return _cache.get(key)
+
+
+def put_surface(key, surface):
+    _cache.put(key, surface)
+
+
+def get_stats():
+    """
+    See LRUCache.get_stats(). Sizes are in bytes.
+    """
+    return _cache.get_stats()
@@ -34,6 +34,7 @@ import signal
 
 from frontend.mainwindow import ActionRefreshIndex, MainWindow
 from frontend.util.config import load_config
+from paperwork.backend.common import procpool
 
 
 logger = logging.getLogger(__name__)
@@ -97,6 +98,9 @@ def main():
     init_logging()
     set_locale()
 
+    # must be done before any thread is started (see procpool)
+    procpool.start_pool()
+
     GObject.threads_init()
 
     if hasattr(GLib, "unix_signal_add"):
@@ -113,11 +117,16 @@ def main():
         ActionRefreshIndex(main_win, config).do()
         Gtk.main()
 
+        main_win.stop_workdir_watcher()
+        # must be done while the schedulers are running: stopping them
+        # cancels the index updates they have been given
+        main_win.flush_index_batch()
         for scheduler in main_win.schedulers.values():
             scheduler.stop()
 
         config.write()
     finally:
+        procpool.stop_pool()
         logger.info("Good bye")
 
 
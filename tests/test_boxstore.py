@@ -0,0 +1,115 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+import codecs
+import os
+import shutil
+import tempfile
+import unittest
+
+import pyocr.builders
+import pyocr.tesseract
+
+from paperwork.backend.common.boxstore import BoxStore
+from paperwork.backend.common.boxstore import load_boxes
+
+
+def _make_boxes():
+    return [
+        pyocr.builders.LineBox([
+            pyocr.builders.Box(u"Hello", ((10, 20), (50, 40))),
+            pyocr.builders.Box(u"w\xf6rld", ((60, 20), (110, 40))),
+        ], ((10, 20), (110, 40))),
+        pyocr.builders.LineBox([
+            pyocr.builders.Box(u"second", ((10, 50), (70, 70))),
+        ], ((10, 50), (70, 70))),
+    ]
+
+
+def _dump(boxes):
+    return [(line.position,
+             [(word.content, word.position) for word in line.word_boxes])
+            for line in boxes]
+
+
+class TestBoxStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.boxfile = os.path.join(self.tmpdir, "paper.1.words")
+        self.storefile = os.path.join(self.tmpdir, "paper.1.boxes")
+        # the store only looks at the size and mtime of the box file
+        with open(self.boxfile, 'w') as file_desc:
+            file_desc.write("<html></html>")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        src_stat = os.stat(self.boxfile)
+        BoxStore.write(self.storefile, _make_boxes(), src_stat)
+        store = BoxStore.load(self.storefile, src_stat)
+        self.assertNotEqual(store, None)
+        try:
+            self.assertEqual(_dump(store.get_boxes()), _dump(_make_boxes()))
+            self.assertEqual(store.get_line_texts(),
+                             [u"Hello w\xf6rld", u"second"])
+        finally:
+            store.close()
+
+    def test_invalidated_by_box_file(self):
+        src_stat = os.stat(self.boxfile)
+        BoxStore.write(self.storefile, _make_boxes(), src_stat)
+        # the box file is rewritten: its size changes
+        with open(self.boxfile, 'a') as file_desc:
+            file_desc.write("\n")
+        self.assertEqual(BoxStore.load(self.storefile,
+                                       os.stat(self.boxfile)), None)
+        # only its mtime changes
+        os.utime(self.boxfile, (src_stat.st_atime, src_stat.st_mtime + 10))
+        new_stat = os.stat(self.boxfile)
+        BoxStore.write(self.storefile, _make_boxes(), new_stat)
+        os.utime(self.boxfile, (src_stat.st_atime, src_stat.st_mtime + 20))
+        self.assertEqual(BoxStore.load(self.storefile,
+                                       os.stat(self.boxfile)), None)
+
+    def test_missing_or_corrupted(self):
+        src_stat = os.stat(self.boxfile)
+        self.assertEqual(BoxStore.load(self.storefile, src_stat), None)
+        with open(self.storefile, 'wb') as file_desc:
+            file_desc.write("PWBX")
+        self.assertEqual(BoxStore.load(self.storefile, src_stat), None)
+        with open(self.storefile, 'wb') as file_desc:
+            file_desc.write("X" * 256)
+        self.assertEqual(BoxStore.load(self.storefile, src_stat), None)
+
+    # with recent versions of pyocr, the builders need Tesseract
+    @unittest.skipUnless(pyocr.tesseract.is_available(),
+                         "Tesseract is not available")
+    def test_load_boxes(self):
+        with codecs.open(self.boxfile, 'w', encoding='utf-8') as file_desc:
+            pyocr.builders.LineBoxBuilder().write_file(file_desc,
+                                                      _make_boxes())
+        self.assertFalse(os.path.exists(self.storefile))
+        boxes = load_boxes(self.boxfile, self.storefile)
+        self.assertEqual(_dump(boxes), _dump(_make_boxes()))
+        # the store has been written from the box file
+        self.assertNotEqual(
+            BoxStore.load(self.storefile, os.stat(self.boxfile)), None)
+        self.assertEqual(_dump(load_boxes(self.boxfile, self.storefile)),
+                         _dump(_make_boxes()))
+        self.assertEqual(load_boxes(self.boxfile, self.storefile,
+                                    with_objects=False),
+                         [u"Hello w\xf6rld", u"second"])
@@ -0,0 +1,118 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from paperwork.backend.catalog import CatalogEntry
+from paperwork.backend.catalog import DocCatalog
+
+
+class TestDocCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "catalog")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def __write(self, generation):
+        catalog = DocCatalog(self.path)
+        catalog.entries = {
+            u"20140101_1200_00": CatalogEntry(
+                u"20140101_1200_00", u"IMG", nb_pages=2,
+                last_mod=1388577600.123456,
+                labels=[(u"b\xe9nk", "rgb(255,0,0)")],
+                page_sizes=[(2480, 3508), (3508, 2480)],
+                content_mtime=1388577500.5),
+            # page count and sizes unknown
+            u"20140102_1200_00": CatalogEntry(
+                u"20140102_1200_00", u"PDF", last_mod=1388664000.0),
+        }
+        catalog.write(generation)
+        return catalog
+
+    def test_round_trip(self):
+        written = self.__write(5)
+        catalog = DocCatalog(self.path)
+        self.assertTrue(catalog.load(5))
+        self.assertEqual(sorted(catalog.entries.keys()),
+                         sorted(written.entries.keys()))
+        for (docid, expected) in written.entries.iteritems():
+            entry = catalog.entries[docid]
+            self.assertEqual(entry.docid, expected.docid)
+            self.assertEqual(entry.doctype, expected.doctype)
+            self.assertEqual(entry.nb_pages, expected.nb_pages)
+            # the sub-second part of the mtimes is kept
+            self.assertEqual(entry.last_mod, expected.last_mod)
+            self.assertEqual(entry.content_mtime, expected.content_mtime)
+            self.assertEqual(entry.labels, expected.labels)
+            self.assertEqual([tuple(size) for size in entry.page_sizes],
+                             expected.page_sizes)
+
+    def test_doc_cache(self):
+        self.__write(1)
+        catalog = DocCatalog(self.path)
+        self.assertTrue(catalog.load(1))
+        cache = catalog.entries[u"20140101_1200_00"].get_doc_cache()
+        self.assertEqual(cache['nb_pages'], 2)
+        self.assertEqual(cache['last_mod'], 1388577600.123456)
+        self.assertEqual([label.name for label in cache['labels']],
+                         [u"b\xe9nk"])
+        # unknown page count: not in the cache
+        cache = catalog.entries[u"20140102_1200_00"].get_doc_cache()
+        self.assertFalse('nb_pages' in cache)
+
+    def test_missing(self):
+        catalog = DocCatalog(self.path)
+        self.assertFalse(catalog.load(1))
+        self.assertEqual(catalog.entries, {})
+
+    def test_generation_mismatch(self):
+        self.__write(5)
+        catalog = DocCatalog(self.path)
+        self.assertFalse(catalog.load(6))
+        self.assertEqual(catalog.entries, {})
+
+    def test_version_mismatch(self):
+        self.__write(5)
+        with open(self.path, 'r+b') as file_desc:
+            file_desc.seek(len(DocCatalog.MAGIC))
+            file_desc.write(struct.pack("<I", DocCatalog.VERSION + 1))
+        catalog = DocCatalog(self.path)
+        self.assertFalse(catalog.load(5))
+        self.assertEqual(catalog.entries, {})
+
+    def test_corrupted(self):
+        self.__write(5)
+        with open(self.path, 'rb') as file_desc:
+            content = file_desc.read()
+        with open(self.path, 'wb') as file_desc:
+            file_desc.write(content[:len(content) / 2])
+        catalog = DocCatalog(self.path)
+        self.assertFalse(catalog.load(5))
+        self.assertEqual(catalog.entries, {})
+
+    def test_destroy(self):
+        catalog = self.__write(5)
+        catalog.destroy()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(catalog.entries, {})
+        # nothing to destroy
+        catalog.destroy()
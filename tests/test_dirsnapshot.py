@@ -0,0 +1,106 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from paperwork.backend.common.dirsnapshot import DocDirSnapshot
+
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.docpath = tempfile.mkdtemp()
+        for filename in ["paper.1.jpg", "paper.1.words", "paper.2.jpg",
+                         "paper.2.words", "labels"]:
+            self.__write(filename, "content of %s" % filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.docpath)
+
+    def __write(self, filename, content, mode='w'):
+        with open(os.path.join(self.docpath, filename), mode) as file_desc:
+            file_desc.write(content)
+
+    def __get_fingerprint(self):
+        # a new snapshot each time: they never look at the directory again
+        return DocDirSnapshot(self.docpath).get_fingerprint()
+
+    def test_stable(self):
+        fingerprint = self.__get_fingerprint()
+        self.assertTrue(isinstance(fingerprint, unicode))
+        self.assertEqual(self.__get_fingerprint(), fingerprint)
+
+    def test_missing_directory(self):
+        shutil.rmtree(self.docpath)
+        self.assertEqual(self.__get_fingerprint(), None)
+        os.mkdir(self.docpath)
+
+    def test_ignored_files(self):
+        fingerprint = self.__get_fingerprint()
+        # thumbnails, caches and temporary files are written by Paperwork
+        # itself and don't change the document
+        self.__write("paper.1.thumb.jpg", "thumbnail")
+        self.__write("paper.1.boxes", "box store")
+        self.__write("text.cache", "text cache")
+        self.__write("text.cache.abc123.tmp", "temporary file")
+        self.assertEqual(self.__get_fingerprint(), fingerprint)
+
+    def test_new_page(self):
+        fingerprint = self.__get_fingerprint()
+        self.__write("paper.3.jpg", "new page")
+        self.assertNotEqual(self.__get_fingerprint(), fingerprint)
+
+    def test_removed_page(self):
+        fingerprint = self.__get_fingerprint()
+        os.unlink(os.path.join(self.docpath, "paper.2.jpg"))
+        self.assertNotEqual(self.__get_fingerprint(), fingerprint)
+
+    def test_labels_modified(self):
+        fingerprint = self.__get_fingerprint()
+        self.__write("labels", "new label\n", mode='a')
+        self.assertNotEqual(self.__get_fingerprint(), fingerprint)
+
+    def test_extra_text_modified(self):
+        self.__write("extra.txt", "abc")
+        fingerprint = self.__get_fingerprint()
+        # same size, different mtime
+        path = os.path.join(self.docpath, "extra.txt")
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertNotEqual(self.__get_fingerprint(), fingerprint)
+
+    def test_stat_calls(self):
+        # whatever the number of pages, only the label file and the extra
+        # text file are stat()ed
+        for page_nb in xrange(3, 50):
+            self.__write("paper.%d.jpg" % page_nb, "page")
+            self.__write("paper.%d.words" % page_nb, "boxes")
+        stated = []
+        real_stat = os.stat
+
+        def counting_stat(path):
+            stated.append(os.path.basename(path))
+            return real_stat(path)
+
+        snapshot = DocDirSnapshot(self.docpath)
+        os.stat = counting_stat
+        try:
+            snapshot.get_fingerprint()
+        finally:
+            os.stat = real_stat
+        self.assertEqual(stated, ["labels"])
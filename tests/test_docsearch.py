@@ -0,0 +1,138 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+import shutil
+import tempfile
+import unittest
+
+import whoosh.fields
+import whoosh.index
+import whoosh.query
+
+from paperwork.backend.docsearch import DocSearchResults
+
+
+class _CountingSearcher(object):
+    """
+    Whoosh searcher keeping track of the searches run
+    """
+    def __init__(self, searcher):
+        self.searcher = searcher
+        self.limits = []
+
+    def search(self, query, limit=10, **kwargs):
+        self.limits.append(limit)
+        return self.searcher.search(query, limit=limit, **kwargs)
+
+    def stored_fields(self, docnum):
+        return self.searcher.stored_fields(docnum)
+
+
+class TestDocSearchResults(unittest.TestCase):
+    NB_DOCS = 100
+
+    def setUp(self):
+        self.indexdir = tempfile.mkdtemp()
+        schema = whoosh.fields.Schema(
+            docid=whoosh.fields.ID(stored=True, unique=True),
+            content=whoosh.fields.TEXT,
+        )
+        index = whoosh.index.create_in(self.indexdir, schema)
+        writer = index.writer()
+        for idx in xrange(0, self.NB_DOCS):
+            # every document contains "alpha", one out of two "beta"
+            content = u"alpha"
+            if idx % 2 == 1:
+                content += u" beta"
+            writer.add_document(docid=u"doc%03d" % idx, content=content)
+        writer.commit()
+        self.index = index
+        self.searcher = _CountingSearcher(index.searcher())
+        self.queries = [
+            (whoosh.query.Term("content", u"beta"), None, None),
+            (whoosh.query.Term("content", u"alpha"), None, None),
+        ]
+
+    def tearDown(self):
+        self.searcher.searcher.close()
+        self.index.close()
+        shutil.rmtree(self.indexdir)
+
+    def test_paging(self):
+        results = DocSearchResults(self.searcher, self.queries)
+        pages = []
+        offset = 0
+        while True:
+            page = results.get_page(offset, 10)
+            if len(page) <= 0:
+                break
+            self.assertTrue(len(page) <= 10)
+            pages += page
+            offset += len(page)
+        self.assertEqual(len(pages), self.NB_DOCS)
+        # pages don't change once fetched
+        self.assertEqual(results.get_page(20, 10), pages[20:30])
+        self.assertEqual(results.get_all(), pages)
+
+    def test_dedup(self):
+        results = DocSearchResults(self.searcher, self.queries)
+        docids = results.get_all()
+        self.assertEqual(len(docids), self.NB_DOCS)
+        self.assertEqual(len(set(docids)), self.NB_DOCS)
+        # the results of the first query come first
+        self.assertEqual(
+            set(docids[:self.NB_DOCS / 2]),
+            set([u"doc%03d" % idx
+                 for idx in xrange(1, self.NB_DOCS, 2)]))
+        self.assertEqual(list(DocSearchResults(self.searcher, self.queries)),
+                         docids)
+
+    def test_first_page_is_limited(self):
+        results = DocSearchResults(self.searcher, self.queries)
+        self.assertEqual(len(results.get_page(0, 10)), 10)
+        self.assertEqual(self.searcher.limits,
+                         [DocSearchResults.FIRST_FETCH])
+        self.assertEqual(results.get_query_docnums(), None)
+
+    def test_each_query_run_at_most_twice(self):
+        results = DocSearchResults(self.searcher, self.queries)
+        offset = 0
+        while len(results.get_page(offset, 5)) > 0:
+            offset += 5
+        self.assertEqual(offset, self.NB_DOCS)
+        # each query: once with a limit, then once without, whatever the
+        # number of pages requested
+        self.assertEqual(self.searcher.limits[:2],
+                         [DocSearchResults.FIRST_FETCH, None])
+        self.assertEqual(self.searcher.limits[2:],
+                         [DocSearchResults.FIRST_FETCH, None])
+
+    def test_query_docnums(self):
+        done = []
+        results = DocSearchResults(self.searcher, self.queries,
+                                   done_cb=done.append)
+        results.get_all()
+        query_docnums = results.get_query_docnums()
+        self.assertEqual([len(docnums) for docnums in query_docnums],
+                         [self.NB_DOCS / 2, self.NB_DOCS])
+        self.assertEqual(done, [query_docnums])
+
+    def test_no_result(self):
+        queries = [(whoosh.query.Term("content", u"gamma"), None, None)]
+        results = DocSearchResults(self.searcher, queries)
+        self.assertEqual(results.get_page(0, 10), [])
+        self.assertEqual(results.get_all(), [])
+        self.assertEqual(list(results), [])
@@ -0,0 +1,77 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from paperwork.backend.labels import format_color
+from paperwork.backend.labels import parse_color
+
+
+class TestColors(unittest.TestCase):
+    def assertColorEqual(self, color, expected):
+        self.assertEqual(len(color), 4)
+        for (channel, expected_channel) in zip(color, expected):
+            self.assertAlmostEqual(channel, expected_channel, places=6)
+
+    def test_parse_hex(self):
+        # same results as Gdk.RGBA.parse()
+        self.assertColorEqual(parse_color("#f00"), (1.0, 0.0, 0.0, 1.0))
+        self.assertColorEqual(parse_color("#00ff00"), (0.0, 1.0, 0.0, 1.0))
+        self.assertColorEqual(parse_color("#000000fff"),
+                              (0.0, 0.0, 1.0, 1.0))
+        self.assertColorEqual(parse_color("#000000000000"),
+                              (0.0, 0.0, 0.0, 1.0))
+        self.assertColorEqual(parse_color("#8080ffff0000"),
+                              (0x8080 / 65535.0, 1.0, 0.0, 1.0))
+        self.assertColorEqual(parse_color("#8c0"),
+                              (0x88 / 255.0, 0xcc / 255.0, 0.0, 1.0))
+        self.assertColorEqual(parse_color(" #FFFFFF\n"),
+                              (1.0, 1.0, 1.0, 1.0))
+
+    def test_parse_rgb(self):
+        self.assertColorEqual(parse_color("rgb(255,0,51)"),
+                              (1.0, 0.0, 0.2, 1.0))
+        self.assertColorEqual(parse_color("RGB( 0 , 255 , 0 )"),
+                              (0.0, 1.0, 0.0, 1.0))
+        self.assertColorEqual(parse_color("rgb(50%,100%,0%)"),
+                              (0.5, 1.0, 0.0, 1.0))
+        self.assertColorEqual(parse_color("rgba(255,0,0,0.5)"),
+                              (1.0, 0.0, 0.0, 0.5))
+        # out of range values are clamped
+        self.assertColorEqual(parse_color("rgba(300,-5,0,2)"),
+                              (1.0, 0.0, 0.0, 1.0))
+
+    def test_parse_invalid(self):
+        for color in ["", "red", "#ff", "#fffff", "#ggg", "rgb(1,2)",
+                      "rgba(1,2,3)", "rgb(1,2,3", "rgb(a,b,c)"]:
+            self.assertRaises(ValueError, parse_color, color)
+
+    def test_format(self):
+        # same results as Gdk.RGBA.to_string()
+        self.assertEqual(format_color((1.0, 0.0, 0.2, 1.0)),
+                         "rgb(255,0,51)")
+        self.assertEqual(format_color((0.0, 0.0, 0.0, 1.0)), "rgb(0,0,0)")
+        self.assertEqual(format_color((1.0, 0.5, 0.0, 0.5)),
+                         "rgba(255,128,0,0.5)")
+
+    def test_round_trip(self):
+        for color in ["rgb(255,0,51)", "rgb(0,0,0)", "rgb(18,52,86)",
+                      "rgba(255,128,0,0.5)"]:
+            self.assertEqual(format_color(parse_color(color)), color)
+        self.assertEqual(format_color(parse_color("#000000000000")),
+                         "rgb(0,0,0)")
+        self.assertEqual(format_color(parse_color("#ff8000")),
+                         "rgb(255,128,0)")
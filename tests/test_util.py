@@ -0,0 +1,92 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2014  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from paperwork.backend.util import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = LRUCache(4)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("a", 42), 42)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertTrue("a" in cache)
+        self.assertEqual(len(cache), 1)
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        # "a" becomes the most recently used entry
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_size_budget(self):
+        cache = LRUCache(10, get_size=len)
+        cache.put("a", "aaaa")
+        cache.put("b", "bbbb")
+        cache.put("c", "cc")
+        self.assertEqual(cache.size, 10)
+        self.assertEqual(len(cache), 3)
+
+        cache.put("d", "d")
+        self.assertFalse("a" in cache)
+        self.assertEqual(cache.size, 7)
+
+        # the oldest entries are evicted until the new one fits
+        cache.put("e", "eeeeeeee")
+        self.assertEqual(len(cache), 2)
+        self.assertTrue("d" in cache)
+        self.assertTrue("e" in cache)
+        self.assertEqual(cache.size, 9)
+
+    def test_too_big(self):
+        cache = LRUCache(4, get_size=len)
+        cache.put("a", "aa")
+        cache.put("b", "bbbbbb")
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.get("a"), "aa")
+        self.assertEqual(cache.size, 2)
+
+    def test_replace(self):
+        cache = LRUCache(10, get_size=len)
+        cache.put("a", "aaaa")
+        cache.put("a", "aa")
+        self.assertEqual(cache.get("a"), "aa")
+        self.assertEqual(cache.size, 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_pop_clear(self):
+        cache = LRUCache(10, get_size=len)
+        cache.put("a", "aaaa")
+        cache.put("b", "bb")
+        self.assertEqual(cache.pop("a"), "aaaa")
+        self.assertEqual(cache.pop("a", 42), 42)
+        self.assertEqual(cache.size, 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)